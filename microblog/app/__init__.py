@@ -7,23 +7,99 @@
 # executes and defines what symbols the package exposes
 # to the outside world.
 
+import os
+
 from flask import Flask
 
 # Read the config file.
-from config import Config
+from config import config
 
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask_login import LoginManager
+
+from app import database
+
+db = SQLAlchemy(session_options={'class_': database.RoutingSession})
+login = LoginManager()
+login.login_view = 'auth.login'
+
+from app.cache import FragmentCache
+fragment_cache = FragmentCache()
+
+
+def create_app(config_class=None):
+    app = Flask(__name__)
+
+    # Apply the config file. Unless told otherwise, the profile is picked by
+    # the MICROBLOG_CONFIG environment variable.
+    if config_class is None:
+        config_class = config[os.environ.get('MICROBLOG_CONFIG') or 'default']
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+    database.init_app(app)
+
+    from app import instrumentation
+    instrumentation.init_app(app)
+    login.init_app(app)
+    fragment_cache.init_app(app)
+
+    from app import passwords
+    passwords.init_app(app)
+
+    from app import ratelimit
+    ratelimit.init_app(app)
+
+    from app import tokens
+    tokens.init_app(app)
+
+    from app import usercache
+    usercache.init_app(app)
 
-app = Flask(__name__)
+    from app import search
+    search.init_app(app)
 
-# Apply the config file.
-app.config.from_object(Config)
+    from app.main import bp as main_bp
+    app.register_blueprint(main_bp)
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+    from app.auth import bp as auth_bp
+    app.register_blueprint(auth_bp)
 
-from app import routes, models
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    from app import cli
+    cli.register(app)
+
+    from app import templating
+    templating.init_app(app)
+
+    if app.config['SQLALCHEMY_ASYNC']:
+        from app import aio
+        aio.init_app(app)
+
+    return app
+
+
+from app import models
+
+'''
+The application is now built by the create_app() factory function instead of
+at import time. The extensions are created once, unbound, and attached to
+each application with init_app(), and the views are registered through
+blueprints. Importing the package is cheap, and tests or scripts can create
+as many applications as they need, each with its own configuration:
+
+    app = create_app(SomeOtherConfig)
+
+Flask-Migrate (and with it Alembic) is not set up here at all. Only the
+flask db commands need it, so app/cli.py registers a stand-in db command
+that imports and initializes Flask-Migrate the first time it is used. Web
+workers never pay for it.
+
+The notes below were written when the app object was still created at the
+top of this file.
+'''
 
 # The logic above, creates the application object,
 # as an instance of the class Flask, imported
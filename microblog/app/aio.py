@@ -0,0 +1,65 @@
+import asyncio
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.database import listen_for_pragmas
+
+'''
+Async database access
+
+When SQLALCHEMY_ASYNC is set in the configuration, the index and login views
+are replaced by async def versions (see app/async_routes.py) that talk to the
+database through an AsyncEngine, so that the worker is free to do something
+else while it waits on the database. Everything else, including the models
+and the migrations, keeps using the regular Flask-SQLAlchemy engine, and both
+engines point at the same database.
+
+Flask runs every async view in an event loop of its own, and connections of
+an async driver belong to the loop that opened them. That is why the async
+engine does not keep a connection pool around between requests (NullPool),
+and why init_app() opens a first connection itself: SQLAlchemy serializes the
+very first connect of an engine with a lock that belongs to the event loop of
+whoever gets there first, and requests arriving in other loops at the same
+time would fail on it.
+'''
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def async_url(url):
+    '''
+    Turn a database URL for a regular driver into the same URL for the async
+    driver of that database, e.g. sqlite:///app.db -> sqlite+aiosqlite:///...
+    '''
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver known for {backend} databases')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def init_app(app):
+    engine = create_async_engine(
+        async_url(app.config['SQLALCHEMY_DATABASE_URI']), poolclass=NullPool)
+    # The PRAGMA statements go to the DBAPI connections, which the async
+    # engine drives through its sync_engine.
+    listen_for_pragmas(engine.sync_engine, app.config['SQLITE_PRAGMAS'])
+    asyncio.run(_first_connect(engine))
+    app.extensions['async_db'] = async_sessionmaker(engine,
+                                                    expire_on_commit=False)
+
+    from app import async_routes
+    app.view_functions['main.index'] = async_routes.index
+    app.view_functions['auth.login'] = async_routes.login
+    return engine
+
+
+async def _first_connect(engine):
+    async with engine.connect():
+        pass
@@ -0,0 +1,8 @@
+from flask import Blueprint
+
+bp = Blueprint('api', __name__)
+
+from app.api import routes
+
+# The api blueprint holds the views that are meant for programs rather than
+# browsers. They take and return JSON, and are mounted under /api/v1.
@@ -0,0 +1,56 @@
+import json
+
+from flask import request, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+'''
+Response encoding for the JSON API
+
+The timeline endpoints can send a few thousand small objects a second per
+worker, and with the standard json module encoding them takes longer than
+the queries. When orjson is installed it is used instead, and when msgpack
+is installed clients can ask for MessagePack, which is smaller on the wire,
+with ?format=msgpack or an Accept header of application/msgpack. Both are
+optional: without them the API falls back to the json module, and answers
+requests for MessagePack with 406.
+
+Timestamps go out as ISO 8601 strings in UTC in both formats.
+'''
+
+MSGPACK = 'application/msgpack'
+
+
+def dumps_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def wants_msgpack():
+    if request.args.get('format') == 'msgpack':
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', MSGPACK, 'application/x-msgpack'],
+        default='application/json') != 'application/json'
+
+
+def encode(data, status=200, headers=None):
+    '''Encode data in the format the client asked for, as a Response.'''
+    if wants_msgpack():
+        if msgpack is None:
+            return Response(dumps_json({'error': 'MessagePack is not '
+                                        'available'}), 406,
+                            mimetype='application/json')
+        return Response(msgpack.packb(data), status, headers,
+                        mimetype=MSGPACK)
+    return Response(dumps_json(data), status, headers,
+                    mimetype='application/json')
@@ -0,0 +1,198 @@
+import hmac
+from functools import wraps
+
+from flask import current_app, g, request, Response, stream_with_context
+
+from app import db, ingest, ratelimit, tokens, export as exporter
+from app.api import bp
+from app.api.encoding import encode
+from app.models import Post, User, author_sources, feed_sources, \
+    paginate_keyset, query_budget
+from app.usercache import find_user
+
+
+def token_required(config_key):
+    '''
+    Only let through requests that carry the token of the config_key
+    configuration variable as a bearer token. The views protected this way
+    work on everybody's data, and are closed while no token is configured.
+    '''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            token = current_app.config[config_key]
+            supplied = request.headers.get('Authorization', '')
+            if not token or not hmac.compare_digest(
+                    supplied.encode(), f'Bearer {token}'.encode()):
+                return {'error': 'forbidden'}, 403
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def authenticate(optional=False):
+    '''
+    Check the API token (see app/tokens.py) sent as a bearer token, and put
+    the id of the user it was issued to in g.token_user_id. The User is not
+    loaded, views that need more than the id query it themselves. Return a
+    401 response when the token is not valid, or missing and not optional.
+    '''
+    header = request.headers.get('Authorization')
+    if header is None and optional:
+        return None
+    scheme, _, token = (header or '').partition(' ')
+    user_id = tokens.verify_token(token) \
+        if scheme.lower() == 'bearer' else None
+    if user_id is None:
+        return {'error': 'unauthorized'}, 401, {'WWW-Authenticate': 'Bearer'}
+    g.token_user_id = user_id
+    return None
+
+
+def token_auth_required(f):
+    '''Only let through requests that carry a valid API token.'''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return authenticate() or f(*args, **kwargs)
+    return wrapper
+
+
+@bp.route('/tokens', methods=['POST'])
+def issue_token():
+    '''
+    Exchange a username and password, sent with HTTP Basic authentication,
+    for an API token. This is the only API request that reads the user and
+    hashes a password, so it is throttled like the login form.
+    '''
+    auth = request.authorization
+    if auth is None or auth.type != 'basic':
+        return {'error': 'unauthorized'}, 401, \
+            {'WWW-Authenticate': 'Basic realm="microblog"'}
+    throttled = ratelimit.check_login(auth.username or '')
+    if throttled is not None:
+        return throttled
+    user = find_user(username=auth.username or '')
+    if user is None or not user.check_password(auth.password or ''):
+        return {'error': 'unauthorized'}, 401, \
+            {'WWW-Authenticate': 'Basic realm="microblog"'}
+    # check_password() may have upgraded the password hash.
+    db.session.commit()
+    token, expires = tokens.issue_token(user.id)
+    return {'token': token, 'expires': expires}
+
+
+@bp.route('/posts/import', methods=['POST'])
+@token_required('IMPORT_API_TOKEN')
+def import_posts():
+    '''
+    Import the posts in the request body, NDJSON or a JSON array (see
+    app/ingest.py). The body is read as a stream, so it can be much larger
+    than the memory of the worker. The response is the final report, and the
+    progress is logged after every chunk.
+    '''
+    chunk_size = request.args.get('chunk_size', type=int)
+    report = ingest.import_posts(
+        request.stream, chunk_size,
+        progress=lambda report: current_app.logger.info('Import: %s', report))
+    return report.to_dict()
+
+
+@bp.route('/export/<table>')
+@token_required('EXPORT_API_TOKEN')
+def export(table):
+    '''
+    Stream the users or posts table as NDJSON (the default) or CSV, gzip
+    compressed when the client accepts it. Exports of posts send the
+    watermark to pass as ?since= next time in the X-Export-Watermark header.
+    '''
+    fmt = request.args.get('format', 'ndjson')
+    if table not in exporter.COLUMNS or fmt not in exporter.FORMATS:
+        return {'error': 'not found'}, 404
+    since = request.args.get('since')
+    compress = 'gzip' in request.accept_encodings
+    until = exporter.watermark() if table == 'posts' else None
+    try:
+        chunks = exporter.export(table, fmt, since, until, compress)
+    except ValueError:
+        return {'error': 'invalid watermark'}, 400
+    headers = {}
+    if table == 'posts' and (until or since):
+        headers['X-Export-Watermark'] = until or since
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+    # The context keeps db.session usable while the response is streamed,
+    # after this function has returned.
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers=headers)
+
+
+# Fields of a post in the timeline API, and the columns they are read from,
+# given the model of the posts (Post, or ArchivedPost for the archive). The
+# timeline queries join the author already, so the username is free.
+POST_FIELDS = {
+    'id': lambda post: post.id,
+    'body': lambda post: post.body,
+    'timestamp': lambda post: post.timestamp,
+    'author': lambda post: User.username,
+}
+
+
+def timeline_response(sources):
+    '''
+    Send one page of a timeline as {"posts": [...], "next_cursor": ...,
+    "prev_cursor": ...}, with the same cursors as the HTML timeline. Only the
+    columns of the fields asked for with ?fields= are selected, as plain rows
+    instead of Post objects, plus the timestamp and id that the cursors are
+    made of.
+    '''
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else list(POST_FIELDS)
+    unknown = [name for name in fields if name not in POST_FIELDS]
+    if unknown:
+        return encode({'error': f'unknown fields: {", ".join(unknown)}',
+                       'fields': list(POST_FIELDS)}, 400)
+
+    def columns(post):
+        return [post.timestamp.label('timestamp'), post.id.label('id')] + \
+            [POST_FIELDS[name](post).label(f'f_{name}') for name in fields]
+
+    per_page = min(request.args.get('per_page', type=int) or
+                   current_app.config['POSTS_PER_PAGE'], 100)
+    try:
+        page = paginate_keyset(sources, before=request.args.get('before'),
+                               after=request.args.get('after'),
+                               per_page=max(per_page, 1), columns=columns)
+    except ValueError:
+        return encode({'error': 'invalid cursor'}, 400)
+    posts = [dict(zip(fields, row[2:])) for row in page]
+    if 'timestamp' in fields:
+        for post in posts:
+            post['timestamp'] = post['timestamp'].isoformat() + 'Z'
+    return encode({'posts': posts, 'next_cursor': page.next_cursor,
+                   'prev_cursor': page.prev_cursor})
+
+
+@bp.route('/timeline')
+@query_budget()
+def timeline():
+    '''
+    The home timeline of the user of the API token, or the public timeline
+    when the request has no token. The token is only checked, so this costs
+    the timeline queries and nothing else.
+    '''
+    unauthorized = authenticate(optional=True)
+    if unauthorized is not None:
+        return unauthorized
+    if 'token_user_id' in g:
+        return timeline_response(feed_sources(g.token_user_id))
+    return timeline_response(Post.timeline_sources())
+
+
+@bp.route('/users/<username>/posts')
+@query_budget()
+def user_posts(username):
+    user = find_user(username=username)
+    if user is None:
+        return encode({'error': 'not found'}, 404)
+    return timeline_response(author_sources(user.id))
@@ -0,0 +1,101 @@
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.models import ArchivedFeedEntry, ArchivedPost, FeedEntry, Post, \
+    archive_horizon
+
+'''
+Post archive
+
+Nearly every read of posts is of the last few days, while the post and
+feed_entry tables, and their indexes, keep every post ever written. "flask
+posts archive" moves the posts older than ARCHIVE_AFTER_DAYS, with their feed
+rows, to the post_archive and feed_entry_archive tables, which have the same
+columns and the same indexes. The indexes the pages of recent posts are read
+from then only cover recent posts, and stay small enough to be kept in
+memory.
+
+Reads go through the timeline sources of app/models.py, which include the
+archive tables, but only query them for the pages that reach past the
+horizon: archived posts are all older than it, so a page of newer posts
+cannot hold any. Moving posts changes nothing on the pages, the posts keep
+their ids and columns, so the cached pages and the ETags stay valid. The post
+counters of the users include archived posts. The archive has a full-text
+index of its own (see app/search.py), which the search page reads along with
+the one of the post table, so archived posts can still be found.
+
+Posts are moved oldest first in batches of ARCHIVE_BATCH_SIZE, each batch in
+a transaction of its own that copies the rows and deletes them from where they
+were, so a post is always in exactly one of the tables, writers only wait for
+one batch at a time, and an interrupted run leaves the rest for the next one.
+
+The post with the highest id is never archived, because SQLite gives a new
+row the highest id in the table plus one, and would hand out the ids of the
+archived posts again.
+
+The horizon can be shortened at any time. After making it longer, the posts
+archived between the old and the new horizon are missing from the timelines
+until "flask posts archive --restore" moves them back.
+'''
+
+
+def archive_posts(batch_size=None, progress=None):
+    '''
+    Move the posts older than the horizon to the archive. Return the number
+    of posts moved. progress is called with the total after every batch.
+    '''
+    newest = sa.select(sa.func.max(Post.id)).scalar_subquery()
+    return _move(Post, FeedEntry, ArchivedPost, ArchivedFeedEntry,
+                 sa.and_(Post.timestamp < archive_horizon(), Post.id != newest),
+                 batch_size, progress)
+
+
+def restore_posts(batch_size=None, progress=None):
+    '''
+    Move the archived posts that are newer than the horizon back to the post
+    table. Return the number of posts moved.
+    '''
+    return _move(ArchivedPost, ArchivedFeedEntry, Post, FeedEntry,
+                 ArchivedPost.timestamp >= archive_horizon(), batch_size,
+                 progress)
+
+
+def _move(source, source_feed, target, target_feed, condition, batch_size,
+          progress):
+    batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+    # The batches are picked and moved on the primary, a replica may not
+    # have the latest posts or deletions yet.
+    db.session.info['wrote'] = True
+    post_columns = [column.name for column in ArchivedPost.__table__.columns]
+    feed_columns = [column.name
+                    for column in ArchivedFeedEntry.__table__.columns]
+    moved = 0
+    while True:
+        ids = db.session.scalars(
+            sa.select(source.id).where(condition)
+            .order_by(source.timestamp, source.id).limit(batch_size)).all()
+        if not ids:
+            break
+        # Bulk statements, which do not fire the mapper events, so the
+        # counters are left alone and no feed rows are fanned out. The
+        # full-text indexes follow the two tables through their triggers.
+        db.session.execute(sa.insert(target).from_select(
+            post_columns, sa.select(*[getattr(source, name)
+                                      for name in post_columns])
+            .where(source.id.in_(ids))))
+        db.session.execute(sa.insert(target_feed).from_select(
+            feed_columns, sa.select(*[getattr(source_feed, name)
+                                      for name in feed_columns])
+            .where(source_feed.post_id.in_(ids))))
+        db.session.execute(
+            sa.delete(source_feed).where(source_feed.post_id.in_(ids))
+            .execution_options(synchronize_session=False))
+        db.session.execute(
+            sa.delete(source).where(source.id.in_(ids))
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        moved += len(ids)
+        if progress is not None:
+            progress(moved)
+    return moved
@@ -0,0 +1,84 @@
+from flask import current_app, render_template, flash, redirect, url_for, \
+    request, abort, make_response
+from flask_login import current_user, login_user
+from markupsafe import Markup
+from app import conditional, fragment_cache, passwords
+from app.auth.forms import LoginForm
+from app.models import User, Post, keyset_keys_async, \
+    paginate_keyset_async
+from app.usercache import find_user_async
+
+'''
+The async def versions of the index and login views. When the
+SQLALCHEMY_ASYNC configuration variable is set, app/aio.py registers them for
+the main.index and auth.login endpoints, in place of the views of the
+blueprints. The logic is the same, only
+the database work is awaited on an AsyncSession and the password check is
+awaited on the hashing thread pool.
+'''
+
+def async_session():
+    return current_app.extensions['async_db']()
+
+
+async def index():
+    user = current_user
+    if user.is_authenticated:
+        scope, sources = f'feed:{user.id}', user.followed_timeline_sources()
+    else:
+        scope, sources = 'public', Post.timeline_sources()
+    before, after = request.args.get('before'), request.args.get('after')
+    per_page = current_app.config['POSTS_PER_PAGE']
+    async with async_session() as session:
+        try:
+            keys = await keyset_keys_async(session, sources, before, after,
+                                           per_page)
+        except ValueError:
+            abort(400)
+        validators = conditional.timeline_validators(scope, keys, before,
+                                                     after, per_page)
+        if validators is not None:
+            not_modified = validators.not_modified()
+            if not_modified is not None:
+                return not_modified
+        # Keyed by the posts the page holds, so that a fragment left behind
+        # by a missed expiration is never served for a page that changed.
+        key = fragment_cache.key(scope, before, after, per_page,
+                                 conditional.page_digest(keys, after, per_page))
+        posts = fragment_cache.get(key)
+        if posts is None:
+            page = await paginate_keyset_async(
+                session, sources, before=before, after=after,
+                per_page=per_page)
+            posts = render_template('_posts.html', page=page)
+            fragment_cache.set_page(scope, key, posts, page, before, after)
+    response = make_response(render_template('index.html', title='Home',
+                                             user=user, posts=Markup(posts)))
+    return validators.apply(response) if validators else response
+
+
+async def login():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = LoginForm()
+    if form.validate_on_submit():
+        async with async_session() as session:
+            user = await find_user_async(session,
+                                         username=form.username.data)
+            if user is None or not await passwords.verify_password_async(
+                    user.password_hash, form.password.data):
+                flash('Invalid username or password')
+                return redirect(url_for('auth.login'))
+            method = current_app.config['PASSWORD_HASH_METHOD']
+            if passwords.needs_rehash(user.password_hash, method):
+                pwhash = await passwords.hash_password_async(
+                    form.password.data, method,
+                    current_app.config['PASSWORD_SALT_LENGTH'])
+                if User.password_hash_fits(pwhash):
+                    user.password_hash = pwhash
+                    await session.commit()
+                else:
+                    passwords.warn_too_long(pwhash)
+        login_user(user, remember=form.remember_me.data)
+        return redirect(url_for('main.index'))
+    return render_template('login.html', title='Sign In', form=form)
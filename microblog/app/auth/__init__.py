@@ -0,0 +1,7 @@
+from flask import Blueprint
+
+bp = Blueprint('auth', __name__)
+
+from app.auth import routes
+
+# The auth blueprint holds the views that log users in and out.
@@ -1,8 +1,10 @@
-from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired
+from app.instrumentation import TimedForm
 
-class LoginForm(FlaskForm):
+# TimedForm is a FlaskForm that reports how long its validation takes when
+# the instrumentation is on (see app/instrumentation.py).
+class LoginForm(TimedForm):
     username = StringField('Username', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired()])
     remember_me = BooleanField('Remember Me')
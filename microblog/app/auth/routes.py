@@ -0,0 +1,99 @@
+from flask import render_template, flash, redirect, url_for, request
+from flask_login import current_user, login_user, logout_user
+from app import db, ratelimit
+from app.auth import bp
+from app.auth.forms import LoginForm
+from app.usercache import find_user
+
+@bp.before_request
+def throttle_login():
+    # Runs before the view, sync or async, so that throttled attempts never
+    # get to the database or to the password hash.
+    if request.endpoint == 'auth.login' and request.method == 'POST':
+        return ratelimit.check_login()
+
+@bp.route('/login', methods=['GET', 'POST'])
+def login():
+    '''
+    Here, we import the LoginForm class from the module forms.py. Then,
+    we instantiate a LoginForm object, and send it to the template.
+    
+    Note the methods argument in the route decorator: This tells Flask
+    that this view function accepts GET and POST requests, overriding the
+    default, which is to accept only GET requests.
+    
+    The HTTP protocol states that GET requests are those that return
+    information to the client. All the requests in the application so far
+    are of this type. POST requests are typically used when the browser
+    submits form data to the server.
+    
+    If the client attempts to submit a login request and the application was not
+    configured to accept it, we would get a "Method Not Allowed" error.
+    This is because we have no logic to process any data submitted by the user.
+    
+    The form.validate_on_submit() method does the form processing work.
+    When the browser sends the GET request to receive the web page with the
+    form, form.validate_on_submit() will return False. So in that case,
+    the function skips the if statement and goes directly to render the
+    template in the last line of the function:
+    
+        return render_template('login.html', title='Sign In', form=form)
+        
+    When the browser sends the POST request as a result of the user pressing
+    the submit button, form.validate_on_submit() will gather all the
+    data, and run all the validators attached to fields. If everything is all
+    right it will return True. This indicates that the data is valid and can
+    be processed by the application. If at least one field fails validation,
+    the function will return False, and that will cause the form to be
+    rendered back to the user, like in the GET request case.
+    
+    Later, we will add an error message when validation fails.
+    '''
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = LoginForm()
+    
+    if form.validate_on_submit():
+        user = find_user(username=form.username.data)
+        if user is None or not user.check_password(form.password.data):
+            flash('Invalid username or password')
+            return redirect(url_for('auth.login'))
+        # check_password() may have upgraded the stored hash to the current
+        # PASSWORD_HASH_METHOD, save it.
+        db.session.commit()
+        login_user(user, remember=form.remember_me.data)
+        '''
+        When form.validate_on_submit() returns True, the username is looked up
+        in the database and the password is checked against the stored hash.
+        If either of them is wrong, we flash() a message and send the user
+        back to the login form. The message is deliberately the same in both
+        cases, so that the form cannot be used to find out which usernames
+        exist.
+        
+        When we call the flash() functiono, Flask stores the message, but
+        flashed messages will not magically appear in web pages. The templates
+        oof the application neede to render these flashed messages in a way
+        that is conformant with the site layout.
+        
+        We will add these messages to the template base.html, so that all
+        templates will inherit this functionality.
+
+        When the credentials are good, login_user() from Flask-Login records
+        the user as logged in, so that current_user refers to them in all the
+        requests that follow.
+        '''
+        return redirect(url_for('main.index'))
+    '''
+    The second new function used in the login view is redirect(). This function
+    instructs the client web browser to automatically navigate to a different
+    page, given as an argument.
+    
+    This view function uses it to redirect the user to the index page of the
+    application.
+    '''
+    return render_template('login.html', title='Sign In', form=form)
+
+@bp.route('/logout')
+def logout():
+    logout_user()
+    return redirect(url_for('main.index'))
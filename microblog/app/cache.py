@@ -0,0 +1,426 @@
+import fnmatch
+import threading
+import time
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app.models import decode_cursor
+
+'''
+Caching of rendered timeline fragments
+
+Rendering the list of posts on the index page means running the timeline
+query and then running the posts through Jinja2. Both are wasted work when
+nothing was posted since the last time the same page was rendered, so the
+rendered HTML of each page is cached, keyed by the timeline it belongs to (the
+"scope": the public timeline, or one user's feed) and by its cursor.
+
+The cache is made of tiers that are tried in order. The first one is an LRU
+inside the worker process, which is as fast as a dictionary lookup but private
+to the process. The optional second one is shared by all the workers and
+speaks the Redis protocol. The LocalRedis class below implements the handful
+of Redis commands that are used here, so the shared tier can be exercised
+without a Redis server.
+
+Keyset pages have a useful property: a page only depends on the posts between
+its two boundary keys. A new post in the public timeline changes the first
+page, but "the 20 posts older than cursor X" stay exactly the same. So every
+cached fragment is registered in its scope together with the (timestamp, id)
+range it covers, and when a post is inserted or deleted only the fragments
+whose range contains that post are expired.
+
+The key of a fragment also holds a digest of the keys of the posts on the
+page (see app/conditional.py), read from the database on every request. A
+fragment that missed its expiration therefore cannot be served for a page
+whose posts have changed, it just sits unused until it is evicted.
+
+Expiring only reaches the in-process tier of the process that does it. The
+posts written by a web worker expire its own copies, but the fan-out of a
+post to the feeds of the followers runs in a "flask worker" process, whose
+in-process tier never holds any pages, so it only expires the shared tier.
+Without a shared tier, the copies kept by the other processes are only
+dropped by FRAGMENT_CACHE_LOCAL_TTL or by eviction. Thanks to the digest they
+are never served in the meantime, so the in-process tier on its own is safe
+with several processes, only less effective.
+'''
+
+
+class LRUCache(object):
+    '''
+    In-process cache with a maximum number of entries and a time to live.
+    When full, the least recently used entry is evicted.
+
+    The members of the indexes end with the key of the entry they stand
+    for, after a tab, and leave the indexes when that entry does.
+    '''
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._indexes = {}
+        # Key -> the (index name, member) pairs that stand for it.
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def _drop(self, key):
+        self._data.pop(key, None)
+        for name, member in self._members.pop(key, ()):
+            index = self._indexes.get(name)
+            if index is not None:
+                index.discard(member)
+                if not index:
+                    del self._indexes[name]
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                self._drop(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._drop(next(iter(self._data)))
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._indexes.clear()
+            self._members.clear()
+
+    def index_add(self, name, member):
+        key = member.rsplit('\t', 1)[-1]
+        with self._lock:
+            if key not in self._data:
+                return
+            self._indexes.setdefault(name, set()).add(member)
+            self._members.setdefault(key, set()).add((name, member))
+
+    def index_members(self, name):
+        with self._lock:
+            return set(self._indexes.get(name, ()))
+
+    def index_remove(self, name, *members):
+        with self._lock:
+            index = self._indexes.get(name, set())
+            index.difference_update(members)
+            if not index:
+                self._indexes.pop(name, None)
+            for member in members:
+                pairs = self._members.get(member.rsplit('\t', 1)[-1])
+                if pairs is not None:
+                    pairs.discard((name, member))
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(object):
+    '''
+    Shared cache tier on top of a Redis client (or anything that speaks the
+    same commands, such as LocalRedis). Values are stored as UTF-8 text.
+
+    All the keys start with prefix, so that the cache can share a Redis
+    database with other data. The indexes are sorted sets scored by the
+    time their members' entries expire, which are dropped from them as
+    they go, and the sets themselves expire with their last entry.
+    '''
+
+    def __init__(self, client, ttl=300, prefix='microblog:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, value.encode(), ex=ttl or None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        # Only our own keys, in batches, without blocking the server.
+        batch = []
+        for key in self.client.scan_iter(match=self.prefix + '*', count=1000):
+            batch.append(key)
+            if len(batch) == 1000:
+                self.client.unlink(*batch)
+                batch = []
+        if batch:
+            self.client.unlink(*batch)
+
+    def index_add(self, name, member):
+        key = self.prefix + 'index:' + name
+        now = time.time()
+        self.client.zadd(key, {member: now + self.ttl if self.ttl
+                               else float('inf')})
+        self.client.zremrangebyscore(key, '-inf', now)
+        if self.ttl:
+            self.client.expire(key, self.ttl)
+
+    def index_members(self, name):
+        members = self.client.zrangebyscore(self.prefix + 'index:' + name,
+                                            time.time(), '+inf')
+        return {member.decode() for member in members}
+
+    def index_remove(self, name, *members):
+        if members:
+            self.client.zrem(self.prefix + 'index:' + name, *members)
+
+
+class LocalRedis(object):
+    '''
+    A stand-in for a Redis server that lives in the current process. It only
+    implements the commands used by RedisCache, and is meant for tests and for
+    single process development servers.
+    '''
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, key):
+        value, expires = self._data[key]
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return True
+        return False
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data or self._expired(key):
+                return None
+            return self._data[key][0]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            expires = time.monotonic() + ex if ex else None
+            self._data[key] = (value, expires)
+        return True
+
+    def delete(self, *keys):
+        keys = [key.decode() if isinstance(key, bytes) else key for key in keys]
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def unlink(self, *keys):
+        return self.delete(*keys)
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if key not in self._data or self._expired(key):
+                return False
+            self._data[key] = (self._data[key][0],
+                               time.monotonic() + seconds)
+            return True
+
+    def scan_iter(self, match='*', count=None):
+        with self._lock:
+            keys = [key for key in self._data
+                    if fnmatch.fnmatchcase(key, match)]
+        return iter([key.encode() for key in keys])
+
+    def _zset(self, key, create=False):
+        if key not in self._data or self._expired(key):
+            if not create:
+                return {}
+            self._data[key] = ({}, None)
+        return self._data[key][0]
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            self._zset(key, create=True).update(
+                (m.encode() if isinstance(m, str) else m, float(score))
+                for m, score in mapping.items())
+
+    def zrangebyscore(self, key, min, max):
+        with self._lock:
+            low, high = float(min), float(max)
+            return [member for member, score in self._zset(key).items()
+                    if low <= score <= high]
+
+    def zremrangebyscore(self, key, min, max):
+        with self._lock:
+            low, high = float(min), float(max)
+            zset = self._zset(key)
+            for member in [member for member, score in zset.items()
+                           if low <= score <= high]:
+                del zset[member]
+
+    def zrem(self, key, *members):
+        with self._lock:
+            zset = self._zset(key)
+            for member in members:
+                zset.pop(member.encode() if isinstance(member, str)
+                         else member, None)
+
+
+def shared_tier(url, ttl):
+    if url == 'local://':
+        return RedisCache(LocalRedis(), ttl=ttl)
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError('CACHE_SHARED_URL is set, but the redis package '
+                           'is not installed')
+    return RedisCache(redis.Redis.from_url(url), ttl=ttl)
+
+
+class FragmentCache(object):
+    '''
+    Flask extension for the cache of rendered timeline pages. Each
+    application gets its own TieredCache, stored in app.extensions, and the
+    extension object forwards to the one of the current application:
+
+        fragment_cache = FragmentCache()
+        fragment_cache.init_app(app)
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        tiers = [LRUCache(app.config['FRAGMENT_CACHE_SIZE'],
+                          app.config['FRAGMENT_CACHE_LOCAL_TTL'])]
+        if app.config['CACHE_SHARED_URL']:
+            tiers.append(shared_tier(app.config['CACHE_SHARED_URL'],
+                                     app.config['FRAGMENT_CACHE_TTL']))
+        app.extensions['fragment_cache'] = TieredCache(
+            tiers, app.config['FRAGMENT_CACHE_ENABLED'])
+
+    def __getattr__(self, name):
+        return getattr(current_app.extensions['fragment_cache'], name)
+
+
+class TieredCache(object):
+    '''
+    A list of cache tiers, fastest first, holding rendered fragments and the
+    ranges they cover.
+    '''
+
+    def __init__(self, tiers, enabled=True):
+        self.tiers = tiers
+        self.enabled = enabled
+
+    @staticmethod
+    def key(scope, before=None, after=None, per_page=20, digest=''):
+        # digest is conditional.page_digest() of the posts on the page.
+        return f'fragment:{scope}:{per_page}:{before or ""}:{after or ""}' \
+            f':{digest}'
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                # Copy the value into the faster tiers that missed it.
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                return value
+        return None
+
+    def set(self, scope, key, value, low=None, high=None):
+        '''
+        Store a fragment. low and high are the cursors of the oldest and
+        newest post the fragment covers, None meaning that the range is open
+        on that side (the last page, or the first page).
+        '''
+        if not self.enabled:
+            return
+        member = f'{low or ""}\t{high or ""}\t{key}'
+        for tier in self.tiers:
+            tier.set(key, value)
+            tier.index_add(scope, member)
+
+    def set_page(self, scope, key, value, page, before=None, after=None):
+        # Work out the range covered by a TimelinePage from the cursors that
+        # were used to fetch it and the ones that it hands out.
+        if after:
+            low, high = after, page.prev_cursor
+        else:
+            low, high = page.next_cursor, before
+        self.set(scope, key, value, low, high)
+
+    def expire(self, scopes, timestamp, id, shared_only=False):
+        '''
+        Expire the fragments of the given scopes that cover the post with the
+        given key. With shared_only, the in-process tier is left alone.
+        '''
+        self.expire_range(scopes, (timestamp, id), (timestamp, id),
+                          shared_only)
+
+    def expire_range(self, scopes, first, last, shared_only=False):
+        '''
+        Expire the fragments of the given scopes whose range overlaps the
+        (timestamp, id) keys from first to last, such as the posts of a bulk
+        import.
+        '''
+        tiers = self.tiers[1:] if shared_only else self.tiers
+        for scope in scopes:
+            members = set()
+            for tier in tiers:
+                members |= tier.index_members(scope)
+            stale = []
+            for member in members:
+                low, high, key = member.split('\t', 2)
+                if low and last < decode_cursor(low):
+                    continue
+                if high and first > decode_cursor(high):
+                    continue
+                stale.append(member)
+            if stale:
+                keys = [member.split('\t', 2)[2] for member in stale]
+                for tier in tiers:
+                    tier.delete(*keys)
+                    tier.index_remove(scope, *stale)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    def expire_on_commit(self, session, scopes, timestamp, id,
+                         shared_only=False):
+        '''
+        Queue an expiration until the session commits. Expiring straight
+        away from the flush would let a concurrent request re-render and
+        cache the page before the new post is visible to it.
+        '''
+        session.info.setdefault('expired_fragments', []).append(
+            (self, scopes, timestamp, id, shared_only))
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_commit')
+def _expire_committed(session):
+    for cache, scopes, timestamp, id, shared_only in session.info.pop(
+            'expired_fragments', ()):
+        cache.expire(scopes, timestamp, id, shared_only)
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_soft_rollback')
+def _forget_rolled_back(session, previous_transaction):
+    session.info.pop('expired_fragments', None)
@@ -0,0 +1,168 @@
+import json
+
+import click
+from flask.cli import AppGroup, with_appcontext
+
+from app import db
+
+'''
+Command line commands
+
+Everything the flask command offers on top of what comes with Flask is
+registered here by register(), which is called from create_app().
+'''
+
+
+class MigrateCommand(click.Command):
+    '''
+    Stand-in for the flask db command group of Flask-Migrate. Importing
+    Flask-Migrate imports Alembic, which is not needed to serve requests, so
+    this command takes whatever arguments it is given, and only then loads
+    Flask-Migrate, initializes it and hands the arguments over to the real
+    db group.
+    '''
+
+    def __init__(self, app):
+        super().__init__('db', help='Perform database migrations.',
+                         add_help_option=False, context_settings={
+                             'ignore_unknown_options': True,
+                             'allow_extra_args': True})
+        self.app = app
+
+    def invoke(self, ctx):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as migrate_group
+        if 'migrate' not in self.app.extensions:
+            Migrate(self.app, db)
+        return migrate_group.main(args=ctx.args, prog_name=ctx.command_path,
+                                  obj=ctx.obj, standalone_mode=False)
+
+
+posts = AppGroup('posts', help='Manage posts.')
+
+
+@posts.command('import')
+@click.argument('source', type=click.File('rb'), default='-')
+@click.option('--chunk-size', type=int, default=None,
+              help='Posts per INSERT and per commit (IMPORT_CHUNK_SIZE).')
+def import_posts(source, chunk_size):
+    """Import posts from an NDJSON or JSON array file (- for stdin)."""
+    from app.ingest import import_posts
+    report = import_posts(source, chunk_size,
+                          progress=lambda report: click.echo(report, err=True))
+    for error in report.errors:
+        click.echo(f'record {error["record"]}: {error["error"]}', err=True)
+    click.echo(json.dumps(report.to_dict()))
+
+
+@posts.command('archive')
+@click.option('--batch-size', type=int, default=None,
+              help='Posts moved per transaction (ARCHIVE_BATCH_SIZE).')
+@click.option('--restore', is_flag=True, help='Move the archived posts that '
+              'are newer than the horizon back instead.')
+def archive_posts(batch_size, restore):
+    """Move the posts older than ARCHIVE_AFTER_DAYS to the archive."""
+    from app import archive
+    move = archive.restore_posts if restore else archive.archive_posts
+    moved = move(batch_size, progress=lambda moved: click.echo(
+        f'{moved} posts moved', err=True))
+    click.echo(json.dumps({'moved': moved}))
+
+
+@click.command('export')
+@click.argument('table', type=click.Choice(['users', 'posts']))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']),
+              default='ndjson')
+@click.option('--since', help='Watermark printed by a previous export of '
+              'posts, to only export the posts that came after it.')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output.')
+@click.option('-o', '--output', type=click.File('wb'), default='-')
+@with_appcontext
+def export(table, fmt, since, compress, output):
+    """Stream the users or posts table to a file (stdout by default)."""
+    from app import export as exporter
+    until = exporter.watermark() if table == 'posts' else None
+    try:
+        chunks = exporter.export(table, fmt, since, until, compress)
+    except ValueError:
+        raise click.BadParameter('not a valid watermark', param_hint='--since')
+    for chunk in chunks:
+        output.write(chunk)
+    output.flush()
+    if table == 'posts':
+        click.echo(f'watermark: {until or since or ""}', err=True)
+
+
+users = AppGroup('users', help='Manage users.')
+
+
+@users.command('reconcile-counters')
+@click.option('--batch-size', type=int, default=1000,
+              help='Users recounted per UPDATE and per commit.')
+def reconcile_counters(batch_size):
+    """Recount the post and follower counters of all the users."""
+    from app.models import reconcile_counters
+    checked, repaired = reconcile_counters(
+        batch_size, progress=lambda checked, repaired: click.echo(
+            f'{checked} users checked, {repaired} repaired', err=True))
+    click.echo(json.dumps({'checked': checked, 'repaired': repaired}))
+
+
+@click.command('worker')
+@click.option('-p', '--processes', type=int, default=None,
+              help='Worker processes (JOBS_WORKER_PROCESSES).')
+@click.option('--batch-size', type=int, default=None,
+              help='Jobs claimed at a time (JOBS_BATCH_SIZE).')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+@with_appcontext
+def worker(processes, batch_size, burst):
+    """Run the background jobs, see app/jobs.py."""
+    from flask import current_app
+    from app import jobs
+    totals = jobs.run_pool(
+        processes or current_app.config['JOBS_WORKER_PROCESSES'], batch_size,
+        burst=burst)
+    if totals is not None:
+        click.echo(json.dumps({'succeeded': totals[0], 'failed': totals[1]}))
+
+
+@click.command('trending')
+@click.option('--once', is_flag=True, help='Exit after the first snapshot.')
+@with_appcontext
+def trending(once):
+    """Count the trending terms and authors, see app/trending.py."""
+    import threading
+    from app import jobs, trending
+    stop = threading.Event()
+    with jobs.stop_on_signals(stop):
+        trending.run(stop, once=once)
+
+
+templates = AppGroup('templates', help='Manage the Jinja2 templates.')
+
+
+@templates.command('compile')
+@click.argument('target', required=False)
+@click.option('--zip', 'compression',
+              type=click.Choice(['deflated', 'stored']),
+              help='Write a zip file instead of a directory.')
+def compile_templates(target, compression):
+    """Precompile the templates to Python modules for TEMPLATE_MODULES."""
+    from flask import current_app
+    from app.templating import compile_templates
+    target = target or current_app.config['TEMPLATE_MODULES']
+    if not target:
+        raise click.UsageError('Give a target, or set TEMPLATE_MODULES.')
+    compile_templates(current_app, target, zip=compression,
+                      log_function=lambda message: click.echo(message,
+                                                              err=True))
+
+
+def register(app):
+    app.cli.add_command(MigrateCommand(app))
+    app.cli.add_command(posts)
+    app.cli.add_command(export)
+    app.cli.add_command(users)
+    app.cli.add_command(worker)
+    app.cli.add_command(trending)
+    app.cli.add_command(templates)
@@ -0,0 +1,102 @@
+import hashlib
+from datetime import timezone
+
+from flask import current_app, request, session, Response
+from werkzeug.http import http_date, is_resource_modified
+from flask_login import current_user
+
+from app.templating import templates_digest
+
+'''
+Conditional requests
+
+Clients that keep polling /index mostly get back the page they already have.
+To let them skip the download, the timeline pages carry an ETag and a
+Last-Modified header, and a request whose If-None-Match (or, without it,
+If-Modified-Since) still matches is answered with an empty 304.
+
+The validators have to be known before the page is rendered, so they are not
+a hash of the HTML. They are computed from what the HTML is made of: the
+(timestamp, id) keys of the posts on the page, read by the key-only versions
+of the timeline queries from the indexes alone, plus the timeline it belongs
+to and a digest of the templates. A new or deleted post on the page changes
+the keys, and with them the ETag. Last-Modified is the time of the newest
+post on the page and cannot see deletions, which is why If-None-Match wins
+when a request has both.
+
+The cached fragments of app/cache.py are keyed by the same keys, through
+page_digest(), so the HTML that goes out with an ETag is always the HTML of
+the posts that ETag was computed from, even when a fragment cached by this
+process was not expired by a post written in another one.
+
+Anonymous pages are the same for everyone, so they are marked public with a
+short s-maxage (TIMELINE_SHARED_MAX_AGE) that lets a reverse proxy serve them
+for a few seconds, and max-age=0 so that browsers revalidate every time.
+Pages of logged in users are private. A page with flashed messages waiting
+to be shown is a one-off, and gets neither.
+'''
+
+
+class Validators(object):
+    def __init__(self, etag, last_modified, public):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.public = public
+
+    def not_modified(self):
+        '''A 304 response if the request matches, else None.'''
+        if is_resource_modified(request.environ, etag=self.etag,
+                                last_modified=self.last_modified):
+            return None
+        return self.apply(Response(status=304))
+
+    def apply(self, response):
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.headers['Last-Modified'] = http_date(self.last_modified)
+        if self.public:
+            response.headers['Cache-Control'] = \
+                'public, max-age=0, s-maxage=' \
+                f'{current_app.config["TIMELINE_SHARED_MAX_AGE"]}'
+        else:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+def page_keys(results, after, per_page):
+    '''
+    The (timestamp, id) keys of a page, from the keyset_keys() of its
+    sources, in display order. They include one row more than the page,
+    which is the row that decides whether there is an "Older posts" link.
+    '''
+    return sorted({tuple(row) for result in results for row in result},
+                  reverse=not after)[:per_page + 1]
+
+
+def page_digest(results, after, per_page):
+    '''A digest of the page_keys(), for the key of a cached fragment.'''
+    sha = hashlib.sha256()
+    for timestamp, id in page_keys(results, after, per_page):
+        sha.update(f'|{timestamp.isoformat()},{id}'.encode())
+    return sha.hexdigest()[:32]
+
+
+def timeline_validators(scope, results, before, after, per_page):
+    '''
+    Return the Validators of a timeline page, from the keyset_keys() of its
+    sources, or None when the page should not be cached at all. The extra
+    row of the page_keys() is part of the ETag too.
+    '''
+    if '_flashes' in session:
+        return None
+    keys = page_keys(results, after, per_page)
+    sha = hashlib.sha256(
+        f'{templates_digest(current_app)}|{scope}|{per_page}|{before or ""}'
+        f'|{after or ""}'.encode())
+    for timestamp, id in keys:
+        sha.update(f'|{timestamp.isoformat()},{id}'.encode())
+    page = keys[:per_page]
+    last_modified = max(timestamp for timestamp, _ in page).replace(
+        tzinfo=timezone.utc) if page else None
+    return Validators(sha.hexdigest()[:32], last_modified,
+                      not current_user.is_authenticated)
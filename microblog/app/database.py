@@ -0,0 +1,119 @@
+import random
+import time
+
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+
+'''
+Engine set up
+
+Flask-SQLAlchemy creates the engines from the configuration, and this module
+adds what the configuration cannot express by itself.
+
+The first thing is the SQLite PRAGMA statements of the SQLITE_PRAGMAS
+configuration variable, which have to be issued on each new connection
+because most of them only apply to the connection they are run on.
+
+The second is read replicas. The SQLALCHEMY_REPLICA_URIS configuration
+variable lists copies of the database that the primary replicates to, and
+db.session is a RoutingSession that sends plain SELECT statements to one of
+them (the timelines, the profiles, the user lookups), while everything else
+goes to the primary. Replicas trail the primary by a little, so a session
+that has written something keeps reading from the primary, and so does the
+client that made the write, for REPLICA_LAG_TOLERANCE seconds after it. That
+way a user who just posted finds the post on the next page they load.
+
+Migrations and the async views only ever use the primary. For tests and
+development, copies of app.db can play the part of the replicas.
+'''
+
+
+def init_app(app):
+    with app.app_context():
+        from app import db
+        for engine in db.engines.values():
+            listen_for_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+    replicas = []
+    for uri in app.config['SQLALCHEMY_REPLICA_URIS']:
+        engine = sa.create_engine(uri,
+                                  **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        listen_for_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+        replicas.append(engine)
+    app.extensions['replicas'] = replicas
+
+
+def listen_for_pragmas(engine, pragmas):
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @sa.event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def replica_engines():
+    return current_app.extensions.get('replicas', [])
+
+
+def reading_own_writes():
+    '''
+    True when the client of the current request wrote to the database less
+    than REPLICA_LAG_TOLERANCE seconds ago.
+    '''
+    if not stateful_request():
+        return False
+    return session.get('primary_until', 0) > time.time()
+
+
+def stateful_request():
+    # Requests authenticated with an API token (see app/tokens.py) have no
+    # cookie session to keep the deadline in, and do not load it either.
+    return has_request_context() and 'token_user_id' not in g
+
+
+class RoutingSession(Session):
+    '''
+    Session that sends reads to a replica and writes to the primary. A
+    session sticks to the replica it picked first, so that all the queries
+    of a page see the same state of the database.
+    '''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                   **kwargs)
+        if bind is not None or primary is not self._db.engine:
+            # An explicit bind, or a model that lives in another database.
+            return primary
+        if self._flushing or self.info.get('wrote') or \
+                not isinstance(clause, sa.sql.expression.SelectBase):
+            return primary
+        replicas = replica_engines()
+        if not replicas or reading_own_writes():
+            return primary
+        if 'replica' not in self.info:
+            self.info['replica'] = random.randrange(len(replicas))
+        return replicas[self.info['replica']]
+
+
+@sa.event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['wrote'] = True
+
+
+@sa.event.listens_for(RoutingSession, 'do_orm_execute')
+def _executed(orm_execute_state):
+    # Statements passed to session.execute() that are not a SELECT, such as
+    # the insert from select of User.follow(), are writes as well.
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@sa.event.listens_for(RoutingSession, 'after_commit')
+def _committed(db_session):
+    if db_session.info.get('wrote') and stateful_request():
+        session['primary_until'] = \
+            time.time() + current_app.config['REPLICA_LAG_TOLERANCE']
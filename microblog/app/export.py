@@ -0,0 +1,197 @@
+import csv
+import io
+import json
+import zlib
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.models import User, Post, ArchivedPost, decode_cursor
+
+'''
+Streaming export of users and posts
+
+The export is a generator of byte chunks, so that the rows go out as they are
+read from the database instead of being collected first: the query runs with
+yield_per, which fetches the rows in batches (from a server-side cursor on
+databases that have them), every row is serialized as soon as it arrives, and
+the text is handed over, optionally gzip compressed, in chunks of about
+CHUNK_SIZE bytes. Memory use stays the same whatever the size of the table.
+
+Posts are exported in id order, and every export of posts comes with a
+watermark of the posts it includes. Passing that watermark to the next export
+makes it incremental, it then only includes the posts that were written
+after. The watermark is based on the ids rather than the timestamps, so posts
+imported with old timestamps (see app/ingest.py) are picked up by the next
+export too. It is looked up before the export starts, so posts written while
+it runs are left for the next one. Archived posts are exported along with the
+others.
+
+Ids are handed out when a post is inserted, not when it is committed. On
+SQLite, which has one writer at a time, that is the same order, but on
+PostgreSQL a transaction can take an id, and commit it after an export has
+read higher ones. So a watermark is the highest id, plus the ids within
+EXPORT_WATERMARK_WINDOW below it that no post had, such as '1234:1201-1203'.
+The next export includes the posts that have appeared under those ids since,
+and every post comes out exactly once, as long as a transaction does not
+commit after more than EXPORT_WATERMARK_WINDOW later ids were taken. Ids
+freed by deletions are carried along the same way, until they fall out of
+the window.
+
+Watermarks of older versions, which were (timestamp, id) cursors, are still
+accepted and stand for their id. The posts after that id that had older
+timestamps than the cursor may have been exported already, and come again.
+'''
+
+FORMATS = ('ndjson', 'csv')
+
+# Password hashes stay out of the export.
+COLUMNS = {
+    'users': (User.id, User.username, User.email),
+    'posts': (Post.id, Post.user_id, Post.timestamp, Post.body),
+}
+
+CHUNK_SIZE = 64 * 1024
+
+YIELD_PER = 1000
+
+
+def watermark():
+    '''Watermark of the posts there are now, or None when there are none.'''
+    ids = [db.session.scalar(sa.select(sa.func.max(model.id)))
+           for model in (Post, ArchivedPost)]
+    ids = [id for id in ids if id is not None]
+    if not ids:
+        return None
+    newest = max(ids)
+    low = max(0, newest - current_app.config['EXPORT_WATERMARK_WINDOW'])
+    present = set()
+    for model in (Post, ArchivedPost):
+        present.update(db.session.scalars(
+            sa.select(model.id).where(model.id > low, model.id < newest)))
+    gaps = [id for id in range(low + 1, newest) if id not in present]
+    return encode_watermark(newest, gaps)
+
+
+def encode_watermark(newest, gaps):
+    ranges = []
+    for id in gaps:
+        if ranges and ranges[-1][1] == id - 1:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    if not ranges:
+        return str(newest)
+    return f'{newest}:' + ','.join(
+        str(first) if first == last else f'{first}-{last}'
+        for first, last in ranges)
+
+
+def decode_watermark(watermark):
+    '''
+    The highest id of a watermark and the (first, last) ranges of the ids
+    below it that it leaves out. Anything that is not a watermark raises
+    ValueError.
+    '''
+    if watermark.isdigit():
+        return int(watermark), []
+    if ':' in watermark:
+        newest, _, parts = watermark.partition(':')
+        ranges = []
+        for part in parts.split(','):
+            first, _, last = part.partition('-')
+            ranges.append((int(first), int(last or first)))
+        return int(newest), ranges
+    # A (timestamp, id) cursor, from an older version.
+    return decode_cursor(watermark)[1], []
+
+
+def _in_ranges(column, ranges):
+    return sa.or_(sa.false(), *[column.between(first, last)
+                                for first, last in ranges])
+
+
+def select_rows(table, since=None, until=None):
+    columns = COLUMNS[table]
+    if table == 'users':
+        return sa.select(*columns).order_by(User.id)
+    # Posts come from the post table and from the archive (see
+    # app/archive.py), which has the same columns.
+    queries = []
+    for model in (Post, ArchivedPost):
+        query = sa.select(*[getattr(model, column.key) for column in columns])
+        if since:
+            newest, gaps = decode_watermark(since)
+            query = query.where(sa.or_(model.id > newest,
+                                       _in_ranges(model.id, gaps)))
+        if until:
+            newest, gaps = decode_watermark(until)
+            query = query.where(model.id <= newest,
+                                sa.not_(_in_ranges(model.id, gaps)))
+        queries.append(query)
+    posts = sa.union_all(*queries).subquery()
+    return sa.select(*[posts.c[column.key] for column in columns]) \
+        .order_by(posts.c.id)
+
+
+def _serialize(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _lines(table, rows, fmt):
+    names = [column.key for column in COLUMNS[table]]
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(dict(zip(names, map(_serialize, row))),
+                             ensure_ascii=False) + '\n'
+    else:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow(map(_serialize, row))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def export(table, fmt='ndjson', since=None, until=None, compress=False):
+    '''
+    Yield the rows of table ('users' or 'posts') as bytes, in fmt ('ndjson'
+    or 'csv'). For posts, since and until are watermarks that bound the
+    export, excluding since and including until.
+    '''
+    if table not in COLUMNS:
+        raise ValueError(f'Unknown table {table}')
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt}')
+    # Built here so that a bad watermark raises ValueError right away, the
+    # query itself only runs once the first chunk is asked for.
+    query = select_rows(table, since, until) \
+        .execution_options(yield_per=YIELD_PER)
+    return _stream(table, fmt, query, compress)
+
+
+def _stream(table, fmt, query, compress):
+    rows = db.session.execute(query)
+    encoder = zlib.compressobj(wbits=31) if compress else None
+    pending, size = [], 0
+    try:
+        for line in _lines(table, rows, fmt):
+            pending.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                chunk = ''.join(pending).encode()
+                pending, size = [], 0
+                if encoder is not None:
+                    chunk = encoder.compress(chunk)
+                if chunk:
+                    yield chunk
+    finally:
+        rows.close()
+    chunk = ''.join(pending).encode()
+    if encoder is not None:
+        chunk = encoder.compress(chunk) + encoder.flush()
+    if chunk:
+        yield chunk
@@ -0,0 +1,280 @@
+import codecs
+import json
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.models import User, Post, count_posts, fan_out_many, followers
+
+'''
+Bulk import of posts
+
+Posts coming from other systems are read as a stream of JSON objects, either
+one per line (NDJSON) or as the elements of one big JSON array, so that the
+input never has to fit in memory:
+
+    {"username": "susan", "body": "Hello!", "timestamp": "2023-06-01T12:00:00"}
+
+The timestamp is optional and defaults to the time of the import. Records are
+validated one by one and collected into chunks. Each chunk resolves the
+usernames it has not seen yet with a single query, goes into the post table
+as one executemany INSERT, gets fanned out to the feeds with two INSERT ...
+SELECT statements, and is committed. Going through the ORM instead costs an
+object, a flush and a fan-out per post.
+
+Bad records (missing fields, a body longer than the column, an unknown
+author) are skipped and reported, and the rest of the input is imported. A
+JSON array that is not well formed cannot be read past the error, so that
+stops the import, keeping the chunks committed so far.
+'''
+
+# Only the first errors are kept in the report.
+MAX_ERRORS = 100
+
+READ_SIZE = 64 * 1024
+
+# A JSON array element that is not complete after this many characters is
+# treated as malformed, instead of reading the rest of the input to find out.
+MAX_RECORD_SIZE = 1024 * 1024
+
+
+class ImportReport(object):
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def reject(self, number, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'record': number, 'error': reason})
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.inserted / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {'read': self.read, 'inserted': self.inserted,
+                'rejected': self.rejected, 'seconds': round(self.elapsed, 3),
+                'posts_per_second': round(self.rate, 1),
+                'errors': self.errors}
+
+    def __str__(self):
+        return (f'{self.read} read, {self.inserted} inserted, '
+                f'{self.rejected} rejected, {self.rate:.0f} posts/s')
+
+
+class MalformedInput(ValueError):
+    pass
+
+
+def _text_chunks(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = stream.read(READ_SIZE)
+        if not data:
+            break
+        if isinstance(data, str):
+            yield data
+        else:
+            yield decoder.decode(data)
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_records(stream):
+    '''
+    Yield the JSON values of an NDJSON or JSON array stream, binary or text,
+    as they are read. A line of NDJSON that does not parse is yielded as a
+    MalformedInput exception, so that the caller can report it and go on.
+    '''
+    chunks = _text_chunks(stream)
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+    head = head.lstrip()
+    if head.startswith('['):
+        return _iter_array(head[1:], chunks)
+    return _iter_lines(head, chunks)
+
+
+def _parse_line(line):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return MalformedInput(f'invalid JSON: {e}')
+
+
+def _iter_lines(buffer, chunks):
+    for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split('\n')
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+    for line in buffer.split('\n'):
+        if line.strip():
+            yield _parse_line(line)
+
+
+def _iter_array(buffer, chunks):
+    decoder = json.JSONDecoder()
+    pos = 0
+    expect_value = True
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos < len(buffer) and not expect_value:
+            if buffer[pos] != ',':
+                raise MalformedInput(f'expected "," in the JSON array, found '
+                                     f'{buffer[pos]!r}')
+            pos += 1
+            expect_value = True
+            continue
+        if pos < len(buffer):
+            try:
+                value, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Most likely the element goes on in the next chunk.
+                pass
+            else:
+                yield value
+                expect_value = False
+                continue
+        buffer = buffer[pos:]
+        pos = 0
+        if len(buffer) > MAX_RECORD_SIZE:
+            raise MalformedInput('invalid or oversized JSON array element')
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise MalformedInput('the JSON array is not terminated'
+                                 if not buffer else
+                                 'invalid JSON array element')
+        buffer += chunk
+
+
+def parse_timestamp(value):
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            timestamp = datetime.fromtimestamp(value, timezone.utc)
+        except (OverflowError, OSError):
+            raise ValueError(f'timestamp {value} is out of range')
+    elif isinstance(value, str):
+        timestamp = datetime.fromisoformat(value)
+    else:
+        raise ValueError('timestamp must be an ISO 8601 string or a number')
+    # Timestamps are stored as naive UTC, like Post.timestamp defaults to.
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def validate(record):
+    '''
+    Return (username, body, timestamp) for a valid record, or raise
+    ValueError saying what is wrong with it.
+    '''
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError('a record must be a JSON object')
+    username, body = record.get('username'), record.get('body')
+    if not isinstance(username, str) or not username:
+        raise ValueError('username is missing')
+    if not isinstance(body, str) or not body.strip():
+        raise ValueError('body is missing')
+    limit = Post.body.type.length
+    if len(body) > limit:
+        raise ValueError(f'body is {len(body)} characters long, the limit is '
+                         f'{limit}')
+    return username, body, parse_timestamp(record.get('timestamp'))
+
+
+def import_posts(stream, chunk_size=None, progress=None):
+    '''
+    Import the posts of stream, committing every chunk_size posts (the
+    IMPORT_CHUNK_SIZE configuration variable by default). progress, when
+    given, is called with the ImportReport after every chunk. Returns the
+    final ImportReport.
+    '''
+    chunk_size = chunk_size or current_app.config['IMPORT_CHUNK_SIZE']
+    report = ImportReport()
+    authors = {}
+    chunk = []
+    try:
+        for record in iter_records(stream):
+            report.read += 1
+            try:
+                chunk.append((report.read, *validate(record)))
+            except ValueError as e:
+                report.reject(report.read, str(e))
+                continue
+            if len(chunk) >= chunk_size:
+                _insert_chunk(chunk, authors, report)
+                chunk = []
+                if progress is not None:
+                    progress(report)
+    except MalformedInput as e:
+        report.reject(report.read + 1, str(e))
+    if chunk:
+        _insert_chunk(chunk, authors, report)
+        if progress is not None:
+            progress(report)
+    return report
+
+
+def _insert_chunk(chunk, authors, report):
+    unknown = {username for _, username, _, _ in chunk} - authors.keys()
+    if unknown:
+        authors.update({username: None for username in unknown})
+        authors.update(db.session.execute(
+            sa.select(User.username, User.id)
+            .where(User.username.in_(unknown))).all())
+    rows = []
+    for number, username, body, timestamp in chunk:
+        if authors[username] is None:
+            report.reject(number, f'unknown user {username!r}')
+            continue
+        rows.append({'body': body, 'user_id': authors[username],
+                     'timestamp': timestamp})
+    if not rows:
+        return
+    # A list of parameter sets makes this one executemany INSERT. The ORM is
+    # bypassed on purpose, so the fan-out and the post counters are done here
+    # for the whole chunk.
+    post_ids = db.session.scalars(
+        sa.insert(Post.__table__).returning(Post.__table__.c.id), rows).all()
+    fan_out_many(db.session.connection(), post_ids)
+    counts = Counter(row['user_id'] for row in rows)
+    count_posts(db.session.connection(), counts)
+    cache = current_app.extensions['fragment_cache']
+    if cache.enabled:
+        # The cached pages are expired once for the whole chunk: the public
+        # timeline and the feeds of the authors and of their followers,
+        # over the range of keys the chunk spans.
+        readers = db.session.scalars(
+            sa.select(followers.c.follower_id).distinct()
+            .where(followers.c.followed_id.in_(counts))).all()
+        scopes = ['public'] + [f'feed:{id}' for id in {*counts, *readers}]
+        timestamps = [row['timestamp'] for row in rows]
+    db.session.commit()
+    if cache.enabled:
+        cache.expire_range(scopes, (min(timestamps), min(post_ids)),
+                           (max(timestamps), max(post_ids)))
+    report.inserted += len(rows)
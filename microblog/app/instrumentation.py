@@ -0,0 +1,293 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from flask import g, request, has_app_context, Response, \
+    before_render_template, template_rendered
+from flask_wtf import FlaskForm
+
+'''
+Request instrumentation
+
+When the INSTRUMENTATION configuration variable is set, every request keeps
+track of where its time goes: the SQL statements it runs (how many, and how
+long they take), the templates it renders and the forms it validates. The
+numbers are sent back to the client in a Server-Timing header, which the
+developer tools of the browsers display next to the request, and they are
+added up per endpoint for the Prometheus-style /metrics endpoint. The totals
+belong to the worker process that serves /metrics, so with several workers
+each one has to be scraped on its own.
+
+On top of that, PROFILE_SLOW_REQUESTS turns on a sampling profiler. A
+background thread looks at the stack of every thread that is handling a
+request every PROFILE_INTERVAL seconds, and when a request takes longer than
+PROFILE_SLOW_REQUESTS seconds its samples are written to PROFILE_DIR in the
+"folded" format, one stack per line followed by its sample count, which
+flamegraph.pl and speedscope turn into a flame graph.
+
+When INSTRUMENTATION is not set, none of this is installed and the timers
+below do nothing.
+'''
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           float('inf'))
+
+
+class RequestMetrics(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timers = defaultdict(float)
+        self.queries = 0
+        self.template_started = None
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        parts = [f'app;dur={self.elapsed * 1000:.1f}',
+                 f'db;dur={self.timers["db"] * 1000:.1f};'
+                 f'desc="{self.queries} queries"']
+        for name in ('template', 'form'):
+            if name in self.timers:
+                parts.append(f'{name};dur={self.timers[name] * 1000:.1f}')
+        return ', '.join(parts)
+
+
+@contextmanager
+def timer(name):
+    '''Add the time spent in the with block to the timer called name.'''
+    metrics = g.get('metrics') if has_app_context() else None
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timers[name] += time.perf_counter() - started
+
+
+class TimedForm(FlaskForm):
+    '''Base class for the forms whose validation is timed.'''
+
+    def validate(self, extra_validators=None):
+        with timer('form'):
+            return super().validate(extra_validators=extra_validators)
+
+
+class Registry(object):
+    '''
+    Totals per endpoint, rendered in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.histograms = defaultdict(lambda: [0] * len(BUCKETS))
+        self.sums = Counter()
+        self.seconds = Counter()
+        self.queries = Counter()
+
+    def record(self, endpoint, method, status, metrics):
+        elapsed = metrics.elapsed
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            buckets = self.histograms[endpoint]
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    buckets[i] += 1
+            self.sums[endpoint] += elapsed
+            self.queries[endpoint] += metrics.queries
+            for name, seconds in metrics.timers.items():
+                self.seconds[(endpoint, name)] += seconds
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += ['# TYPE microblog_requests_total counter']
+            for (endpoint, method, status), n in \
+                    sorted(self.requests.items()):
+                lines.append('microblog_requests_total'
+                             f'{{endpoint="{endpoint}",method="{method}",'
+                             f'status="{status}"}} {n}')
+            lines += ['# TYPE microblog_request_duration_seconds histogram']
+            for endpoint, buckets in sorted(self.histograms.items()):
+                for bound, n in zip(BUCKETS, buckets):
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append('microblog_request_duration_seconds_bucket'
+                                 f'{{endpoint="{endpoint}",le="{le}"}} {n}')
+                lines.append('microblog_request_duration_seconds_sum'
+                             f'{{endpoint="{endpoint}"}} '
+                             f'{self.sums[endpoint]:.6f}')
+                lines.append('microblog_request_duration_seconds_count'
+                             f'{{endpoint="{endpoint}"}} {buckets[-1]}')
+            lines += ['# TYPE microblog_sql_queries_total counter']
+            for endpoint, n in sorted(self.queries.items()):
+                lines.append('microblog_sql_queries_total'
+                             f'{{endpoint="{endpoint}"}} {n}')
+            lines += ['# TYPE microblog_time_seconds_total counter']
+            for (endpoint, name), seconds in sorted(self.seconds.items()):
+                lines.append('microblog_time_seconds_total'
+                             f'{{endpoint="{endpoint}",part="{name}"}} '
+                             f'{seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+class Sampler(object):
+    '''
+    Sampling profiler for the threads that have called start(). Samples are
+    counted per distinct stack, in the folded format of flamegraph.pl.
+    '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='sampling-profiler')
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[folded_stack(frame)] += 1
+
+
+def folded_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} '
+                     f'({os.path.basename(code.co_filename)}:'
+                     f'{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def write_profile(directory, endpoint, elapsed, samples):
+    os.makedirs(directory, exist_ok=True)
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-' \
+           f'{elapsed * 1000:.0f}ms.folded'
+    with open(os.path.join(directory, name), 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f'{stack} {count}\n')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_app_context() and 'metrics' in g:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _query_finished(info):
+    # The start time is popped whether or not the request is still being
+    # measured, so that none are left behind on the pooled connection.
+    started = info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if has_app_context() and 'metrics' in g:
+        g.metrics.queries += 1
+        g.metrics.timers['db'] += elapsed
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _query_finished(conn.info)
+
+
+def _handle_error(context):
+    # A statement that fails never gets to after_cursor_execute. It is
+    # counted all the same, with the time it took to fail.
+    if context.connection is not None:
+        _query_finished(context.connection.info)
+
+
+def _template_started(sender, template, context, **extra):
+    if 'metrics' in g:
+        g.metrics.template_started = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    metrics = g.get('metrics')
+    if metrics is not None and metrics.template_started is not None:
+        started = metrics.template_started
+        g.metrics.timers['template'] += time.perf_counter() - started
+        g.metrics.template_started = None
+
+
+def init_app(app):
+    if not app.config['INSTRUMENTATION']:
+        return
+    from app import db
+    from app.database import replica_engines
+    with app.app_context():
+        for engine in [*db.engines.values(), *replica_engines()]:
+            sa.event.listen(engine, 'before_cursor_execute',
+                            _before_cursor_execute)
+            sa.event.listen(engine, 'after_cursor_execute',
+                            _after_cursor_execute)
+            sa.event.listen(engine, 'handle_error', _handle_error)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
+
+    registry = Registry()
+    app.extensions['metrics'] = registry
+    sampler = None
+    if app.config['PROFILE_SLOW_REQUESTS']:
+        sampler = Sampler(app.config['PROFILE_INTERVAL'])
+
+    @app.before_request
+    def start_request():
+        g.metrics = RequestMetrics()
+        if sampler is not None:
+            sampler.start()
+
+    @app.after_request
+    def finish_request(response):
+        metrics = g.pop('metrics', None)
+        if metrics is None:
+            return response
+        endpoint = request.endpoint or 'none'
+        response.headers['Server-Timing'] = metrics.server_timing()
+        registry.record(endpoint, request.method, response.status_code,
+                        metrics)
+        if sampler is not None:
+            samples = sampler.stop()
+            if metrics.elapsed > app.config['PROFILE_SLOW_REQUESTS'] and \
+                    samples:
+                write_profile(app.config['PROFILE_DIR'], endpoint,
+                              metrics.elapsed, samples)
+        return response
+
+    @app.teardown_request
+    def forget_request(exc):
+        # Requests that failed never reached after_request.
+        if sampler is not None:
+            sampler.stop()
+
+    def metrics_view():
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,250 @@
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+
+from app import db
+
+'''
+Background jobs
+
+Work that follows a write but does not have to be finished before the
+response goes out, such as copying a new post into the feeds of thousands of
+followers, is queued as a job and done by "flask worker" processes.
+
+The queue is the job table of the application database, so it needs no
+broker. A job is inserted in the same transaction as the write that calls for
+it, and therefore exists if and only if that write was committed. Workers
+claim jobs in batches with a single UPDATE that marks them as running and
+leases them for JOBS_LEASE seconds; a job whose worker died is claimed again
+once its lease runs out. Each job then runs in its own transaction, which
+also deletes the job row, so its effects and its removal from the queue are
+committed together. A job that raises is put back in the queue with an
+exponential backoff, and after JOBS_MAX_ATTEMPTS attempts it stays in the
+table with status 'failed' and the error that killed it.
+
+A job that lost its lease while still running can end up running twice, so
+tasks have to be safe to repeat.
+
+With JOBS_INLINE set, as in the testing profile, jobs are not queued but run
+right before the session that queued them commits, in the same transaction.
+'''
+
+TASKS = {}
+
+
+def task(name):
+    '''Register the decorated function as the task called name.'''
+    def decorator(f):
+        TASKS[name] = f
+        return f
+    return decorator
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    # The keyword arguments of the task, as JSON.
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    # 'queued', 'running' or 'failed'. Finished jobs are deleted.
+    status = db.Column(db.String(16), nullable=False, default='queued',
+                       server_default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0,
+                         server_default='0')
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status}>'
+
+
+def enqueue(name, payload=None, session=None, connection=None, delay=0):
+    '''
+    Queue a run of the task called name, with payload as its keyword
+    arguments. The job row goes through connection when one is given, which
+    is how mapper events queue jobs from inside a flush, or else through
+    session (db.session by default). Either way it is committed or rolled
+    back together with the rest of the transaction.
+    '''
+    if name not in TASKS:
+        raise KeyError(f'unknown task {name!r}')
+    payload = payload or {}
+    session = session if session is not None else db.session
+    if has_app_context() and current_app.config['JOBS_INLINE']:
+        session.info.setdefault('inline_jobs', []).append((name, payload))
+        return
+    statement = sa.insert(Job.__table__).values(
+        name=name, payload=json.dumps(payload),
+        run_at=datetime.utcnow() + timedelta(seconds=delay))
+    (connection if connection is not None else session).execute(statement)
+
+
+@sa.event.listens_for(sa.orm.Session, 'before_commit')
+def _run_inline_jobs(session):
+    if not has_app_context() or not current_app.config['JOBS_INLINE']:
+        return
+    # Flush first, so that the mapper events of pending objects get to add
+    # their jobs, and again after each job for the jobs it adds itself.
+    session.flush()
+    while session.info.get('inline_jobs'):
+        name, payload = session.info['inline_jobs'].pop(0)
+        TASKS[name](**payload)
+        session.flush()
+
+
+@sa.event.listens_for(sa.orm.Session, 'after_soft_rollback')
+def _forget_inline_jobs(session, previous_transaction):
+    session.info.pop('inline_jobs', None)
+
+
+def claim(worker, batch_size):
+    '''
+    Lease up to batch_size jobs that are due to worker, oldest first, and
+    return them as (id, name, payload, attempts) rows. On PostgreSQL the
+    rows other workers are claiming at the same moment are skipped instead
+    of waited for. SQLite lets one writer in at a time, which serializes the
+    claims by itself.
+    '''
+    now = datetime.utcnow()
+    table = Job.__table__
+    due = sa.select(table.c.id).where(sa.or_(
+        sa.and_(table.c.status == 'queued', table.c.run_at <= now),
+        sa.and_(table.c.status == 'running', table.c.locked_until < now)
+    )).order_by(table.c.run_at).limit(batch_size) \
+        .with_for_update(skip_locked=True)
+    rows = db.session.execute(
+        sa.update(table).where(table.c.id.in_(due)).values(
+            status='running', locked_by=worker, attempts=table.c.attempts + 1,
+            locked_until=now + timedelta(
+                seconds=current_app.config['JOBS_LEASE']))
+        .returning(table.c.id, table.c.name, table.c.payload,
+                   table.c.attempts)).all()
+    db.session.commit()
+    return rows
+
+
+def backoff(attempts):
+    '''Seconds to wait before attempt number attempts + 1, with jitter.'''
+    delay = current_app.config['JOBS_RETRY_DELAY'] * 2 ** (attempts - 1)
+    return min(delay, current_app.config['JOBS_RETRY_MAX_DELAY']) * \
+        random.uniform(0.5, 1)
+
+
+def run(job, worker):
+    '''Run a claimed job. Return True if it succeeded.'''
+    table = Job.__table__
+    mine = sa.and_(table.c.id == job.id, table.c.locked_by == worker)
+    try:
+        TASKS[job.name](**json.loads(job.payload))
+        db.session.execute(sa.delete(table).where(mine))
+        db.session.commit()
+        return True
+    except Exception as exc:
+        db.session.rollback()
+        current_app.logger.exception('Job %s (%s) failed, attempt %s',
+                                     job.id, job.name, job.attempts)
+        failed = job.attempts >= current_app.config['JOBS_MAX_ATTEMPTS']
+        db.session.execute(sa.update(table).where(mine).values(
+            status='failed' if failed else 'queued',
+            run_at=datetime.utcnow() + timedelta(
+                seconds=backoff(job.attempts)),
+            locked_by=None, locked_until=None,
+            last_error=f'{type(exc).__name__}: {exc}'))
+        db.session.commit()
+        return False
+
+
+def work(batch_size=None, poll_interval=None, burst=False, stop=None):
+    '''
+    Claim and run jobs until stop (a threading or multiprocessing Event) is
+    set, or with burst until the queue is empty. The batch at hand is always
+    finished before stopping. Return (succeeded, failed).
+    '''
+    batch_size = batch_size or current_app.config['JOBS_BATCH_SIZE']
+    poll_interval = poll_interval or current_app.config['JOBS_POLL_INTERVAL']
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    # Jobs are about writes that were just committed, which the replicas
+    # may not have yet, so the worker reads from the primary.
+    db.session.info['wrote'] = True
+    succeeded = failed = 0
+    while stop is None or not stop.is_set():
+        jobs = claim(worker, batch_size)
+        if not jobs:
+            if burst:
+                break
+            if stop is not None:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+        for job in jobs:
+            if run(job, worker):
+                succeeded += 1
+            else:
+                failed += 1
+    return succeeded, failed
+
+
+def _worker_process(stop, batch_size, poll_interval, burst):
+    # Ctrl+C reaches the whole process group; the parent handles it by
+    # setting stop, and so does a SIGTERM sent to a worker directly.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        succeeded, failed = work(batch_size, poll_interval, burst, stop)
+        app.logger.info('Worker %s done: %s jobs succeeded, %s failed',
+                        os.getpid(), succeeded, failed)
+
+
+def run_pool(processes, batch_size=None, poll_interval=None, burst=False):
+    '''
+    Run processes worker processes until SIGINT or SIGTERM. The processes
+    are started fresh (spawned, not forked) and each creates its own
+    application, with the configuration picked by MICROBLOG_CONFIG, so that
+    no database connection is shared between them. A single worker runs in
+    the current process instead, and returns (succeeded, failed).
+    '''
+    if processes == 1:
+        stop = threading.Event()
+        with stop_on_signals(stop):
+            return work(batch_size, poll_interval, burst, stop)
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    pool = [context.Process(target=_worker_process, name=f'worker-{i}',
+                            args=(stop, batch_size, poll_interval, burst))
+            for i in range(processes)]
+    with stop_on_signals(stop):
+        for process in pool:
+            process.start()
+        for process in pool:
+            process.join()
+    return None
+
+
+@contextmanager
+def stop_on_signals(stop):
+    '''Set stop on SIGINT and SIGTERM inside the with block.'''
+    previous = {signum: signal.signal(signum,
+                                      lambda signum, frame: stop.set())
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
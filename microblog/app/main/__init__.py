@@ -0,0 +1,11 @@
+from flask import Blueprint
+
+bp = Blueprint('main', __name__)
+
+from app.main import routes
+
+# A blueprint is a group of views (plus their templates, static files and
+# error handlers) that is defined on its own and attached to an application
+# later with app.register_blueprint(). This is what allows create_app() in
+# app/__init__.py to build as many application instances as it likes: the
+# views are no longer tied to one global app object.
@@ -0,0 +1,160 @@
+from flask import render_template, request, abort, current_app, \
+    make_response
+from flask_login import current_user
+from markupsafe import Markup
+from app import conditional, fragment_cache
+from app.main import bp
+from app.models import Post, keyset_keys, paginate_keyset, query_budget
+from app.search import search_posts
+from app.usercache import find_user
+from app import trending as trends
+
+@bp.route('/')
+@bp.route('/index')
+@query_budget()
+def index():
+    # Logged in users get their home timeline (their own posts and the posts
+    # of the people they follow), everybody else gets the public one.
+    user = current_user
+    if user.is_authenticated:
+        scope, sources = f'feed:{user.id}', user.followed_timeline_sources()
+    else:
+        scope, sources = 'public', Post.timeline_sources()
+    before, after = request.args.get('before'), request.args.get('after')
+    per_page = current_app.config['POSTS_PER_PAGE']
+    try:
+        # Which posts the page holds, read from the indexes only. When the
+        # client has this exact page already, that is all the work we do.
+        keys = keyset_keys(sources, before, after, per_page)
+    except ValueError:
+        # The cursor was tampered with or truncated.
+        abort(400)
+    validators = conditional.timeline_validators(scope, keys, before, after,
+                                                 per_page)
+    if validators is not None:
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+    # Keyed by the posts the page holds, so that a fragment left behind
+    # by a missed expiration is never served for a page that changed.
+    key = fragment_cache.key(scope, before, after, per_page,
+                             conditional.page_digest(keys, after, per_page))
+    posts = fragment_cache.get(key)
+    if posts is None:
+        page = paginate_keyset(sources, before=before, after=after,
+                               per_page=per_page)
+        posts = render_template('_posts.html', page=page)
+        fragment_cache.set_page(scope, key, posts, page, before, after)
+    # We can now simplify the view function, as the presentation of the page
+    # has been offloaded to the HTML template. Note the structure of this
+    # function: the first argument is the template name, index.html.
+    # the second and third arguments are required to fill in the 
+    # variables called out in the HTML file index.html.
+    # The render_template() function invokes the Jinja2 template
+    # engine that comes bundled with the Flask framework.
+    # Jinja2 substitutes {{ ... }} 
+    response = make_response(render_template('index.html', title='Home',
+                                             user=user, posts=Markup(posts)))
+    return validators.apply(response) if validators else response
+
+@bp.route('/user/<username>')
+@query_budget()
+def user(username):
+    # The numbers at the top of the profile come from the counter columns of
+    # the user, so the whole page is the user query plus one page of posts.
+    user = find_user(username=username)
+    if user is None:
+        abort(404)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    try:
+        page = user.posts_timeline(before=request.args.get('before'),
+                                   after=request.args.get('after'),
+                                   per_page=per_page)
+    except ValueError:
+        abort(400)
+    return render_template('user.html', title=user.username, user=user,
+                           page=page)
+
+@bp.route('/search')
+@query_budget()
+def search():
+    # Results are ranked rather than sorted by time, so they are paginated
+    # with page numbers instead of timeline cursors.
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(404)
+    results = None
+    if query:
+        results = search_posts(query, page,
+                               current_app.config['POSTS_PER_PAGE'])
+    return render_template('search.html', title='Search', query=query,
+                           results=results)
+
+@bp.route('/trending')
+@query_budget()
+def trending():
+    # The counting is done by "flask trending", which saves the top terms
+    # and authors of each window, so the page is a single query.
+    windows = [name for name, seconds, buckets
+               in current_app.config['TRENDING_WINDOWS']]
+    window = request.args.get('window', windows[0])
+    if window not in windows:
+        abort(404)
+    return render_template('trending.html', title='Trending', window=window,
+                           windows=windows, trends=trends.top(window))
+
+# Chapter 1:
+# The @app.route decorator (@bp.route now that the views live in
+# blueprints) creates an association between the URL
+# given as an argument and the function.
+
+# The two decorators associate the URLs '/' and '/index' to this
+# function. What does this mean? When a web browser requests either
+# of these two URLs, Flask is going to invoke index() and pass
+# the return value of it back to the browser as a response.
+
+# To complete the application we need to have a Python script at the
+# top-level that defines the Flask application instance.
+# We will call the script microblog.py, and define it as a single
+# line that imports the application instance.
+
+# From Chapter 2:
+# Note that you can return raw HTML to the view, but this is not
+# considered sustainable or good practice.
+
+# If we can keep the logic of the application separate from the layout
+# or presentation of the web pages, this will be far better. It also
+# separates the front-end development and the back-end development
+# a bit more.
+
+# Templates help achieve this separation between the view logic and
+# the business logic. In Flask, templates are written as separate files,
+# stored in a templates folder that is inside the application package.
+
+'''
+Chapter 3: Generating Links
+
+One problem with writing links directly in templates and source files, is that
+if the links are reorganized or renamed, then we will have to search and
+replace those links in the entire application.
+
+To have better control over these links, Flask provides a function called
+url_for(). This function, url_for(), generates URLs using its internal mapping
+of URLs to view functions.
+
+For example, the expression url_for('login') returns /login, and
+url_for('index') returns /index. The argument to url_for() is the endpoint name,
+WHICH IS THE NAME OF THE VIEW FUNCTION. Take note of this! The endpoint name 
+is the same as the view function name!
+
+Why is it better to use the function names instead of URLs? The fact is that
+URLs are much more likely to change than view function names. The secondary
+and more important reason is that, as we will learn later, some URLs have
+dynamic components in them, so generating those URLs by hand would require
+concatenating multiple elements, which is tedious and error prone. url_for()
+is also able to generate these complex URLs.
+
+From now on, we will use url_for() every time we need to generate an application
+URL. We make changes to the base.html template and the routes.py script.
+'''
\ No newline at end of file
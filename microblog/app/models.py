@@ -1,5 +1,14 @@
-from datetime import datetime
-from app import db
+import base64
+import warnings
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context
+from flask_login import UserMixin
+from app import db, jobs, login, passwords
+from app.database import replica_engines
 
 r'''
 The model class created in the previous section defines the initial database
@@ -137,15 +146,160 @@ downgrade the database, delete the migration script, and then generate a new
 one to replace it.
 '''
 
-class User(db.Model):
+followers = db.Table(
+    'followers',
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Index('ix_followers_followed_id', 'followed_id'),
+)
+'''
+The followers association table records who follows whom. It is not declared
+as a model class because it only holds the two foreign keys. The primary key
+(follower_id, followed_id) answers "who do I follow?", and the extra index on
+followed_id answers "who follows this author?", which is the question asked
+every time a post is fanned out to its author's followers.
+'''
+
+class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
+    # Set once an author has more followers than FEED_FANOUT_LIMIT. Their
+    # posts are then pulled into timelines at read time instead of being
+    # copied into every follower's feed.
+    fanout_on_read = db.Column(db.Boolean, nullable=False, default=False,
+                               server_default=sa.false())
+    # Denormalized counts, so that showing them does not need a COUNT(*)
+    # over the post or followers tables. They are kept up to date in the
+    # same transaction as the rows they count, see "Counters" below.
+    post_count = db.Column(db.Integer, nullable=False, default=0,
+                           server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0,
+                               server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0,
+                               server_default='0')
+    followed = db.relationship(
+        'User', secondary=followers,
+        primaryjoin=(followers.c.follower_id == id),
+        secondaryjoin=(followers.c.followed_id == id),
+        backref=db.backref('followers', lazy='dynamic'), lazy='dynamic')
     
     def __repr__(self):
         return f'<User {self.username}>'
+
+    @staticmethod
+    def password_hash_fits(pwhash):
+        return len(pwhash) <= User.password_hash.type.length
+
+    def set_password(self, password):
+        pwhash = passwords.hash_password(
+            password, current_app.config['PASSWORD_HASH_METHOD'],
+            current_app.config['PASSWORD_SALT_LENGTH'])
+        if not User.password_hash_fits(pwhash):
+            raise ValueError(f'{len(pwhash)} character password hash does '
+                             'not fit in the password_hash column')
+        self.password_hash = pwhash
+
+    def check_password(self, password):
+        '''
+        Verify a password against the stored hash. When it matches but the
+        hash was made with a different method or cost than the one currently
+        configured, the hash is replaced with a fresh one, and the caller is
+        expected to commit the session. A fresh hash too long for the column
+        is not stored, and the user keeps logging in with the old one.
+        '''
+        if not passwords.verify_password(self.password_hash, password):
+            return False
+        method = current_app.config['PASSWORD_HASH_METHOD']
+        if passwords.needs_rehash(self.password_hash, method):
+            pwhash = passwords.hash_password(
+                password, method, current_app.config['PASSWORD_SALT_LENGTH'])
+            if User.password_hash_fits(pwhash):
+                self.password_hash = pwhash
+            else:
+                passwords.warn_too_long(pwhash)
+        return True
+
+    def is_following(self, user):
+        return self.followed.filter(
+            followers.c.followed_id == user.id).count() > 0
+
+    def follow(self, user):
+        '''
+        Follow user, and copy their most recent posts into our feed so the
+        timeline does not start out empty. Users that are already read on
+        demand are not copied, the timeline query picks them up by itself.
+        '''
+        if self.is_following(user):
+            return
+        self.followed.append(user)
+        self._count_follow(user, 1)
+        limit = current_app.config['FEED_FANOUT_LIMIT']
+        if not user.fanout_on_read and user.follower_count > limit:
+            # Once flipped, an author stays on fan-out-on-read, so that
+            # hovering around the limit does not leave holes in feeds.
+            user.fanout_on_read = True
+        if not user.fanout_on_read:
+            recent = sa.select(sa.literal(self.id), Post.timestamp, Post.id) \
+                .where(Post.user_id == user.id) \
+                .order_by(Post.timestamp.desc(), Post.id.desc()) \
+                .limit(current_app.config['FEED_BACKFILL'])
+            db.session.execute(sa.insert(FeedEntry).from_select(
+                ['user_id', 'timestamp', 'post_id'], recent))
+
+    def unfollow(self, user):
+        if not self.is_following(user):
+            return
+        self.followed.remove(user)
+        self._count_follow(user, -1)
+        for post, entry in ((Post, FeedEntry),
+                            (ArchivedPost, ArchivedFeedEntry)):
+            db.session.execute(sa.delete(entry).where(
+                entry.user_id == self.id,
+                entry.post_id.in_(
+                    sa.select(post.id).where(post.user_id == user.id))))
+
+    def _count_follow(self, user, delta):
+        # The counters are incremented in the database rather than in
+        # Python, so that two concurrent follows cannot overwrite each other.
+        # Executing the UPDATE flushes the follow first, and the ORM applies
+        # the same change to the User objects it has in memory.
+        db.session.execute(sa.update(User).where(User.id == self.id)
+                           .values(followed_count=User.followed_count + delta))
+        db.session.execute(sa.update(User).where(User.id == user.id)
+                           .values(follower_count=User.follower_count + delta))
+
+    def posts_timeline(self, before=None, after=None, per_page=20):
+        '''
+        Return one page of the posts written by this user, newest first,
+        read from the ix_post_user_id_timestamp_id index.
+        '''
+        return paginate_keyset(self.posts_timeline_sources(), before=before,
+                               after=after, per_page=per_page)
+
+    def posts_timeline_sources(self):
+        return author_sources(self.id)
+
+    def followed_timeline(self, before=None, after=None, per_page=20):
+        '''
+        Return one page of the home timeline: our own posts plus the posts of
+        everyone we follow.
+
+        Most of it is a range scan over this user's rows in feed_entry, which
+        were written when the posts were created. The posts of followed
+        authors that are too popular to be fanned out are seeked with the
+        same cursor straight from the post table, and both sources are
+        merged into a single page.
+        '''
+        return paginate_keyset(self.followed_timeline_sources(),
+                               before=before, after=after, per_page=per_page)
+
+    def followed_timeline_sources(self):
+        return feed_sources(self.id)
     
     r'''
     The User class has a new posts field, that is initialized with
@@ -253,6 +407,10 @@ class Post(db.Model):
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
     '''
     The user_id field was initialized as a foreign key to user.id, which means
     that it references an id value from the users table
@@ -268,5 +426,629 @@ class Post(db.Model):
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
-    
-    
\ No newline at end of file
+
+    @classmethod
+    def timeline(cls, before=None, after=None, per_page=20):
+        '''
+        Return one page of the public timeline, newest posts first.
+
+        The page is located with a keyset (or "seek") instead of an OFFSET:
+        the before/after cursors carry the (timestamp, id) of the last row
+        the client saw, and the query asks the ix_post_timestamp_id index for
+        the rows that sort right next to it. That way page 1000 costs the
+        same as page 1, because the database never has to walk over and throw
+        away the rows of the pages in between.
+        '''
+        return paginate_keyset(cls.timeline_sources(), before=before,
+                               after=after, per_page=per_page)
+
+    @classmethod
+    def timeline_sources(cls):
+        return post_sources()
+
+
+class FeedEntry(db.Model):
+    '''
+    The materialized home timeline. There is one row per (reader, post), and
+    the primary key is laid out as (user_id, timestamp, post_id) so that one
+    page of a reader's timeline is a single range scan over the primary key
+    index, in the same (timestamp, id) order that the keyset cursors use.
+    '''
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True,
+                        index=True)
+
+    def __repr__(self):
+        return f'<FeedEntry {self.user_id} {self.post_id}>'
+
+
+class ArchivedPost(db.Model):
+    '''
+    A post older than the archive horizon, moved out of the post table by
+    "flask posts archive" (see app/archive.py). It keeps its id and its
+    columns, so cursors and templates cannot tell it from a Post.
+    '''
+    __tablename__ = 'post_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    author = db.relationship('User')
+    __table_args__ = (
+        db.Index('ix_post_archive_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_archive_user_id_timestamp_id', 'user_id',
+                 'timestamp', 'id'),
+    )
+
+    def __repr__(self):
+        return '<ArchivedPost {}>'.format(self.body)
+
+
+class ArchivedFeedEntry(db.Model):
+    '''The feed rows of the archived posts, laid out like FeedEntry.'''
+    __tablename__ = 'feed_entry_archive'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post_archive.id'),
+                        primary_key=True, index=True)
+
+    def __repr__(self):
+        return f'<ArchivedFeedEntry {self.user_id} {self.post_id}>'
+
+
+# One query of a timeline: query, ordered by the (timestamp, id) columns in
+# keys, returns posts of model (Post or ArchivedPost). The sources that read
+# the archive are only queried for pages that reach past the archive horizon.
+Source = namedtuple('Source', ['query', 'keys', 'model', 'archived'])
+
+
+def post_sources(condition=None):
+    '''
+    The keyset sources of the public timeline, or of the posts for which
+    condition(model) is true, in the post table and in the archive.
+    '''
+    sources = []
+    for model in (Post, ArchivedPost):
+        query = sa.select(model)
+        if condition is not None:
+            query = query.where(condition(model))
+        sources.append(Source(with_authors(query, model),
+                              (model.timestamp, model.id), model,
+                              model is ArchivedPost))
+    return sources
+
+
+def feed_sources(user_id):
+    '''
+    The keyset sources of the home timeline of user_id, see
+    User.followed_timeline(). Only the id is needed, so callers that know
+    it do not have to load the User.
+    '''
+    popular = sa.select(followers.c.followed_id) \
+        .join(User, User.id == followers.c.followed_id) \
+        .where(followers.c.follower_id == user_id, User.fanout_on_read)
+    sources = []
+    for model, entry in ((Post, FeedEntry), (ArchivedPost, ArchivedFeedEntry)):
+        feed = with_authors(
+            sa.select(model).join(entry, entry.post_id == model.id)
+            .where(entry.user_id == user_id), model)
+        pulled = with_authors(
+            sa.select(model).where(model.user_id.in_(popular)), model)
+        archived = model is ArchivedPost
+        sources += [Source(feed, (entry.timestamp, entry.post_id), model,
+                           archived),
+                    Source(pulled, (model.timestamp, model.id), model,
+                           archived)]
+    return sources
+
+
+def author_sources(user_id):
+    '''The keyset sources of the posts written by user_id.'''
+    return post_sources(lambda post: post.user_id == user_id)
+
+
+def fan_out(connection, post_id, user_id, timestamp):
+    '''
+    Copy a new post into the feeds of the author's followers, as a single
+    INSERT ... SELECT over ix_followers_followed_id, and return the ids of
+    the followers. Posts by authors that are read on demand are not copied.
+    The author's own feed is filled by post_inserted(). Rows left by an
+    earlier run are replaced, so the fan-out job can safely run twice.
+    '''
+    popular = connection.scalar(
+        sa.select(User.fanout_on_read).where(User.id == user_id))
+    if popular:
+        return []
+    connection.execute(sa.delete(FeedEntry).where(
+        FeedEntry.post_id == post_id, FeedEntry.user_id != user_id))
+    readers = sa.select(followers.c.follower_id, sa.literal(timestamp),
+                        sa.literal(post_id)) \
+        .where(followers.c.followed_id == user_id)
+    return connection.scalars(sa.insert(FeedEntry).from_select(
+        ['user_id', 'timestamp', 'post_id'], readers)
+        .returning(FeedEntry.user_id)).all()
+
+
+@jobs.task('fan_out')
+def fan_out_job(post_id):
+    '''
+    The fan-out of a new post, run by a worker after the post is committed,
+    followed by the expiration of the cached pages of the feeds it went to.
+    The web workers keep their own copies of those pages, which a worker
+    cannot reach, so only the shared tier is expired (see app/cache.py).
+    With JOBS_INLINE the job runs in the web worker that wrote the post, and
+    expires its copies too.
+    '''
+    post = db.session.execute(sa.select(Post.user_id, Post.timestamp)
+                              .where(Post.id == post_id)).first()
+    if post is None or post.user_id is None:
+        # Deleted before we got to it.
+        return
+    readers = fan_out(db.session.connection(), post_id, post.user_id,
+                      post.timestamp)
+    cache = current_app.extensions.get('fragment_cache')
+    if readers and cache is not None and cache.enabled:
+        inline = current_app.config['JOBS_INLINE']
+        cache.expire_on_commit(db.session, [f'feed:{id}' for id in readers],
+                               post.timestamp, post_id, shared_only=not inline)
+
+
+def fan_out_many(connection, post_ids):
+    '''
+    fan_out() for many posts at once, such as a chunk of imported ones: two
+    INSERT ... SELECT statements fill the feeds of all the authors and of
+    their followers.
+    '''
+    new = sa.select(Post.user_id, Post.timestamp, Post.id) \
+        .where(Post.id.in_(post_ids), Post.user_id.is_not(None))
+    readers = sa.select(followers.c.follower_id, Post.timestamp, Post.id) \
+        .join(Post, Post.user_id == followers.c.followed_id) \
+        .join(User, User.id == Post.user_id) \
+        .where(Post.id.in_(post_ids), User.fanout_on_read.is_(False))
+    for rows in (new, readers):
+        connection.execute(sa.insert(FeedEntry).from_select(
+            ['user_id', 'timestamp', 'post_id'], rows))
+
+
+@sa.event.listens_for(Post, 'after_insert')
+def post_inserted(mapper, connection, post):
+    # This runs inside the flush, so the author's feed row and the fan-out
+    # job are committed (or rolled back) together with the post itself. The
+    # author sees the post in their feed straight away, the followers once
+    # a worker has run the job.
+    if post.user_id is not None:
+        connection.execute(sa.insert(FeedEntry).values(
+            user_id=post.user_id, timestamp=post.timestamp, post_id=post.id))
+        jobs.enqueue('fan_out', {'post_id': post.id},
+                     session=sa.orm.object_session(post),
+                     connection=connection)
+
+
+@sa.event.listens_for(Post, 'after_delete')
+@sa.event.listens_for(ArchivedPost, 'after_delete')
+def post_deleted(mapper, connection, post):
+    entry = ArchivedFeedEntry if isinstance(post, ArchivedPost) else FeedEntry
+    connection.execute(sa.delete(entry).where(entry.post_id == post.id))
+
+
+'''
+Counters
+
+User.post_count, follower_count and followed_count save a COUNT(*) every
+time they are shown. Each change is an UPDATE ... SET n = n + 1 issued in
+the same transaction as the row being counted, so the database serializes
+concurrent changes and a rolled back post takes its increment with it. Posts
+are counted by the mapper events below, follows by User.follow() and
+unfollow(), and the bulk paths that bypass the ORM call count_posts().
+Archived posts still count, moving them to the archive leaves the counters
+alone.
+
+Anything that writes to the tables some other way (a manual fix in a SQL
+shell, a bulk delete) leaves the counters wrong, and "flask users
+reconcile-counters" recounts them.
+'''
+
+def count_posts(connection, counts):
+    '''
+    Add to the post counters, counts being a {user_id: delta} dictionary.
+    All the users are updated with a single executemany UPDATE.
+    '''
+    table = User.__table__
+    statement = sa.update(table).where(table.c.id == sa.bindparam('author')) \
+        .values(post_count=table.c.post_count + sa.bindparam('delta'))
+    rows = [{'author': user_id, 'delta': delta}
+            for user_id, delta in counts.items() if user_id is not None]
+    if rows:
+        connection.execute(statement, rows)
+
+
+def _count_post(connection, post, delta):
+    if post.user_id is None:
+        return
+    count_posts(connection, {post.user_id: delta})
+    # The UPDATE went straight to the connection, so the author object the
+    # session may be holding is corrected by hand.
+    session = sa.orm.object_session(post)
+    key = sa.orm.util.identity_key(User, post.user_id)
+    author = session.identity_map.get(key) if session is not None else None
+    if author is not None and 'post_count' in author.__dict__:
+        sa.orm.attributes.set_committed_value(
+            author, 'post_count', author.post_count + delta)
+
+
+@sa.event.listens_for(Post, 'after_insert')
+def post_counted(mapper, connection, post):
+    _count_post(connection, post, 1)
+
+
+@sa.event.listens_for(Post, 'after_delete')
+@sa.event.listens_for(ArchivedPost, 'after_delete')
+def post_uncounted(mapper, connection, post):
+    _count_post(connection, post, -1)
+
+
+def reconcile_counters(batch_size=1000, progress=None):
+    '''
+    Recount the counters of every user, in batches of batch_size users with
+    a commit after each, and return (users checked, users repaired). Each
+    batch is one UPDATE that recomputes the counts with correlated
+    subqueries and only touches the users whose counters are off.
+    '''
+    counts = {
+        'post_count': sa.select(sa.func.count()).select_from(Post)
+        .where(Post.user_id == User.id).scalar_subquery() +
+        sa.select(sa.func.count()).select_from(ArchivedPost)
+        .where(ArchivedPost.user_id == User.id).scalar_subquery(),
+        'follower_count': sa.select(sa.func.count()).select_from(followers)
+        .where(followers.c.followed_id == User.id).scalar_subquery(),
+        'followed_count': sa.select(sa.func.count()).select_from(followers)
+        .where(followers.c.follower_id == User.id).scalar_subquery(),
+    }
+    drifted = sa.or_(*[getattr(User, name) != count
+                       for name, count in counts.items()])
+    checked = repaired = 0
+    last = 0
+    while True:
+        ids = db.session.scalars(sa.select(User.id).where(User.id > last)
+                                 .order_by(User.id).limit(batch_size)).all()
+        if not ids:
+            break
+        result = db.session.execute(
+            sa.update(User).where(User.id.between(ids[0], ids[-1]), drifted)
+            .values(**counts).execution_options(synchronize_session=False))
+        db.session.commit()
+        checked += len(ids)
+        repaired += result.rowcount
+        last = ids[-1]
+        if progress is not None:
+            progress(checked, repaired)
+    return checked, repaired
+
+
+def timeline_scopes(connection, user_id):
+    '''
+    Names of the timelines a post by user_id shows up in, as used by the
+    fragment cache: the public one, and the feeds of the author and of
+    everyone who follows them.
+    '''
+    readers = connection.scalars(sa.select(followers.c.follower_id).where(
+        followers.c.followed_id == user_id))
+    return ['public'] + [f'feed:{id}' for id in [user_id, *readers]]
+
+
+@sa.event.listens_for(Post, 'after_insert')
+def expire_fragments_inserted(mapper, connection, post):
+    # The feeds of the followers only change when the fan-out job runs, and
+    # the job expires them then.
+    _expire_fragments(post, lambda: ['public', f'feed:{post.user_id}'])
+
+
+@sa.event.listens_for(Post, 'after_delete')
+@sa.event.listens_for(ArchivedPost, 'after_delete')
+def expire_fragments_deleted(mapper, connection, post):
+    _expire_fragments(post, lambda: timeline_scopes(connection, post.user_id))
+
+
+def _expire_fragments(post, scopes):
+    if not has_app_context() or post.user_id is None:
+        return
+    cache = current_app.extensions.get('fragment_cache')
+    if cache is not None and cache.enabled:
+        cache.expire_on_commit(sa.orm.object_session(post), scopes(),
+                               post.timestamp, post.id)
+
+
+@login.user_loader
+def load_user(id):
+    return db.session.get(User, int(id))
+
+
+'''
+Timeline queries
+
+Templates read post.author.username for every post in a list. The author
+relationship is a plain lazy one, so if the posts were loaded on their own,
+each of those attribute reads would issue its own SELECT on the user table:
+one query for the page, plus one per post (the "N+1" problem).
+
+with_authors() fixes that by joining the user table into the page query and
+telling the ORM to populate post.author from the joined columns
+(contains_eager), so a page of posts costs exactly one query no matter how
+many posts it holds. When strict loading is on, which by default is the case
+in debug mode, every other relationship is set to raise instead of lazy
+loading, so a template that starts touching a new relationship fails loudly
+during development instead of quietly adding a query per row in production.
+'''
+
+def strict_loading():
+    strict = current_app.config.get('TIMELINE_STRICT_LOADING')
+    return current_app.debug if strict is None else strict
+
+
+def with_authors(query, model=Post):
+    # The author backref is only added to Post once the mappers have been
+    # configured, which normally happens on the first query.
+    sa.orm.configure_mappers()
+    query = query.join(model.author) \
+        .options(sa.orm.contains_eager(model.author))
+    if strict_loading():
+        query = query.options(sa.orm.raiseload('*'))
+    return query
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if 'query_count' in g:
+        g.query_count += 1
+
+
+@contextmanager
+def query_budget(limit=None):
+    '''
+    Count the SQL statements issued inside the with block, which for a view
+    is the page query plus everything the template triggers while rendering.
+    Going over the limit (TIMELINE_QUERY_BUDGET by default) always emits a
+    warning, and raises QueryBudgetExceeded when strict loading is on.
+
+    Like any contextmanager it also works as a view decorator:
+
+        @app.route('/index')
+        @query_budget()
+        def index():
+            ...
+    '''
+    if limit is None:
+        limit = current_app.config['TIMELINE_QUERY_BUDGET']
+    for engine in [db.engine, *replica_engines()]:
+        if not sa.event.contains(engine, 'before_cursor_execute', _count_query):
+            sa.event.listen(engine, 'before_cursor_execute', _count_query)
+    outer = g.pop('query_count', None)
+    g.query_count = 0
+    try:
+        yield g
+    finally:
+        count = g.pop('query_count')
+        if outer is not None:
+            g.query_count = outer + count
+    if count > limit:
+        message = f'{count} queries issued, the budget is {limit}'
+        warnings.warn(message, RuntimeWarning)
+        if strict_loading():
+            raise QueryBudgetExceeded(message)
+
+
+'''
+Keyset pagination
+
+A cursor is an opaque, URL safe token that encodes the (timestamp, id) pair of
+a row. The id is part of the key because timestamps are not unique, and
+without a tie-breaker two posts written in the same microsecond could be
+skipped or shown twice when a page boundary falls between them.
+
+Following the "before" cursor walks towards older posts, and following the
+"after" cursor walks back towards newer ones.
+
+A timeline is read from one or more sources (see Source), and the ones that
+read the archive tables are skipped unless the page reaches past the archive
+horizon, so that the pages of the last ARCHIVE_AFTER_DAYS days, which are
+nearly all the pages anyone reads, never touch the archive.
+'''
+
+def encode_cursor(timestamp, id):
+    raw = f'{timestamp.isoformat()}|{id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Turn a cursor back into a (timestamp, id) tuple. Anything that was not
+    produced by encode_cursor() raises ValueError.
+    '''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    timestamp, _, id = base64.urlsafe_b64decode(padded).decode().partition('|')
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+class TimelinePage(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        # Cursor for the page of older posts, or None on the last page.
+        self.next_cursor = next_cursor
+        # Cursor for the page of newer posts, or None on the first page.
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __repr__(self):
+        return f'<TimelinePage {len(self.items)} items>'
+
+
+def _seek(query, columns, before=None, after=None):
+    timestamp_col, id_col = columns
+    if after:
+        timestamp, id = decode_cursor(after)
+        return query.where(sa.or_(
+            timestamp_col > timestamp,
+            sa.and_(timestamp_col == timestamp, id_col > id))
+        ).order_by(timestamp_col.asc(), id_col.asc())
+    if before:
+        timestamp, id = decode_cursor(before)
+        query = query.where(sa.or_(
+            timestamp_col < timestamp,
+            sa.and_(timestamp_col == timestamp, id_col < id)))
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def paginate_keyset(sources, before=None, after=None, per_page=20,
+                    key=lambda row: (row.timestamp, row.id), columns=None):
+    '''
+    Return a TimelinePage of the rows of one or more Source queries.
+
+    Each query is seeked with the same cursor, ordered by the (timestamp, id)
+    keys of its source, and one extra row is fetched to find out whether
+    there is another page in the direction we are walking. When there is more
+    than one source the results are merged, dropping duplicates. The sources
+    that read the archive only run when the page reaches past the horizon.
+
+    With columns, a function that is given the model of a source (Post or
+    ArchivedPost) and returns the columns to select from it, the queries
+    select those columns instead of the entities, and the page holds plain
+    rows. They have to include columns labeled timestamp and id for the
+    cursors.
+    '''
+    if columns is None:
+        def fetch(statement):
+            return db.session.scalars(statement).all()
+    else:
+        sources = _only_columns(sources, columns)
+
+        def fetch(statement):
+            return db.session.execute(statement).all()
+    results = _fetch(sources, before, after, per_page, fetch, key)
+    return _keyset_page(results, before, after, per_page, key)
+
+
+async def paginate_keyset_async(session, sources, before=None, after=None,
+                                per_page=20,
+                                key=lambda row: (row.timestamp, row.id)):
+    '''
+    The same as paginate_keyset(), running the queries on an AsyncSession.
+    '''
+    async def fetch(statement):
+        return (await session.scalars(statement)).all()
+    results = await _fetch_async(sources, before, after, per_page, fetch, key)
+    return _keyset_page(results, before, after, per_page, key)
+
+
+def keyset_keys(sources, before, after, per_page):
+    '''
+    The (timestamp, id) keys of the rows paginate_keyset() would find, one
+    list per source that had to be queried. They are read from the indexes
+    the pages come from, and tell which rows a page holds without loading
+    them.
+    '''
+    def fetch(statement):
+        return db.session.execute(statement).all()
+    return _fetch(_only_columns(sources), before, after, per_page, fetch,
+                  tuple)
+
+
+async def keyset_keys_async(session, sources, before, after, per_page):
+    '''The same as keyset_keys(), on an AsyncSession.'''
+    async def fetch(statement):
+        return (await session.execute(statement)).all()
+    return await _fetch_async(_only_columns(sources), before, after,
+                              per_page, fetch, tuple)
+
+
+def _fetch(sources, before, after, per_page, fetch, key):
+    hot, archived = _split_sources(sources)
+    results = [fetch(statement) for statement
+               in _keyset_statements(hot, before, after, per_page)]
+    if archived and reaches_archive(results, before, after, per_page, key):
+        results += [fetch(statement) for statement
+                    in _keyset_statements(archived, before, after, per_page)]
+    return results
+
+
+async def _fetch_async(sources, before, after, per_page, fetch, key):
+    hot, archived = _split_sources(sources)
+    results = [await fetch(statement) for statement
+               in _keyset_statements(hot, before, after, per_page)]
+    if archived and reaches_archive(results, before, after, per_page, key):
+        results += [await fetch(statement) for statement
+                    in _keyset_statements(archived, before, after, per_page)]
+    return results
+
+
+def _split_sources(sources):
+    return ([source for source in sources if not source.archived],
+            [source for source in sources if source.archived])
+
+
+def _keyset_statements(sources, before, after, per_page):
+    return [_seek(source.query, source.keys, before, after)
+            .limit(per_page + 1) for source in sources]
+
+
+def _only_columns(sources, columns=None):
+    # The joins and conditions stay, only the selected columns change. The
+    # default is the (timestamp, id) keys of each source.
+    return [source._replace(query=source.query.with_only_columns(
+        *(columns(source.model) if columns else source.keys),
+        maintain_column_froms=False)) for source in sources]
+
+
+def archive_horizon():
+    '''
+    Posts older than this may have been moved to the archive, see
+    app/archive.py. Everything newer is in the post table.
+    '''
+    return datetime.utcnow() - \
+        timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+
+def reaches_archive(results, before, after, per_page, key):
+    '''
+    Whether the page that the results of the sources outside the archive
+    start can hold archived posts. Walking back to newer posts, that is when
+    the cursor is older than the horizon. Walking to older posts, it is when
+    those results do not fill the page and its extra row with posts newer
+    than the horizon, since every archived post is older than it.
+    '''
+    horizon = archive_horizon()
+    if after:
+        return decode_cursor(after)[0] < horizon
+    keys = sorted({key(row) for result in results for row in result},
+                  reverse=True)
+    return len(keys) <= per_page or keys[per_page][0] < horizon
+
+
+def _keyset_page(results, before, after, per_page, key):
+    rows = [row for result in results for row in result]
+    if len(results) > 1:
+        # The identity map hands out one object per primary key, so a post
+        # returned by two sources is the same object twice.
+        rows = sorted(dict.fromkeys(rows), key=key, reverse=not after)
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if after:
+        # Rows were read oldest first so that the seek uses the index; put
+        # them back in display order.
+        rows.reverse()
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, before is not None
+
+    next_cursor = prev_cursor = None
+    if rows and has_older:
+        next_cursor = encode_cursor(*key(rows[-1]))
+    if rows and has_newer:
+        prev_cursor = encode_cursor(*key(rows[0]))
+    return TimelinePage(rows, next_cursor, prev_cursor)
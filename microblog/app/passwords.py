@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+from werkzeug.security import generate_password_hash, check_password_hash
+
+'''
+Password hashing
+
+Passwords are hashed with the key derivation functions that ship with
+Werkzeug. They are slow on purpose, and the method string in the
+PASSWORD_HASH_METHOD configuration variable sets how slow: for example
+'pbkdf2:sha256:600000' means 600,000 iterations of PBKDF2-HMAC-SHA256, and
+'scrypt:32768:8:1' is scrypt with N=32768, r=8 and p=1. The method and the
+cost are stored at the front of every hash, which is what makes it possible
+to notice that a stored hash was made with old settings and upgrade it the
+next time the user logs in, because that is the only time the plain text
+password is known.
+
+The User.password_hash column holds 256 characters, enough for the 162 of an
+scrypt hash. When the configured method makes longer hashes than that, the
+stored hashes are not upgraded: the users keep logging in with the old ones,
+and a warning is logged, until the column is widened.
+
+The hashing itself runs in a small thread pool of PASSWORD_HASH_WORKERS
+threads, one pool per application. Its size is a cap on how many hashes are
+computed at once, and so on how many CPU cores login traffic can tie up,
+whatever the number of request threads. The synchronous functions still wait
+for the result, so the request thread is blocked for the length of the hash
+plus any time spent queued behind other logins, it just does not compete for
+the CPU meanwhile. Only the async versions, used by the async views, give
+their thread back to serve other requests while the hash is computed, since
+hashlib releases the GIL while it works.
+'''
+
+
+def init_app(app):
+    app.extensions['password_hash'] = ThreadPoolExecutor(
+        max_workers=app.config['PASSWORD_HASH_WORKERS'],
+        thread_name_prefix='password-hash')
+
+
+def _executor():
+    if has_app_context():
+        return current_app.extensions.get('password_hash')
+    return None
+
+
+def _submit(fn, *args):
+    executor = _executor()
+    if executor is None:
+        # Not configured, e.g. a script using the models directly.
+        return fn(*args)
+    # Blocks this thread all the same, the pool only caps the concurrency.
+    return executor.submit(fn, *args).result()
+
+
+def warn_too_long(pwhash):
+    current_app.logger.warning(
+        'Not upgrading a password hash: the %d characters of a %s hash do '
+        'not fit in the password_hash column', len(pwhash),
+        pwhash.split('$', 1)[0])
+
+
+def hash_password(password, method, salt_length=16):
+    return _submit(generate_password_hash, password, method, salt_length)
+
+
+def verify_password(pwhash, password):
+    if not pwhash:
+        return False
+    return _submit(check_password_hash, pwhash, password)
+
+
+async def hash_password_async(password, method, salt_length=16):
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor(), generate_password_hash, password, method, salt_length)
+
+
+async def verify_password_async(pwhash, password):
+    if not pwhash:
+        return False
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor(), check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash, method):
+    '''
+    Return True when pwhash was not made with the given method and cost.
+    Only the parts spelled out in method are compared, so that a method of
+    'pbkdf2:sha256' accepts whatever iteration count Werkzeug defaulted to.
+    '''
+    stored = pwhash.split('$', 1)[0].split(':')
+    wanted = method.split(':')
+    return stored[:len(wanted)] != wanted
@@ -0,0 +1,191 @@
+import time
+from collections import OrderedDict
+
+from flask import current_app, request, Response
+
+'''
+Rate limiting
+
+Every login attempt costs a password hash, which is slow on purpose, so a
+client that keeps posting to /login can tie up the workers. Login attempts
+are therefore counted per client IP address and per username with token
+buckets: a bucket holds up to "burst" tokens, refills at "rate" tokens per
+second, and an attempt that finds it empty is turned away with a 429 before
+the database or the password hash are touched. The limits are configuration
+strings such as '20/minute', meaning a burst of 20 and a refill of 20 tokens
+a minute.
+
+The per-username limit also slows down attempts spread over many addresses,
+at the price of letting someone keep a user from logging in for as long as
+they keep guessing their password.
+
+The buckets live in a backend. MemoryBackend keeps them in the worker
+process, and RedisBackend keeps them in Redis so that all the workers share
+them. Behind a reverse proxy, request.remote_addr is the proxy unless the
+application is wrapped in werkzeug's ProxyFix.
+'''
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(limit):
+    '''Turn '20/minute' into (rate per second, burst).'''
+    count, _, period = limit.partition('/')
+    count = int(count)
+    return count / PERIODS[period.strip().rstrip('s')], count
+
+
+class MemoryBackend(object):
+    '''
+    Token buckets in an OrderedDict, least recently hit first. It takes no
+    lock: each bucket is an immutable tuple that is replaced as a whole, and
+    every step of a hit is a single OrderedDict operation, which the GIL
+    makes atomic, so the buckets can never be corrupted, and a hit costs the
+    same however many clients there are.
+
+    Each hit forgets the least recently hit buckets that are full again,
+    which are the same as no bucket, and when there are more than max_keys
+    buckets, the least recently hit ones whether they are full or not. The
+    races this allows only make the limits a little looser: two threads
+    hitting the same bucket at the same instant may both get the same
+    token, and a bucket hit just as it is forgotten starts over full. Either
+    way an attempt or two more get through, which does not matter for
+    throttling.
+    '''
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def hit(self, key, rate, burst, now=None):
+        '''
+        Take a token from the bucket of key. Return (allowed, retry_after),
+        retry_after being the seconds until a token is available again.
+        '''
+        now = time.monotonic() if now is None else now
+        buckets = self._buckets
+        tokens, last, _ = buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # The bucket is full again, and can be forgotten, at full_at.
+        buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        try:
+            buckets.move_to_end(key)
+        except KeyError:
+            # Forgotten by another thread in between.
+            pass
+        self._evict(now)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            try:
+                oldest = next(iter(buckets))
+            except (StopIteration, RuntimeError):
+                # Emptied or changed by another thread.
+                return
+            bucket = buckets.get(oldest)
+            if bucket is not None and bucket[2] > now and \
+                    len(buckets) <= self.max_keys:
+                return
+            buckets.pop(oldest, None)
+
+    def clear(self):
+        self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBackend(object):
+    '''
+    Token buckets in Redis hashes, updated by a Lua script so that each hit
+    is atomic across all the workers. Idle buckets expire on their own.
+    '''
+
+    SCRIPT = '''
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local tokens = tonumber(bucket[1]) or burst
+        local last = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last',
+                   ARGV[3])
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate))
+        return {allowed, tostring(tokens)}
+    '''
+
+    def __init__(self, client, prefix='microblog:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def hit(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        allowed, tokens = self._script(keys=[self.prefix + key],
+                                       args=[rate, burst, now])
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def backend_for(url):
+    if url == 'memory://':
+        return MemoryBackend()
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError('RATELIMIT_STORAGE_URL is set to a Redis server, '
+                           'but the redis package is not installed')
+    return RedisBackend(redis.Redis.from_url(url))
+
+
+def init_app(app):
+    app.extensions['ratelimit'] = backend_for(
+        app.config['RATELIMIT_STORAGE_URL'])
+
+
+def too_many(retry_after):
+    retry_after = max(1, int(retry_after + 0.999))
+    return Response(f'Too many login attempts, try again in {retry_after} '
+                    'seconds.', 429, {'Retry-After': str(retry_after)},
+                    mimetype='text/plain')
+
+
+def check_login(username=None):
+    '''
+    Count a login attempt of the current request. Return a 429 response if
+    it goes over one of the limits, or None to let the login go ahead. Only
+    the raw form is looked at, nothing is validated or read from the database.
+    Logins that do not come from the login form pass the username.
+    '''
+    if not current_app.config['RATELIMIT_ENABLED']:
+        return None
+    backend = current_app.extensions['ratelimit']
+    keys = [('ip:' + (request.remote_addr or ''),
+             current_app.config['RATELIMIT_LOGIN_IP'])]
+    if username is None:
+        username = request.form.get('username', '')
+    username = username.strip().lower()
+    if username:
+        keys.append(('user:' + username,
+                     current_app.config['RATELIMIT_LOGIN_USERNAME']))
+    for key, limit in keys:
+        allowed, retry_after = backend.hit('login:' + key,
+                                           *parse_limit(limit))
+        if not allowed:
+            return too_many(retry_after)
+    return None
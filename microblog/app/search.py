@@ -0,0 +1,254 @@
+import re
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.models import Post, ArchivedPost, with_authors
+
+'''
+Full-text search
+
+Searching posts with LIKE '%word%' cannot use an index, so the database reads
+every post in the table for every search. Instead, each backend below keeps
+(or relies on) an index of the words in Post.body and ranks the posts that
+match. The backend is picked from the SEARCH_BACKEND configuration variable,
+or from the database in use when that is not set.
+
+With SQLite, the index is an FTS5 virtual table, post_fts, that uses the post
+table as its "external content": it only stores the index and looks the text
+up in post. Triggers on the post table keep it in sync, so posts inserted by
+any means, including plain SQL, are indexed. The posts moved to the archive
+(see app/archive.py) have an index of their own, post_archive_fts, kept in
+sync with post_archive the same way, so moving a post takes it out of one
+index and puts it in the other. The tables and the triggers are created by
+migrations, and for databases built with db.create_all() (tests, benchmarks)
+by the after_create hooks at the bottom of this module.
+
+Other databases get the LIKE backend until a backend for their own full-text
+search is written. A backend only needs to turn a list of words into a select
+of the ids of the matching rows of a table, and to say how to order them.
+Both tables are searched together and their matches are paginated as one
+list, so archived posts come up where their rank puts them.
+'''
+
+
+def fts5_ddl(table):
+    '''The statements that create the FTS5 index of table and its triggers.'''
+    fts = f'{table}_fts'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(body, "
+        f"content='{table}', content_rowid='id', "
+        f"tokenize='porter unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} "
+        f"BEGIN INSERT INTO {fts} (rowid, body) VALUES (new.id, new.body); "
+        f"END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} "
+        f"BEGIN INSERT INTO {fts} ({fts}, rowid, body) "
+        f"VALUES ('delete', old.id, old.body); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF body ON "
+        f"{table} BEGIN "
+        f"INSERT INTO {fts} ({fts}, rowid, body) "
+        f"VALUES ('delete', old.id, old.body); "
+        f"INSERT INTO {fts} (rowid, body) VALUES (new.id, new.body); END",
+    ]
+
+
+# The tables that are searched, in the order of the source column of the
+# matches.
+MODELS = (Post, ArchivedPost)
+
+# Longer queries are cut down to this many words.
+MAX_TERMS = 8
+
+
+def terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+class SearchPage(object):
+    '''
+    A page of results. truncated is True on the last page when only some of
+    the matches were ranked, so that the page can say why there are no more.
+    '''
+
+    def __init__(self, items, query, page, has_next, truncated=False):
+        self.items = items
+        self.query = query
+        self.page = page
+        self.has_next = has_next
+        self.truncated = truncated
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __repr__(self):
+        return f'<SearchPage {self.query!r} {self.page}>'
+
+
+class SearchBackend(object):
+    name = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def matches(self, words, model):
+        '''
+        Return a select of the rows of model (Post or ArchivedPost) matching
+        all the words: their id, and the columns that order_by() needs.
+        '''
+        raise NotImplementedError
+
+    def order_by(self, matches):
+        '''The ORDER BY of the matches subquery, best match first.'''
+        raise NotImplementedError
+
+    def truncated(self, words):
+        '''True when matches() leaves out some of the rows that match.'''
+        return False
+
+    def search(self, query, page=1, per_page=20):
+        words = terms(query)
+        if not words:
+            return SearchPage([], query, page, False)
+        matches = sa.union_all(*[
+            self.matches(words, model)
+            .add_columns(sa.literal(source).label('source'))
+            .subquery().select()
+            for source, model in enumerate(MODELS)]).subquery()
+        # Only the ids are sorted and sliced, and only the posts of the page
+        # are loaded. One row more than the page holds tells whether there is
+        # a next one.
+        rows = db.session.execute(
+            sa.select(matches.c.id, matches.c.source)
+            .order_by(*self.order_by(matches))
+            .limit(per_page + 1).offset((page - 1) * per_page)).all()
+        posts = {}
+        for source, model in enumerate(MODELS):
+            ids = [row.id for row in rows[:per_page] if row.source == source]
+            if ids:
+                posts.update((post.id, post) for post in db.session.scalars(
+                    with_authors(sa.select(model).where(model.id.in_(ids)),
+                                 model)))
+        # A post moved or deleted since the ids were read is left out.
+        items = [posts[row.id] for row in rows[:per_page] if row.id in posts]
+        has_next = len(rows) > per_page
+        return SearchPage(items, query, page, has_next,
+                          not has_next and self.truncated(words))
+
+
+def fts_table(model):
+    return sa.table(f'{model.__tablename__}_fts',
+                    sa.column('rowid', sa.Integer), sa.column('rank'))
+
+
+class Fts5Backend(SearchBackend):
+    '''
+    Ranks matches with the bm25 function of FTS5. Scoring a word found in
+    most posts means scoring most of the table, so only the rank_window most
+    recent matches of each index are ranked (all of them when rank_window is
+    None), and the older ones cannot be paged to. FTS5 finds the most recent
+    matches cheaply by reading its index backwards. The last page says when
+    matches were left out.
+    '''
+    name = 'fts5'
+
+    def __init__(self, rank_window=None):
+        self.rank_window = rank_window
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['SEARCH_RANK_WINDOW'])
+
+    def _matching(self, words, fts):
+        # Every word is quoted, so that nothing the user types is taken as
+        # FTS5 query syntax. Words separated by spaces must all match.
+        match = ' '.join('"' + word.replace('"', '""') + '"'
+                         for word in words)
+        return sa.literal_column(fts.name).op('MATCH')(match)
+
+    def matches(self, words, model):
+        fts = fts_table(model)
+        matching = self._matching(words, fts)
+        # The ranking runs on the index alone, the posts of the page are
+        # loaded afterwards. Sorting all the matches together with their text
+        # and author is much slower for common words.
+        ranked = sa.select(fts.c.rowid.label('id'),
+                           fts.c.rank.label('rank')).where(matching)
+        if self.rank_window:
+            recent = sa.select(fts.c.rowid).where(matching) \
+                .order_by(fts.c.rowid.desc()) \
+                .limit(self.rank_window).subquery()
+            oldest = sa.select(sa.func.min(recent.c.rowid)) \
+                .correlate(None).scalar_subquery()
+            ranked = ranked.where(fts.c.rowid >= oldest)
+        return ranked
+
+    def order_by(self, matches):
+        return matches.c.rank, matches.c.id.desc()
+
+    def truncated(self, words):
+        if not self.rank_window:
+            return False
+        for model in MODELS:
+            fts = fts_table(model)
+            # Reads one match past the window from the index, at most.
+            beyond = sa.select(fts.c.rowid).where(self._matching(words, fts)) \
+                .order_by(fts.c.rowid.desc()) \
+                .limit(1).offset(self.rank_window)
+            if db.session.scalar(beyond) is not None:
+                return True
+        return False
+
+
+class LikeBackend(SearchBackend):
+    '''
+    Works everywhere and scans the whole post table (and the archive),
+    newest posts first.
+    '''
+    name = 'like'
+
+    def matches(self, words, model):
+        # Words can hold underscores, which LIKE would take as a wildcard,
+        # so the wildcards and the escape character are escaped.
+        patterns = ['%' + re.sub(r'([\\%_])', r'\\\1', word) + '%'
+                    for word in words]
+        return sa.select(model.id.label('id'),
+                         model.timestamp.label('timestamp')) \
+            .where(*[model.body.ilike(pattern, escape='\\')
+                     for pattern in patterns])
+
+    def order_by(self, matches):
+        return matches.c.timestamp.desc(), matches.c.id.desc()
+
+
+BACKENDS = {backend.name: backend for backend in (Fts5Backend, LikeBackend)}
+
+
+def init_app(app):
+    name = app.config['SEARCH_BACKEND']
+    if name is None:
+        url = sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        name = 'fts5' if url.get_backend_name() == 'sqlite' else 'like'
+    app.extensions['search'] = BACKENDS[name].from_config(app.config)
+
+
+def search_posts(query, page=1, per_page=20):
+    return current_app.extensions['search'].search(query, page, per_page)
+
+
+def create_fts5_index(table, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for statement in fts5_ddl(table.name):
+            connection.exec_driver_sql(statement)
+
+
+def drop_fts5_index(table, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS {table.name}_fts')
+
+
+for model in MODELS:
+    sa.event.listen(model.__table__, 'after_create', create_fts5_index)
+    sa.event.listen(model.__table__, 'after_drop', drop_fts5_index)
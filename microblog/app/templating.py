@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+from jinja2 import ChoiceLoader, FileSystemBytecodeCache, ModuleLoader
+
+'''
+Template loading
+
+Jinja2 parses a template and compiles it to Python code the first time each
+worker renders it, and, unless TEMPLATES_AUTO_RELOAD is off, checks the
+modification time of the file on every render after that. Both costs show up
+as slow first requests after every deploy or worker restart. Three settings
+cut them down:
+
+- TEMPLATE_MODULES points to a directory of templates precompiled to Python
+  modules by "flask templates compile". They are looked up before the
+  template files, so the directory has to be compiled again whenever a
+  template changes, which makes this a build step of a deploy.
+- TEMPLATE_BYTECODE_CACHE points to a directory where Jinja2 keeps the
+  compiled bytecode of the templates it renders, keyed by a checksum of their
+  source. Workers that share the directory only compile each template once
+  between them, and a changed template gets a new entry by itself.
+- TEMPLATE_PRELOAD loads every template when the application starts instead
+  of when it is first rendered.
+
+The production profile turns TEMPLATES_AUTO_RELOAD off and preloads.
+'''
+
+
+def init_app(app):
+    env = app.jinja_env
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE'], exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATE_BYTECODE_CACHE'])
+    modules = app.config['TEMPLATE_MODULES']
+    if modules and not os.path.exists(modules):
+        # Not compiled yet, possibly because this is "flask templates compile"
+        # itself. The template files do the job meanwhile.
+        app.logger.warning('TEMPLATE_MODULES %s does not exist, run "flask '
+                           'templates compile"', modules)
+    elif modules:
+        env.loader = ChoiceLoader([ModuleLoader(modules), env.loader])
+    if app.config['TEMPLATE_PRELOAD']:
+        for name in source_environment(app).list_templates():
+            env.get_template(name)
+
+
+def source_environment(app):
+    # The module loader can load templates but cannot list them or give out
+    # their source, so anything that needs those works on the template files.
+    return app.jinja_env.overlay(loader=app.create_global_jinja_loader())
+
+
+def compile_templates(app, target, zip=None, log_function=None):
+    '''
+    Compile all the templates of app to Python modules in target, a
+    directory, or a zip file when zip is 'deflated' or 'stored'.
+    '''
+    source_environment(app).compile_templates(
+        target, zip=zip, log_function=log_function, ignore_errors=False)
+
+
+def templates_digest(app):
+    '''
+    A digest of the source of all the templates, which changes whenever a
+    deploy changes a template. Computed once per application.
+    '''
+    digest = app.extensions.get('templates_digest')
+    if digest is None:
+        env = source_environment(app)
+        sha = hashlib.sha256()
+        for name in sorted(env.list_templates()):
+            source, _, _ = env.loader.get_source(env, name)
+            sha.update(name.encode() + b'\0' + source.encode() + b'\0')
+        digest = app.extensions['templates_digest'] = sha.hexdigest()[:16]
+    return digest
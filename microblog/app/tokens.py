@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+
+from flask import current_app
+from itsdangerous import BadSignature, Signer
+
+'''
+API tokens
+
+Programs that use the API authenticate with a bearer token instead of the
+session cookie. A token is "<user id>.<expiration>.<signature>", where the
+signature is an HMAC-SHA256 of the first two parts, so checking a token only
+takes the signing keys: there is no session to load and no User to query,
+and a token cannot be revoked other than by letting it expire or by
+retiring the key that signed it.
+
+API_TOKEN_KEYS holds the signing keys. The first one signs new tokens and
+all of them are accepted, which is how keys are rotated: put the new key in
+front, and drop the old one once API_TOKEN_LIFETIME has passed.
+
+Verifying a signature is cheap, but clients send the same token over and
+over, so each worker remembers the API_TOKEN_CACHE_SIZE tokens it verified
+last, and a repeated token only costs a dictionary lookup and the expiration
+check.
+'''
+
+
+class TokenCache(object):
+    '''Least recently used tokens and the (user id, expiration) they carry.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            decoded = self._entries.get(token)
+            if decoded is not None:
+                self._entries.move_to_end(token)
+            return decoded
+
+    def set(self, token, decoded):
+        with self._lock:
+            self._entries[token] = decoded
+            self._entries.move_to_end(token)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TokenAuth(object):
+    def __init__(self, keys, lifetime, cache_size=0):
+        # itsdangerous signs with the last key of the list and accepts all.
+        self.signer = Signer(list(reversed(keys)), salt='api-token',
+                             digest_method=sha256)
+        self.lifetime = lifetime
+        self.cache = TokenCache(cache_size) if cache_size else None
+
+    def issue(self, user_id, now=None):
+        '''Return a new token for user_id and its expiration time.'''
+        expires = int((time.time() if now is None else now) + self.lifetime)
+        return self.signer.sign(f'{user_id}.{expires}').decode(), expires
+
+    def verify(self, token, now=None):
+        '''
+        Return the user id carried by token, or None if it is malformed,
+        was not signed by one of our keys, or has expired.
+        '''
+        now = time.time() if now is None else now
+        decoded = self.cache.get(token) if self.cache is not None else None
+        if decoded is None:
+            try:
+                user_id, expires = self.signer.unsign(token).split(b'.')
+                decoded = int(user_id), int(expires)
+            except (BadSignature, ValueError):
+                return None
+            # Only genuine tokens are cached, so made up ones cannot push
+            # them out.
+            if self.cache is not None and decoded[1] > now:
+                self.cache.set(token, decoded)
+        user_id, expires = decoded
+        return user_id if expires > now else None
+
+
+def init_app(app):
+    app.extensions['tokens'] = TokenAuth(
+        app.config['API_TOKEN_KEYS'] or [app.config['SECRET_KEY']],
+        app.config['API_TOKEN_LIFETIME'], app.config['API_TOKEN_CACHE_SIZE'])
+
+
+def issue_token(user_id):
+    return current_app.extensions['tokens'].issue(user_id)
+
+
+def verify_token(token):
+    return current_app.extensions['tokens'].verify(token)
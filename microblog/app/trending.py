@@ -0,0 +1,229 @@
+import heapq
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from flask import current_app
+
+from app import db
+from app.models import Post
+
+'''
+Trending terms and authors
+
+Counting the words of every post of the last 24 hours on each request would
+read a day of posts per page view. Instead "flask trending" runs one process
+that reads each new post once, in id order, and keeps running counts of its
+terms and of its author over sliding windows (TRENDING_WINDOWS, the last hour
+and the last day by default). Every TRENDING_SNAPSHOT_INTERVAL seconds it
+writes the TRENDING_TOP first terms and authors of each window to the trend
+table, and the /trending page only reads those rows, a few dozen of them
+whatever the number of posts.
+
+A window is a ring of buckets, each one counting the posts of a slice of the
+window. The running totals of the window are updated as posts come in, and
+when time moves past a bucket, its counts are subtracted from the totals and
+the bucket is reused for the newest slice. Adding a post and sliding the
+window cost the same whatever the length of the window, and a window only
+holds the terms that appear in it.
+
+The counts only live in the memory of that process, which rebuilds them when
+it starts by reading the posts of the longest window again. Posts deleted
+after they were counted stay counted until they slide out of the windows.
+Only one "flask trending" process should run at a time, since each one would
+overwrite the snapshots of the others with the same counts.
+'''
+
+KINDS = ('term', 'author')
+
+# Words of four letters or more are counted, minus the most common ones, so
+# that "that" and "with" do not top the list.
+TERM_RE = re.compile(r'[^\W\d_]{4,}')
+MAX_TERM_LENGTH = 64
+STOP_WORDS = frozenset('''
+    about after again also been before being could does doing down each even
+    from have having here into just know like make more most much must only
+    other over really same should some such than that their them then there
+    these they this those very want were what when where which while will
+    with would your
+'''.split())
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def post_terms(body):
+    '''The distinct terms of a post body, lowercased.'''
+    terms = {term.lower()[:MAX_TERM_LENGTH]
+             for term in TERM_RE.findall(body or '')}
+    return terms - STOP_WORDS
+
+
+class Trend(db.Model):
+    '''
+    One row of the latest snapshot: the term or the author at rank (counting
+    from 1) of the given kind in the given window, and its count.
+    '''
+    window = db.Column(db.String(16), primary_key=True)
+    kind = db.Column(db.String(16), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    term = db.Column(db.String(MAX_TERM_LENGTH))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    count = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    author = db.relationship('User')
+
+    def __repr__(self):
+        return f'<Trend {self.window} {self.kind} {self.rank}>'
+
+
+class SlidingWindow(object):
+    '''
+    Counts of keys over the last seconds, in a ring of buckets. Posts are
+    placed by their timestamp, so posts read late still land in the right
+    bucket as long as it is in the window.
+    '''
+
+    def __init__(self, seconds, buckets):
+        self.width = max(1, seconds // buckets)
+        self.buckets = [Counter() for _ in range(buckets)]
+        # The number of the slice each bucket holds, -1 when it is empty.
+        self.slices = array('q', [-1] * buckets)
+        self.totals = Counter()
+        self.newest = None
+
+    def _slice(self, timestamp):
+        return int((timestamp - EPOCH).total_seconds()) // self.width
+
+    def _expire(self, i):
+        for key, count in self.buckets[i].items():
+            left = self.totals[key] - count
+            if left:
+                self.totals[key] = left
+            else:
+                del self.totals[key]
+        self.buckets[i].clear()
+        self.slices[i] = -1
+
+    def advance(self, now):
+        '''Slide the window so that it ends at now.'''
+        newest = self._slice(now)
+        if self.newest is not None and newest <= self.newest:
+            return
+        self.newest = newest
+        oldest = newest - len(self.buckets)
+        for i, number in enumerate(self.slices):
+            if number != -1 and number <= oldest:
+                self._expire(i)
+
+    def add(self, timestamp, keys):
+        number = self._slice(timestamp)
+        if self.newest is not None:
+            if number <= self.newest - len(self.buckets):
+                return
+            # Posts stamped ahead of our clock count as current.
+            number = min(number, self.newest)
+        i = number % len(self.buckets)
+        if self.slices[i] != number:
+            self._expire(i)
+            self.slices[i] = number
+        self.buckets[i].update(keys)
+        self.totals.update(keys)
+
+    def top(self, k):
+        '''The k keys with the highest counts, as (key, count) pairs.'''
+        return heapq.nlargest(k, self.totals.items(), key=lambda item: item[1])
+
+
+class Trends(object):
+    '''The term and author windows of every window in TRENDING_WINDOWS.'''
+
+    def __init__(self, windows):
+        self.windows = {(name, kind): SlidingWindow(seconds, buckets)
+                        for name, seconds, buckets in windows
+                        for kind in KINDS}
+        self.longest = max(seconds for name, seconds, buckets in windows)
+
+    def advance(self, now):
+        for window in self.windows.values():
+            window.advance(now)
+
+    def add(self, post):
+        keys = {'term': post_terms(post.body), 'author': [post.user_id]}
+        for (name, kind), window in self.windows.items():
+            window.add(post.timestamp, keys[kind])
+
+    def snapshot(self, k, now):
+        '''Replace the rows of the trend table with the current top k.'''
+        rows = []
+        for (name, kind), window in self.windows.items():
+            for rank, (key, count) in enumerate(window.top(k), 1):
+                rows.append({'window': name, 'kind': kind, 'rank': rank,
+                             'term': key if kind == 'term' else None,
+                             'user_id': key if kind == 'author' else None,
+                             'count': count, 'updated_at': now})
+        # In a single transaction, so the page never sees half a snapshot.
+        db.session.execute(sa.delete(Trend))
+        if rows:
+            db.session.execute(sa.insert(Trend), rows)
+        db.session.commit()
+
+
+def run(stop=None, once=False):
+    '''
+    Count the new posts and write snapshots until stop (a threading Event)
+    is set. With once, stop after the first snapshot.
+    '''
+    config = current_app.config
+    trends = Trends(config['TRENDING_WINDOWS'])
+    batch_size = config['TRENDING_BATCH_SIZE']
+    stop = stop or threading.Event()
+    # The snapshots are writes, which send the session to the primary anyway.
+    db.session.info['wrote'] = True
+    # Start with the posts of the longest window, to rebuild the counts.
+    start = datetime.utcnow() - timedelta(seconds=trends.longest)
+    last_id = db.session.scalar(
+        sa.select(sa.func.min(Post.id) - 1).where(Post.timestamp >= start))
+    if last_id is None:
+        last_id = db.session.scalar(sa.select(sa.func.max(Post.id))) or 0
+    next_snapshot = 0
+    while not stop.is_set():
+        posts = db.session.execute(
+            sa.select(Post.id, Post.user_id, Post.timestamp, Post.body)
+            .where(Post.id > last_id).order_by(Post.id)
+            .limit(batch_size)).all()
+        # End the read transaction, so that the next poll sees new posts.
+        db.session.commit()
+        now = datetime.utcnow()
+        trends.advance(now)
+        for post in posts:
+            trends.add(post)
+            last_id = post.id
+        if len(posts) == batch_size:
+            # Still catching up, a snapshot now would be missing posts.
+            continue
+        if time.monotonic() >= next_snapshot:
+            trends.snapshot(config['TRENDING_TOP'], now)
+            next_snapshot = time.monotonic() + \
+                config['TRENDING_SNAPSHOT_INTERVAL']
+            if once:
+                break
+        stop.wait(config['TRENDING_POLL_INTERVAL'])
+
+
+def top(window):
+    '''
+    The latest snapshot of window, as a dictionary of lists of Trend rows,
+    one per kind, in rank order.
+    '''
+    rows = db.session.scalars(
+        sa.select(Trend).where(Trend.window == window)
+        .options(sa.orm.joinedload(Trend.author))
+        .order_by(Trend.kind, Trend.rank)).all()
+    trends = {kind: [] for kind in KINDS}
+    for row in rows:
+        trends[row.kind].append(row)
+    return trends
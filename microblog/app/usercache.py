@@ -0,0 +1,356 @@
+import math
+import os
+import threading
+import time
+from hashlib import blake2b
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.pool import StaticPool
+
+from app import db
+from app.cache import LRUCache
+from app.models import User, Post, ArchivedPost
+
+'''
+User lookups by username and email
+
+The login form, the API token endpoint and the profile pages all start by
+finding a user by username, which is a query on the ix_user_username index
+for every request, and crawlers ask for usernames that do not exist over and
+over. Each worker therefore keeps:
+
+- An LRU of USER_CACHE_SIZE users, as the values of their columns, and of
+  the id of the user each username and email belongs to. A hit is put in the
+  session with merge(load=False), which needs no query, and the entries
+  expire after USER_CACHE_TTL seconds. The password hash is never cached: it
+  is loaded when it is read, so that a password changed in another process
+  stops working at once, at the price of that query on the login form. The
+  other columns, the counters among them, can be up to USER_CACHE_TTL
+  seconds behind the changes made by other processes or by bulk imports.
+- A Bloom filter of all the usernames, kept up to date by a thread that adds
+  the users created since, by id, every USER_CACHE_REFRESH seconds, and
+  loads it again from scratch every USER_CACHE_REBUILD seconds or when it
+  fills up past its capacity. A username that the filter has not seen is
+  answered as missing without a query. The filter is behind the users that
+  other processes create by up to USER_CACHE_REFRESH seconds, and behind
+  the ones they rename until the next rebuild. Until its first load, every
+  miss goes to the database.
+- An LRU of the usernames and emails that were looked up and not found,
+  remembered for USER_CACHE_NEGATIVE_TTL seconds, for the emails and for
+  the false positives of the filter.
+
+The thread reads the usernames on a connection of its own, never on the
+session of the requests. It is not started for in-memory SQLite databases,
+whose single connection is shared by all the threads: its queries would end
+up in the middle of the transactions of the requests.
+
+User inserts, updates and deletes made through the ORM in this process
+update the filter and drop the affected entries right away, and so do the
+posts and follows that change the counters of a user.
+
+Usernames and emails are cached exactly as given: the unique indexes compare
+them exactly, so folding their case here would find users that the database
+does not.
+'''
+
+# Answer of cached() for the names known not to exist.
+MISSING = 0
+
+KEYS = ('username', 'email')
+
+
+class BloomFilter(object):
+    '''
+    Set membership with false positives (at the given rate while it holds
+    no more than capacity items) but no false negatives.
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # Values added, not counting the ones that were in already.
+        self.count = 0
+
+    def _positions(self, value):
+        # Double hashing: k positions out of the two halves of one digest.
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def _has(self, positions):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in positions)
+
+    def add(self, value):
+        positions = self._positions(value)
+        if self._has(positions):
+            return
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return self._has(self._positions(value))
+
+
+# Loaded from the database whenever it is read, see above.
+UNCACHED = ('password_hash',)
+
+
+def _uses_shared_connection(engine):
+    return isinstance(engine.pool, StaticPool) or \
+        engine.url.database in (None, '', ':memory:') or \
+        'mode=memory' in str(engine.url)
+
+
+class UserLookup(object):
+    def __init__(self, cache_size, ttl, negative_ttl, refresh_interval,
+                 rebuild_interval, bloom_capacity, bloom_error_rate):
+        self.ids = LRUCache(cache_size, ttl=ttl)
+        self.users = LRUCache(cache_size, ttl=ttl)
+        self.missing = LRUCache(cache_size, ttl=negative_ttl)
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom = None
+        self.last_id = 0
+        self.built = 0
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def start_refresher(self):
+        '''
+        Start the thread that keeps the Bloom filter up to date, unless this
+        process has it running already. It is started on the first lookup
+        rather than with the application, so that servers that fork their
+        workers after loading the application get one in each worker.
+        '''
+        if self._refresher == os.getpid():
+            return
+        with self._lock:
+            if self._refresher == os.getpid():
+                return
+            self._refresher = os.getpid()
+            if _uses_shared_connection(db.engine):
+                return
+            threading.Thread(target=self._refresh_loop, daemon=True,
+                             name='user-lookup-refresh',
+                             args=(current_app._get_current_object(),
+                                   db.engine)).start()
+
+    def _refresh_loop(self, app, engine):
+        while True:
+            try:
+                with engine.connect() as connection:
+                    self.refresh(connection)
+            except Exception:
+                app.logger.exception('Could not refresh the usernames')
+            time.sleep(self.refresh_interval)
+
+    def refresh(self, connection):
+        '''
+        Add the users created since the last refresh to the Bloom filter, or
+        build a new one when it is due or full. A new filter is built aside
+        and swapped in, so lookups keep using the old one meanwhile.
+        '''
+        bloom = self.bloom
+        rebuild = bloom is None or \
+            time.monotonic() - self.built >= self.rebuild_interval
+        rows = []
+        if not rebuild:
+            rows = connection.execute(
+                sa.select(User.id, User.username)
+                .where(User.id > self.last_id).order_by(User.id)).all()
+            rebuild = bloom.count + len(rows) > bloom.capacity
+        if rebuild:
+            count = connection.scalar(sa.select(sa.func.count(User.id)))
+            bloom = BloomFilter(max(self.bloom_capacity, 2 * count),
+                                self.bloom_error_rate)
+            rows = connection.execute(
+                sa.select(User.id, User.username).order_by(User.id)).all()
+            self.built = time.monotonic()
+        for row in rows:
+            if row.username is not None:
+                bloom.add(row.username)
+        if rows:
+            self.last_id = max(self.last_id, rows[-1].id)
+        self.bloom = bloom
+
+    def cached(self, key, value):
+        '''
+        The column values of the user whose key ('username' or 'email') is
+        value, as far as the cache knows: MISSING if there is no such user,
+        or None when it has to be looked up.
+        '''
+        if key == 'username' and self.bloom is not None and \
+                value not in self.bloom:
+            return MISSING
+        if self.missing.get(f'{key}\t{value}') is not None:
+            return MISSING
+        user_id = self.ids.get(f'{key}\t{value}')
+        values = self.users.get(str(user_id)) if user_id is not None \
+            else None
+        # The entry of a user renamed since is left behind by the name.
+        if values is not None and values[key] == value:
+            return values
+        return None
+
+    def remember(self, key, value, user):
+        if user is None:
+            self.missing.set(f'{key}\t{value}', True)
+            return
+        state = sa.inspect(user)
+        self.users.set(str(user.id), {
+            attr.key: state.dict[attr.key]
+            for attr in state.mapper.column_attrs
+            if attr.key not in UNCACHED and attr.key in state.dict})
+        self.ids.set(f'{key}\t{value}', user.id)
+        self.missing.delete(f'{key}\t{value}')
+
+    def restore(self, session, values):
+        '''
+        The User of the cached values, in session. No query is needed: the
+        user already in the session is used if there is one, otherwise the
+        values are merged in without a load.
+        '''
+        key = sa.orm.util.identity_key(User, values['id'])
+        user = session.identity_map.get(key)
+        if user is None:
+            user = User(**values)
+            sa.orm.make_transient_to_detached(user)
+            user = session.merge(user, load=False)
+        return user
+
+    def find(self, key, value, session=None):
+        '''Return the User whose key is value, or None.'''
+        session = session if session is not None else db.session
+        self.start_refresher()
+        values = self.cached(key, value)
+        if values == MISSING:
+            return None
+        if values is not None:
+            return self.restore(session, values)
+        user = session.scalar(
+            sa.select(User).where(getattr(User, key) == value))
+        self.remember(key, value, user)
+        return user
+
+    async def find_async(self, session, key, value):
+        '''
+        The same as find(), on an AsyncSession. Only the misses are answered
+        from the cache: the async view is the login form, which reads the
+        password hash, and an AsyncSession cannot load it lazily.
+        '''
+        self.start_refresher()
+        if self.cached(key, value) == MISSING:
+            return None
+        user = await session.scalar(
+            sa.select(User).where(getattr(User, key) == value))
+        self.remember(key, value, user)
+        return user
+
+    def added(self, user):
+        if self.bloom is not None and user.username is not None:
+            self.bloom.add(user.username)
+        for key in KEYS:
+            self.missing.delete(f'{key}\t{getattr(user, key)}')
+
+    def changed(self, user):
+        self.forget_user(user.id)
+        for key in KEYS:
+            history = sa.inspect(user).attrs[key].history
+            for value in history.added:
+                self.missing.delete(f'{key}\t{value}')
+            if key == 'username' and self.bloom is not None:
+                for value in history.added:
+                    if value is not None:
+                        self.bloom.add(value)
+
+    def removed(self, user):
+        self.forget_user(user.id)
+
+    def forget_user(self, user_id):
+        if user_id is not None:
+            self.users.delete(str(user_id))
+
+
+def init_app(app):
+    app.extensions['user_lookup'] = UserLookup(
+        app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'],
+        app.config['USER_CACHE_NEGATIVE_TTL'], app.config['USER_CACHE_REFRESH'], app.config['USER_CACHE_REBUILD'],
+        app.config['USER_CACHE_BLOOM_CAPACITY'],
+        app.config['USER_CACHE_BLOOM_ERROR_RATE'])
+
+
+def find_user(username=None, email=None):
+    '''Return the User with the given username or email, or None.'''
+    key, value = ('username', username) if username is not None else \
+        ('email', email)
+    if not current_app.config['USER_CACHE_ENABLED']:
+        return db.session.scalar(
+            sa.select(User).where(getattr(User, key) == value))
+    return current_app.extensions['user_lookup'].find(key, value)
+
+
+async def find_user_async(session, username=None, email=None):
+    '''The same as find_user(), on an AsyncSession.'''
+    key, value = ('username', username) if username is not None else \
+        ('email', email)
+    if not current_app.config['USER_CACHE_ENABLED']:
+        return await session.scalar(
+            sa.select(User).where(getattr(User, key) == value))
+    return await current_app.extensions['user_lookup'].find_async(
+        session, key, value)
+
+
+def _lookup():
+    if has_app_context():
+        return current_app.extensions.get('user_lookup')
+    return None
+
+
+@sa.event.listens_for(User, 'after_insert')
+def user_inserted(mapper, connection, user):
+    lookup = _lookup()
+    if lookup is not None:
+        lookup.added(user)
+
+
+@sa.event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, user):
+    lookup = _lookup()
+    if lookup is not None:
+        lookup.changed(user)
+
+
+@sa.event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, user):
+    lookup = _lookup()
+    if lookup is not None:
+        lookup.removed(user)
+
+
+@sa.event.listens_for(Post, 'after_insert')
+@sa.event.listens_for(Post, 'after_delete')
+@sa.event.listens_for(ArchivedPost, 'after_delete')
+def post_counted(mapper, connection, post):
+    # The post counter of the author changed.
+    lookup = _lookup()
+    if lookup is not None:
+        lookup.forget_user(post.user_id)
+
+
+@sa.event.listens_for(User.followed, 'append')
+@sa.event.listens_for(User.followed, 'remove')
+def follow_counted(user, followed, initiator):
+    # The follow counters of both users changed.
+    lookup = _lookup()
+    if lookup is not None:
+        lookup.forget_user(user.id)
+        lookup.forget_user(followed.id)
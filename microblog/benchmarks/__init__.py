@@ -0,0 +1,4 @@
+# Benchmarks for microblog. Each module can be run on its own from the
+# microblog directory, for example:
+#
+#     python -m benchmarks.password_hashing
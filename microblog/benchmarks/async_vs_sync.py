@@ -0,0 +1,132 @@
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+'''
+Sync vs async views under concurrent load
+
+Seeds a temporary SQLite database, then starts the application twice in a
+threaded development server, once with the regular views and once with
+SQLALCHEMY_ASYNC set, and hits /index from a number of concurrent clients.
+Requests per second and mean latency are reported for each mode.
+
+    python -m benchmarks.async_vs_sync --clients 32 --seconds 10
+
+Keep in mind that Flask is a WSGI framework: an async view runs in an event
+loop of its own inside the worker thread, so the difference between the two
+modes depends a lot on the server and on how much of the request is spent
+waiting on the database.
+'''
+
+MICROBLOG = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(database_url, users, posts):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, MICROBLOG)
+    from app import create_app, db
+    from app.models import User, Post
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        authors = [User(username=f'user{i}', email=f'user{i}@example.com')
+                   for i in range(users)]
+        db.session.add_all(authors)
+        db.session.flush()
+        start = datetime.utcnow() - timedelta(days=30)
+        db.session.execute(db.insert(Post), [
+            {'body': f'post number {i}', 'user_id': authors[i % users].id,
+             'timestamp': start + timedelta(seconds=i)}
+            for i in range(posts)])
+        db.session.commit()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def load(port, path, clients, seconds):
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        mine = []
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            conn.request('GET', path)
+            conn.getresponse().read()
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, sum(latencies) / len(latencies)
+
+
+def run(mode, database_url, args):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database_url,
+               SQLALCHEMY_ASYNC='1' if mode == 'async' else '0')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', 'run', '--port', str(port),
+         '--with-threads'],
+        cwd=MICROBLOG, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        load(port, args.path, args.clients, 1)  # warm up
+        return load(port, args.path, args.clients, args.seconds)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the sync and async views under load.')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--path', default='/index')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        seed(database_url, args.users, args.posts)
+        print(f'{"mode":<8} {"req/s":>10} {"mean ms":>10}')
+        for mode in ('sync', 'async'):
+            rps, latency = run(mode, database_url, args)
+            print(f'{mode:<8} {rps:>10.1f} {latency * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+'''
+Password hashing micro-benchmark
+
+Reports how many logins per second a worker can verify at each cost setting,
+first one at a time and then with a pool of threads like the one used by
+app/passwords.py. Use it to pick PASSWORD_HASH_METHOD: the cost should be as
+high as the login traffic of the deployment can afford.
+
+    python -m benchmarks.password_hashing
+    python -m benchmarks.password_hashing --threads 8 pbkdf2:sha256:1000000
+'''
+
+DEFAULT_METHODS = [
+    'pbkdf2:sha256:100000',
+    'pbkdf2:sha256:300000',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:1000000',
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+]
+
+
+def logins_per_second(pwhash, seconds, threads):
+    done = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while time.perf_counter() < deadline:
+            batch = [executor.submit(check_password_hash, pwhash, 'secret')
+                     for _ in range(threads)]
+            done += sum(future.result() for future in batch)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure password verifications per second.')
+    parser.add_argument('methods', nargs='*', default=DEFAULT_METHODS)
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='time spent on each measurement')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='size of the thread pool')
+    args = parser.parse_args()
+
+    print(f'{"method":<24} {"1 thread":>12} {f"{args.threads} threads":>12}')
+    for method in args.methods:
+        pwhash = generate_password_hash('secret', method)
+        single = logins_per_second(pwhash, args.seconds, 1)
+        pooled = logins_per_second(pwhash, args.seconds, args.threads)
+        print(f'{method:<24} {single:>10.1f}/s {pooled:>10.1f}/s')
+
+
+if __name__ == '__main__':
+    main()
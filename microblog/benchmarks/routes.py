@@ -0,0 +1,269 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmarks.async_vs_sync import free_port, wait_for
+from benchmarks.seed import MICROBLOG, PASSWORD, create_app, seed
+
+'''
+Route benchmarks
+
+Seeds a scratch database (see benchmarks/seed.py) and measures the main
+routes of the application, in two ways:
+
+- client: in-process through the Flask test client, one request at a time,
+  which measures the application code alone.
+- server: against the application running in a threaded development server
+  in its own process, with --clients concurrent HTTP clients.
+
+The scenarios are the anonymous home page, a page deep into the public
+timeline, the home feed of a user who follows many people, a login, and a
+search. For each one the report has the latency percentiles and the
+throughput. The output is JSON and includes the commit, so that the results
+of two commits can be compared:
+
+    python -m benchmarks.routes --users 1000 --posts 50000 > routes.json
+
+Everything is seeded from --seed, so two runs with the same arguments work on
+the same data.
+'''
+
+SCENARIOS = ('index_anonymous', 'index_deep', 'index_feed', 'login', 'search')
+
+
+def percentile(values, p):
+    # Nearest rank on sorted values.
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def csrf_token(html):
+    match = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                      html) or re.search(r'value="([^"]+)"[^>]*csrf_token',
+                                         html)
+    return match.group(1) if match else ''
+
+
+class Target(object):
+    '''
+    The requests of the GET scenarios, as (method, path) tuples. The deep
+    cursor, the feed user and the search word are picked from the seeded
+    data.
+    '''
+
+    def __init__(self, deep_cursor, feed_user, word):
+        self.deep_cursor = deep_cursor
+        self.feed_user = feed_user
+        self.word = word
+
+    def request(self, scenario):
+        if scenario == 'index_deep':
+            return 'GET', '/index?' + urlencode({'before': self.deep_cursor})
+        if scenario == 'search':
+            return 'GET', '/search?' + urlencode({'q': self.word})
+        return 'GET', '/index'
+
+
+def find_target(app):
+    import sqlalchemy as sa
+    from app import db
+    from app.models import Post, followers, encode_cursor
+    with app.app_context():
+        # Ten pages back into the public timeline.
+        row = db.session.execute(
+            sa.select(Post.timestamp, Post.id)
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .offset(app.config['POSTS_PER_PAGE'] * 10).limit(1)).first()
+        heaviest = db.session.scalar(
+            sa.select(followers.c.follower_id)
+            .group_by(followers.c.follower_id)
+            .order_by(sa.func.count().desc()).limit(1)) or 1
+    return Target(encode_cursor(*row) if row else '', f'user{heaviest - 1}',
+                  'number')
+
+
+class TestClientDriver(object):
+    def __init__(self, app):
+        self.app = app
+
+    def session(self, scenario, target):
+        client = self.app.test_client()
+        if scenario == 'index_feed':
+            token = csrf_token(client.get('/login').get_data(as_text=True))
+            client.post('/login', data={'username': target.feed_user,
+                                        'password': PASSWORD,
+                                        'csrf_token': token})
+        if scenario == 'login':
+            token = csrf_token(client.get('/login').get_data(as_text=True))
+            data = {'username': 'user1', 'password': PASSWORD,
+                    'csrf_token': token}
+            # Keep the anonymous session, the one that holds the CSRF token,
+            # so that every POST goes through the whole login.
+            cookie = client.get_cookie('session')
+
+            def send():
+                if cookie is not None:
+                    client.set_cookie(cookie.key, cookie.value)
+                return client.post('/login', data=data).status_code
+            return send
+        method, path = target.request(scenario)
+        return lambda: client.open(path, method=method).status_code
+
+
+class HTTPDriver(object):
+    def __init__(self, port):
+        self.port = port
+
+    def _request(self, conn, method, path, cookie, body=None):
+        headers = {'Cookie': cookie} if cookie else {}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        match = re.match(r'(session=[^;]*)',
+                         response.getheader('Set-Cookie') or '')
+        return response.status, data, match.group(1) if match else cookie
+
+    def session(self, scenario, target):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        cookie = None
+        if scenario in ('index_feed', 'login'):
+            _, html, cookie = self._request(conn, 'GET', '/login', cookie)
+            user = target.feed_user if scenario == 'index_feed' else 'user1'
+            body = urlencode({'username': user, 'password': PASSWORD,
+                              'csrf_token': csrf_token(html.decode())})
+            if scenario == 'login':
+                return lambda: self._request(conn, 'POST', '/login', cookie,
+                                             body)[0]
+            _, _, cookie = self._request(conn, 'POST', '/login', cookie, body)
+        method, path = target.request(scenario)
+        return lambda: self._request(conn, method, path, cookie)[0]
+
+
+def run_scenario(driver, scenario, target, clients, requests, warmup):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def client(count):
+        nonlocal errors
+        send = driver.session(scenario, target)
+        for _ in range(warmup):
+            send()
+        mine, failed = [], 0
+        barrier.wait()
+        for _ in range(count):
+            started = time.perf_counter()
+            status = send()
+            mine.append(time.perf_counter() - started)
+            failed += status >= 400
+        with lock:
+            latencies.extend(mine)
+            errors += failed
+
+    barrier = threading.Barrier(clients + 1)
+    threads = [threading.Thread(target=client, args=(requests // clients,))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=MICROBLOG, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the latency and throughput of the routes.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Measured requests per scenario and mode.')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='Unmeasured requests per client first.')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Concurrent clients in server mode.')
+    parser.add_argument('--modes', default='client,server')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    args = parser.parse_args()
+    scenarios = args.scenarios.split(',')
+
+    # The login scenario logs in far more often than the login rate limits
+    # allow, for the server process too.
+    os.environ['RATELIMIT_ENABLED'] = '0'
+    report = {'commit': git_commit(), 'python': sys.version.split()[0],
+              'arguments': vars(args), 'results': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app = create_app(database_url)
+        report['data'] = seed(app, args.users, args.posts, args.follows,
+                              rng=random.Random(args.seed))
+        target = find_target(app)
+
+        if 'client' in args.modes:
+            driver = TestClientDriver(app)
+            report['results']['client'] = {
+                scenario: run_scenario(driver, scenario, target, 1,
+                                       args.requests, args.warmup)
+                for scenario in scenarios}
+
+        if 'server' in args.modes:
+            port = free_port()
+            env = dict(os.environ, DATABASE_URL=database_url)
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'flask', 'run', '--port', str(port),
+                 '--with-threads'],
+                cwd=MICROBLOG, env=env, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            try:
+                wait_for(port)
+                driver = HTTPDriver(port)
+                report['results']['server'] = {
+                    scenario: run_scenario(driver, scenario, target,
+                                           args.clients, args.requests,
+                                           args.warmup)
+                    for scenario in scenarios}
+            finally:
+                server.terminate()
+                server.wait()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
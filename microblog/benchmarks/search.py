@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import string
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+'''
+Full-text search against a LIKE scan
+
+Fills a scratch SQLite database with generated posts and times the first page
+of results of the same searches through the FTS5 backend and through the LIKE
+backend of app/search.py. The words of the posts follow a Zipf-like
+distribution, so that the searches cover a very common word, a rare one, and
+combinations of both.
+
+The LIKE backend lists results newest first and stops at the first page of
+matches, so it is quick for common words and reads the whole table for rare
+ones. The FTS5 backend is timed with the default rank window and with
+--rank-window, which can be set to 0 to rank every match.
+
+    python -m benchmarks.search --posts 1000000 > search.json
+
+Seeding a million posts takes a few minutes, most of it spent indexing them.
+The output is JSON, like the other benchmarks.
+'''
+
+MICROBLOG = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(string.ascii_lowercase,
+                                      k=rng.randint(3, 9))))
+    return sorted(words)
+
+
+def seed(db, posts, words, rng, chunk=10000):
+    from app.models import User, Post
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    users = [{'id': i + 1, 'username': f'user{i}',
+              'email': f'user{i}@example.com'} for i in range(100)]
+    db.session.execute(User.__table__.insert(), users)
+    start = datetime(2023, 1, 1)
+    for first in range(0, posts, chunk):
+        rows = []
+        for i in range(first, min(first + chunk, posts)):
+            body = ' '.join(rng.choices(words, weights, k=rng.randint(5, 15)))
+            rows.append({'body': body[:140], 'user_id': rng.randint(1, 100),
+                         'timestamp': start + timedelta(seconds=i)})
+        db.session.execute(Post.__table__.insert(), rows)
+    db.session.commit()
+
+
+def measure(backend, query, runs, per_page):
+    timings = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        page = backend.search(query, 1, per_page)
+        timings.append((time.perf_counter() - t0) * 1000)
+    return {'median_ms': round(statistics.median(timings), 3),
+            'min_ms': round(min(timings), 3),
+            'results': len(page.items)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare FTS5 search with a LIKE scan over post.body.')
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--rank-window', type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, MICROBLOG)
+    rng = random.Random(args.seed)
+    words = vocabulary(5000, rng)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp,
+                                                                 'search.db')
+        from app import create_app, db
+        from app.search import Fts5Backend, LikeBackend
+        app = create_app()
+        with app.app_context():
+            db.create_all()
+            t0 = time.perf_counter()
+            seed(db, args.posts, words, rng)
+            seed_time = time.perf_counter() - t0
+
+            queries = {
+                'common': words[0],
+                'rare': words[-1],
+                'common_and_rare': f'{words[0]} {words[-1]}',
+                'two_common': f'{words[1]} {words[2]}',
+                'missing': 'zzzzzzzzzz',
+            }
+            report = {'posts': args.posts, 'runs': args.runs,
+                      'rank_window': app.config['SEARCH_RANK_WINDOW'],
+                      'sqlite': sqlite3.sqlite_version,
+                      'seed_s': round(seed_time, 1), 'queries': {}}
+            for name, query in queries.items():
+                report['queries'][name] = {
+                    'query': query,
+                    'fts5': measure(Fts5Backend.from_config(app.config),
+                                    query, args.runs, args.per_page),
+                    f'fts5_window_{args.rank_window or "all"}': measure(
+                        Fts5Backend(args.rank_window or None), query,
+                        args.runs, args.per_page),
+                    'like': measure(LikeBackend(), query, args.runs,
+                                    args.per_page),
+                }
+            db.session.remove()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
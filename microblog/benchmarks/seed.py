@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+'''
+Benchmark data
+
+Fills a database with users, follows and posts shaped roughly like a real
+social network: how popular a user is follows a Zipf distribution, popular
+users both get most of the follows and write most of the posts, and the
+number of users each user follows is exponentially distributed around
+--follows. The home feeds are filled the same way the application fills them,
+so the popular authors above FEED_FANOUT_LIMIT followers are switched to
+fan-out-on-read.
+
+Every user gets the password PASSWORD, hashed once with the configured
+method, and the same --seed always produces the same data:
+
+    python -m benchmarks.seed --users 1000 --posts 50000 \\
+        --database-url sqlite:////tmp/bench.db
+
+Without --database-url a temporary database is seeded and thrown away, which
+is only useful to time the seeding itself. The other benchmarks call seed()
+directly.
+'''
+
+MICROBLOG = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'benchmark'
+
+CHUNK = 10000
+
+
+def popularity(users, exponent=1.0):
+    return [1 / (rank + 1) ** exponent for rank in range(users)]
+
+
+def seed(app, users=1000, posts=50000, follows=30, days=30, rng=None):
+    '''
+    Seed the database of app, whose tables must exist, and return a summary
+    of what was created. User ids are 1 to users, the most popular first.
+    '''
+    import sqlalchemy as sa
+    from app import db
+    from app.models import User, Post, followers, fan_out_many, \
+        reconcile_counters
+    rng = rng or random.Random(42)
+    weights = popularity(users)
+    started = time.perf_counter()
+    with app.app_context():
+        user = User()
+        user.set_password(PASSWORD)
+        db.session.execute(User.__table__.insert(), [
+            {'id': i + 1, 'username': f'user{i}',
+             'email': f'user{i}@example.com',
+             'password_hash': user.password_hash}
+            for i in range(users)])
+
+        pairs = set()
+        for follower in range(1, users + 1):
+            count = min(int(rng.expovariate(1 / follows)), users - 1)
+            for followed in rng.choices(range(1, users + 1), weights,
+                                        k=count):
+                if followed != follower:
+                    pairs.add((follower, followed))
+        rows = [{'follower_id': a, 'followed_id': b} for a, b in pairs]
+        for i in range(0, len(rows), CHUNK):
+            db.session.execute(followers.insert(), rows[i:i + CHUNK])
+
+        counts = {}
+        for _, followed in pairs:
+            counts[followed] = counts.get(followed, 0) + 1
+        limit = app.config['FEED_FANOUT_LIMIT']
+        popular = [id for id, n in counts.items() if n > limit]
+        if popular:
+            db.session.execute(sa.update(User).where(User.id.in_(popular))
+                               .values(fanout_on_read=True))
+
+        start = datetime.utcnow() - timedelta(days=days)
+        step = days * 86400 / max(posts, 1)
+        authors = rng.choices(range(1, users + 1), weights, k=posts)
+        for first in range(0, posts, CHUNK):
+            rows = [{'body': f'post number {i} by user{authors[i] - 1}',
+                     'user_id': authors[i],
+                     'timestamp': start + timedelta(seconds=i * step)}
+                    for i in range(first, min(first + CHUNK, posts))]
+            ids = db.session.scalars(
+                sa.insert(Post.__table__).returning(Post.__table__.c.id),
+                rows).all()
+            fan_out_many(db.session.connection(), ids)
+        db.session.commit()
+        # Nothing above went through the ORM, so the counters start at zero.
+        reconcile_counters(batch_size=CHUNK)
+        feed_rows = db.session.scalar(sa.text('SELECT count(*) FROM '
+                                              'feed_entry'))
+    return {'users': users, 'posts': posts, 'follows': len(pairs),
+            'max_followers': max(counts.values(), default=0),
+            'fanout_on_read_users': len(popular), 'feed_rows': feed_rows,
+            'seconds': round(time.perf_counter() - started, 2)}
+
+
+def create_app(database_url):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, MICROBLOG)
+    from app import create_app, db
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Seed a database with benchmark data.')
+    parser.add_argument('--database-url')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=30,
+                        help='Mean number of users each user follows.')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app = create_app(database_url)
+        summary = seed(app, args.users, args.posts, args.follows,
+                       rng=random.Random(args.seed))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+'''
+Worker startup time
+
+Measures, in fresh interpreters, how long it takes from the first import of
+the app package to the first request served, split into the import, the
+create_app() call and the first request (which includes connecting to the
+database and compiling the templates it renders). It also records whether
+Alembic got imported along the way, which should only happen for the
+flask db commands.
+
+    python -m benchmarks.startup --runs 20 > startup.json
+
+The output is JSON, so that the numbers can be kept and compared from one
+release to the next.
+'''
+
+MICROBLOG = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+from app import create_app, db
+t1 = time.perf_counter()
+app = create_app()
+t2 = time.perf_counter()
+with app.app_context():
+    db.create_all()
+t3 = time.perf_counter()
+response = app.test_client().get('/index')
+t4 = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import': t1 - t0,
+    'create_app': t2 - t1,
+    'first_request': t4 - t3,
+    'total': (t4 - t3) + (t2 - t0),
+    'alembic_imported': 'alembic' in sys.modules,
+}))
+'''
+
+
+def probe(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=MICROBLOG,
+                            env=env, check=True, capture_output=True,
+                            text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the time from import to first served request.')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = 'sqlite:///' + os.path.join(tmp, 'startup.db')
+        runs = [probe(database_url) for _ in range(args.runs)]
+
+    report = {'runs': args.runs,
+              'python': sys.version.split()[0],
+              'alembic_imported': any(run['alembic_imported'] for run in runs)}
+    for phase in ('import', 'create_app', 'first_request', 'total'):
+        values = sorted(run[phase] * 1000 for run in runs)
+        report[phase + '_ms'] = {
+            'median': round(statistics.median(values), 2),
+            'min': round(values[0], 2),
+            'max': round(values[-1], 2),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
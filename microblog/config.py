@@ -36,6 +36,156 @@ class Config(object):
     app/__init__.py file.
     '''
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
+    # Serve the index and login views as async def views on an async engine,
+    # see app/aio.py.
+    SQLALCHEMY_ASYNC = os.environ.get('SQLALCHEMY_ASYNC', '').lower() in \
+        ('1', 'true', 'yes')
+    # Read replicas of the database, as a space or comma separated list of
+    # URLs. Reads are spread over them, see app/database.py.
+    SQLALCHEMY_REPLICA_URIS = (os.environ.get('DATABASE_REPLICA_URLS') or
+                               '').replace(',', ' ').split()
+    # How far behind the primary the replicas may be, in seconds. For this
+    # long after a write, reads from the same client go to the primary so
+    # that users see what they just did.
+    REPLICA_LAG_TOLERANCE = float(os.environ.get('REPLICA_LAG_TOLERANCE') or 5)
+    POSTS_PER_PAGE = int(os.environ.get('POSTS_PER_PAGE') or 20)
+    # Maximum number of SQL queries a timeline page may cost, rendering
+    # included: loading the logged in user, the feed range scan and the posts
+    # pulled from popular authors, and the key-only versions of the last two
+    # that compute the ETag, and the same four again on the archive tables
+    # for the pages that reach past ARCHIVE_AFTER_DAYS. None for
+    # TIMELINE_STRICT_LOADING means "follow app.debug".
+    TIMELINE_QUERY_BUDGET = 9
+    TIMELINE_STRICT_LOADING = None
+    # Authors with more followers than this are not fanned out on write,
+    # their posts are merged into timelines at read time instead.
+    FEED_FANOUT_LIMIT = int(os.environ.get('FEED_FANOUT_LIMIT') or 10000)
+    # How long a reverse proxy may serve an anonymous timeline page without
+    # asking again, in seconds, see app/conditional.py.
+    TIMELINE_SHARED_MAX_AGE = int(os.environ.get('TIMELINE_SHARED_MAX_AGE')
+                                  or 10)
+    # How many recent posts of a newly followed user are copied into the feed.
+    FEED_BACKFILL = 100
+    # Posts older than this many days are moved to the archive tables by
+    # "flask posts archive", in transactions of ARCHIVE_BATCH_SIZE posts, and
+    # only the timeline pages that reach that far back read the archive, see
+    # app/archive.py. Run "flask posts archive --restore" after making it
+    # longer.
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 90)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 1000)
+    # Rendered timeline pages are cached in each worker process, and also in
+    # a shared Redis tier when CACHE_SHARED_URL is set ('local://' selects an
+    # in-process stand-in). Entries are expired as posts come and go, the
+    # TTLs only bound how long an expired page is kept around: the cache key
+    # holds a digest of the posts on the page, so a page that changed is
+    # never served from the cache. Only the process that handled a write can
+    # expire its own in-process copies, the fan-out worker only reaches the
+    # shared tier, so the in-process TTL is kept short.
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_SIZE = 1024
+    FRAGMENT_CACHE_LOCAL_TTL = 10
+    FRAGMENT_CACHE_TTL = 300
+    CACHE_SHARED_URL = os.environ.get('CACHE_SHARED_URL')
+    # Key derivation function and cost for password hashes, see
+    # app/passwords.py. Stored hashes made with other settings are upgraded
+    # when their owners log in.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'pbkdf2:sha256:600000'
+    PASSWORD_SALT_LENGTH = 16
+    # Hashes computed at once per application, see app/passwords.py.
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 4)
+    # 'fts5' or 'like', see app/search.py. By default SQLite databases get
+    # the FTS5 index and the others the LIKE scan.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or None
+    # The FTS5 backend ranks the most recent matches only, this many of them.
+    SEARCH_RANK_WINDOW = int(os.environ.get('SEARCH_RANK_WINDOW') or 1000)
+    # Trending terms and authors, counted by "flask trending", see
+    # app/trending.py. Each window is (name, seconds, buckets): the counts
+    # slide forward one bucket at a time. The top TRENDING_TOP of each window
+    # are saved every TRENDING_SNAPSHOT_INTERVAL seconds.
+    TRENDING_WINDOWS = [('1h', 3600, 60), ('24h', 86400, 96)]
+    TRENDING_TOP = 20
+    TRENDING_SNAPSHOT_INTERVAL = 60
+    TRENDING_POLL_INTERVAL = 5.0
+    TRENDING_BATCH_SIZE = 1000
+    # Posts per INSERT and per commit of a bulk import (flask posts import).
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE') or 1000)
+    # Bearer token of the /api/v1/posts/import endpoint, which is disabled
+    # while this is not set.
+    IMPORT_API_TOKEN = os.environ.get('IMPORT_API_TOKEN')
+    # Bearer token of the /api/v1/export endpoints, disabled while not set.
+    EXPORT_API_TOKEN = os.environ.get('EXPORT_API_TOKEN')
+    # How far below the newest post id an export watermark remembers the
+    # ids that were not committed yet, see app/export.py.
+    EXPORT_WATERMARK_WINDOW = int(
+        os.environ.get('EXPORT_WATERMARK_WINDOW') or 1000)
+    # Per request timings in a Server-Timing header and totals at /metrics,
+    # see app/instrumentation.py.
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '').lower() in \
+        ('1', 'true', 'yes')
+    # With INSTRUMENTATION on, dump sampled stacks of the requests slower
+    # than this many seconds into PROFILE_DIR. None turns the profiler off.
+    PROFILE_SLOW_REQUESTS = float(os.environ.get('PROFILE_SLOW_REQUESTS')
+                                  or 0) or None
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or \
+        os.path.join(basedir, 'profiles')
+    # Template loading, see app/templating.py. TEMPLATE_MODULES is the output
+    # of "flask templates compile", TEMPLATE_BYTECODE_CACHE a directory that
+    # the workers can share.
+    TEMPLATE_MODULES = os.environ.get('TEMPLATE_MODULES')
+    TEMPLATE_BYTECODE_CACHE = os.environ.get('TEMPLATE_BYTECODE_CACHE')
+    TEMPLATE_PRELOAD = False
+    # Login attempts allowed per client address and per username, see
+    # app/ratelimit.py. RATELIMIT_STORAGE_URL is memory:// for counters kept
+    # by each worker, or the URL of a Redis server shared by all of them.
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', '1').lower() in \
+        ('1', 'true', 'yes')
+    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL') or \
+        'memory://'
+    RATELIMIT_LOGIN_IP = os.environ.get('RATELIMIT_LOGIN_IP') or '30/minute'
+    RATELIMIT_LOGIN_USERNAME = os.environ.get('RATELIMIT_LOGIN_USERNAME') or \
+        '10/minute'
+    # Keys that sign the API tokens, see app/tokens.py, separated by spaces
+    # or commas. The first one signs new tokens, the others are still
+    # accepted while they are being rotated out. Empty means SECRET_KEY.
+    API_TOKEN_KEYS = (os.environ.get('API_TOKEN_KEYS') or
+                      '').replace(',', ' ').split()
+    # Seconds an API token is valid for.
+    API_TOKEN_LIFETIME = int(os.environ.get('API_TOKEN_LIFETIME') or 3600)
+    # Verified tokens remembered by each worker.
+    API_TOKEN_CACHE_SIZE = 10000
+    # Users looked up by username or email, see app/usercache.py. Users are
+    # cached for USER_CACHE_TTL seconds, and names that were not found for
+    # USER_CACHE_NEGATIVE_TTL seconds. A thread adds the users created by
+    # other processes to the Bloom filter of usernames every
+    # USER_CACHE_REFRESH seconds, and loads it again from scratch every
+    # USER_CACHE_REBUILD seconds, which is when users renamed by other
+    # processes can be found by their new names.
+    USER_CACHE_ENABLED = os.environ.get('USER_CACHE_ENABLED', '1').lower() in \
+        ('1', 'true', 'yes')
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 60
+    USER_CACHE_NEGATIVE_TTL = 30
+    USER_CACHE_REFRESH = 5
+    USER_CACHE_REBUILD = 600
+    USER_CACHE_BLOOM_CAPACITY = 100000
+    USER_CACHE_BLOOM_ERROR_RATE = 0.01
+    # Background jobs, see app/jobs.py. With JOBS_INLINE they run in the
+    # transaction that queues them instead of in "flask worker" processes.
+    # A job that fails is retried after JOBS_RETRY_DELAY seconds, doubling
+    # every time up to JOBS_RETRY_MAX_DELAY, until JOBS_MAX_ATTEMPTS.
+    JOBS_INLINE = os.environ.get('JOBS_INLINE', '').lower() in \
+        ('1', 'true', 'yes')
+    JOBS_WORKER_PROCESSES = int(os.environ.get('JOBS_WORKER_PROCESSES') or 2)
+    JOBS_BATCH_SIZE = 20
+    JOBS_POLL_INTERVAL = 1.0
+    JOBS_LEASE = 300
+    JOBS_MAX_ATTEMPTS = 5
+    JOBS_RETRY_DELAY = 5
+    JOBS_RETRY_MAX_DELAY = 3600
+    # PRAGMA name -> value, run on every new SQLite connection.
+    SQLITE_PRAGMAS = {}
     
 # The configuration settings are defined as class variables inside the Config
 # class. As the application needs more configuration items, they can be added
@@ -58,4 +208,83 @@ class Config(object):
 # so that the server has a secure key that nobody else knows.
 
 # Now that we have a config file, we need to tell Flask to read and apply it.
-# We go to __init__.py and apply this logic:
\ No newline at end of file
+# We go to __init__.py and apply this logic:
+
+# That time has come: the application now runs in development, in
+# production and under tests, and each of these wants different settings.
+# The subclasses below only hold what differs from Config, and the
+# MICROBLOG_CONFIG environment variable picks one of them by name.
+
+def server_pool_options(uri, **options):
+    '''
+    Connection pool settings only make sense for database servers. SQLite
+    connects to a file (or to memory) and its pools take other arguments.
+    '''
+    return {} if uri.startswith('sqlite') else options
+
+
+class DevelopmentConfig(Config):
+    # Write-ahead logging lets the development server answer reads while
+    # another request is writing, and busy_timeout makes a writer wait a bit
+    # for the lock instead of failing with "database is locked".
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'busy_timeout': 5000,
+    }
+
+
+class ProductionConfig(Config):
+    # pool_size connections are kept open per worker process, with up to
+    # max_overflow extra ones under bursts. pool_pre_ping checks that a
+    # connection is still alive before handing it out, and pool_recycle
+    # replaces connections before the server's idle timeout closes them.
+    SQLALCHEMY_ENGINE_OPTIONS = server_pool_options(
+        Config.SQLALCHEMY_DATABASE_URI,
+        pool_size=int(os.environ.get('DATABASE_POOL_SIZE') or 10),
+        max_overflow=int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20),
+        pool_pre_ping=True,
+        pool_recycle=int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800),
+        pool_timeout=10,
+    )
+    # Applied to every new SQLite connection, see app/database.py. In WAL
+    # mode readers no longer block the writer (and the other way around), and
+    # with synchronous=NORMAL a commit does not wait for an fsync, which is
+    # still safe against application crashes in WAL mode. mmap_size lets
+    # reads come straight from the page cache of the OS, and a negative
+    # cache_size is in KiB: 64 MiB of page cache per connection.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'busy_timeout': 5000,
+    }
+    TIMELINE_STRICT_LOADING = False
+    # Templates only change with a deploy, so there is no need to look at
+    # their modification times on every render.
+    TEMPLATES_AUTO_RELOAD = False
+    TEMPLATE_PRELOAD = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    RATELIMIT_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
+        'sqlite://'
+    WTF_CSRF_ENABLED = False
+    # Tests see the effects of a write as soon as it is committed.
+    JOBS_INLINE = True
+    # Tests log users in all the time, they do not need a slow hash.
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    TIMELINE_STRICT_LOADING = True
+    # Every lookup goes to the database, so that tests see their users
+    # exactly as they wrote them.
+    USER_CACHE_ENABLED = False
+
+
+config = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+    'default': DevelopmentConfig,
+}
@@ -1,7 +1,10 @@
-from app import app
+from app import create_app
 
-# The Flask application instance is called app, and is a member of
-# the app package (the folder name).
+app = create_app()
+
+# The Flask application instance is called app. It used to be created when
+# the app package (the folder name) was imported, now it is built here by
+# the create_app() factory function.
 
 # With this script, we now have a minimal working example
 # of a Flask application.
@@ -1,9 +1,16 @@
 import logging
+import os
+import sys
 from logging.config import fileConfig
 
 from flask import current_app
 
 from alembic import context
+from alembic.migration import MigrationContext
+
+# The migration scripts import the helpers of migrations/online.py.
+sys.path.insert(0, os.path.dirname(__file__))
+import online  # noqa: E402
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -39,6 +46,14 @@ def get_engine_url():
 config.set_main_option('sqlalchemy.url', get_engine_url())
 target_db = current_app.extensions['migrate'].db
 
+# Settings of the online migration helpers, for example
+# "flask db upgrade -x batch_size=5000 -x throttle=0 -x dry_run=true".
+x_arguments = context.get_x_argument(as_dictionary=True)
+dry_run = x_arguments.get('dry_run', '').lower() in ('1', 'true', 'yes')
+online.configure(engine=get_engine(),
+                 batch_size=x_arguments.get('batch_size'),
+                 throttle=x_arguments.get('throttle'))
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -72,6 +87,25 @@ def run_migrations_offline():
         context.run_migrations()
 
 
+def run_migrations_dry():
+    """Render the pending migrations as SQL, like --sql, starting from
+    the revision the database is at. The online helpers estimate their work
+    against the database, without changing it.
+
+    """
+    with get_engine().connect() as connection:
+        current = MigrationContext.configure(connection).get_current_revision()
+    context.configure(
+        url=config.get_main_option("sqlalchemy.url"),
+        target_metadata=get_metadata(), literal_binds=True,
+        starting_rev=current, as_sql=True
+    )
+
+    with online.dry_run_batches(get_engine()), \
+            context.begin_transaction():
+        context.run_migrations()
+
+
 def run_migrations_online():
     """Run migrations in 'online' mode.
 
@@ -90,6 +124,13 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # The full-text indexes of the posts (see app/search.py) are virtual
+    # tables that SQLite backs with tables of their own. None of them are
+    # models, so autogenerate must not offer to drop them.
+    def include_name(name, type_, parent_names):
+        return not (type_ == 'table' and
+                    name.startswith(('post_fts', 'post_archive_fts')))
+
     connectable = get_engine()
 
     with connectable.connect() as connection:
@@ -97,6 +138,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
+            include_name=include_name,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -106,5 +148,7 @@ def run_migrations_online():
 
 if context.is_offline_mode():
     run_migrations_offline()
+elif dry_run:
+    run_migrations_dry()
 else:
     run_migrations_online()
@@ -0,0 +1,530 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from alembic import op
+from alembic.operations import Operations
+from sqlalchemy.dialects import postgresql, sqlite
+
+'''
+Online schema changes
+
+op.batch_alter_table() changes a SQLite table by copying it into a new one
+inside a single transaction, and an UPDATE that backfills a new column
+touches every row in one statement. Both keep the write lock (of the table,
+or of the whole database on SQLite) for as long as they take, which on a big
+post table is minutes of failed or stalled writes. The helpers here do the
+same jobs in small steps, each in its own short transaction, so that the
+application keeps writing in between:
+
+- backfill() runs an UPDATE over consecutive ranges of the primary key.
+- create_index() and drop_index() use CREATE/DROP INDEX CONCURRENTLY on
+  PostgreSQL. Other databases build the index the normal way.
+- copy_and_swap() builds the new version of a table next to the old one,
+  keeps it in sync with triggers while copying the rows over in chunks, and
+  swaps the two in one short transaction at the end. It works on SQLite and
+  PostgreSQL.
+
+After each chunk the helpers sleep for "throttle" times as long as the chunk
+took, so with the default of 0.5 a backfill uses the database two thirds of
+the time at most. Progress is logged to the alembic.online logger.
+
+The batch size and the throttle can be given to each helper, or for a whole
+run on the command line:
+
+    flask db upgrade -x batch_size=5000 -x throttle=0
+
+With -x dry_run=true nothing is changed: the migrations are rendered as SQL,
+like with --sql, and the helpers estimate what they would do instead, timing
+one chunk of the real work inside a transaction that is rolled back:
+
+    flask db upgrade -x dry_run=true
+
+The dry run starts from the revision the database is at. Rendering a
+batch_alter_table() that rebuilds a SQLite table needs the table as it is,
+which --sql cannot reflect, so during a dry run it is reflected from the
+database instead (see dry_run_batches()). That is the table before the
+pending migrations, so a rebuild rendered after an earlier pending migration
+changed the same table misses that change. Batch operations on tables that
+earlier pending migrations create are rendered without a rebuild.
+
+Since the steps are committed one by one, a helper that is interrupted
+leaves its work half done, and the migration has to be run again. The
+helpers are written to pick up where they left off, and backfill() should be
+given a where clause that skips the rows that are done already.
+'''
+
+logger = logging.getLogger('alembic.online')
+
+settings = {
+    'engine': None,
+    'batch_size': 1000,
+    'throttle': 0.5,
+    'report_interval': 5,
+}
+
+
+def configure(engine=None, batch_size=None, throttle=None):
+    '''
+    Called by env.py. engine is used for the estimates of dry runs, which
+    have no connection of their own.
+    '''
+    if engine is not None:
+        settings['engine'] = engine
+    if batch_size is not None:
+        settings['batch_size'] = int(batch_size)
+    if throttle is not None:
+        settings['throttle'] = float(throttle)
+
+
+def is_dry_run():
+    return op.get_context().as_sql
+
+
+class Progress(object):
+    '''Logs how far along a chunked operation is, every few seconds.'''
+
+    def __init__(self, label, low, high):
+        self.label = label
+        self.low = low
+        self.high = high
+        self.started = self.reported = time.monotonic()
+        self.position = low - 1
+        self.rows = 0
+
+    def advance(self, position, rows):
+        self.position = position
+        self.rows += max(rows, 0)
+        if time.monotonic() - self.reported >= settings['report_interval']:
+            self.report()
+
+    def report(self):
+        self.reported = time.monotonic()
+        elapsed = self.reported - self.started
+        span = self.high - self.low + 1
+        done = (self.position - self.low + 1) / span if span else 1
+        left = elapsed / done - elapsed if done else float('inf')
+        logger.info('%s: %.0f%% of ids %s..%s, %s rows in %s, %s left',
+                    self.label, done * 100, self.low, self.high, self.rows,
+                    duration(elapsed), duration(left))
+
+
+class Estimate(object):
+    def __init__(self, label, rows, low, high, batch_size, throttle,
+                 chunk_seconds=None):
+        self.label = label
+        self.rows = rows
+        self.chunks = 0 if low is None else \
+            math.ceil((high - low + 1) / batch_size)
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.chunk_seconds = chunk_seconds
+
+    @property
+    def seconds(self):
+        if self.chunk_seconds is None:
+            return None
+        return self.chunks * self.chunk_seconds * (1 + self.throttle)
+
+    def __str__(self):
+        text = f'{self.label}: {self.rows} rows, {self.chunks} chunks of ' \
+               f'{self.batch_size} ids'
+        if self.chunk_seconds is not None:
+            text += f', {self.chunk_seconds * 1000:.1f} ms per chunk, ' \
+                    f'about {duration(self.seconds)} in total with a ' \
+                    f'throttle of {self.throttle}'
+        return text
+
+
+def duration(seconds):
+    if seconds == float('inf'):
+        return '?'
+    if seconds < 120:
+        return f'{seconds:.1f}s'
+    if seconds < 7200:
+        return f'{seconds / 60:.1f}min'
+    return f'{seconds / 3600:.1f}h'
+
+
+def key_range(connection, table, key):
+    column = table.c[key]
+    return connection.execute(
+        sa.select(sa.func.min(column), sa.func.max(column))).one()
+
+
+def row_count(connection, table):
+    if connection.dialect.name == 'postgresql':
+        # The planner's estimate, which unlike count(*) costs nothing.
+        estimate = connection.scalar(
+            sa.text('SELECT reltuples::bigint FROM pg_class '
+                    'WHERE oid = to_regclass(:name)'), {'name': table.name})
+        if estimate is not None and estimate >= 0:
+            return estimate
+    return connection.scalar(sa.select(sa.func.count()).select_from(table))
+
+
+def estimate(label, table, key='id', batch_size=None, throttle=None,
+             sample=None):
+    '''
+    Estimate a chunked operation over table. sample(connection, low, high)
+    does the work of one chunk; it is timed on a chunk from the middle of
+    the table inside a transaction that is then rolled back.
+    '''
+    batch_size = batch_size or settings['batch_size']
+    throttle = settings['throttle'] if throttle is None else throttle
+    with settings['engine'].connect() as connection:
+        low, high = key_range(connection, table, key)
+        rows = row_count(connection, table)
+        chunk_seconds = None
+        if sample is not None and low is not None:
+            start = low + (high - low) // 2
+            if connection.dialect.name == 'sqlite':
+                # pysqlite only begins a transaction by itself before an
+                # INSERT, UPDATE or DELETE, and a CREATE TABLE of the sample
+                # would survive the rollback.
+                connection.exec_driver_sql('BEGIN')
+            try:
+                started = time.perf_counter()
+                sample(connection, start, start + batch_size - 1)
+                chunk_seconds = time.perf_counter() - started
+            except sa.exc.DBAPIError as exc:
+                # Typically a column added by an earlier step of the same
+                # dry run, which therefore does not exist yet.
+                logger.warning('Dry run: could not time a chunk of the %s: '
+                               '%s', label, exc.orig)
+            finally:
+                connection.rollback()
+    result = Estimate(label, rows, low, high, batch_size, throttle,
+                      chunk_seconds)
+    logger.info('Dry run: %s', result)
+    op.execute(f'-- {result}')
+    return result
+
+
+def in_chunks(label, table, key, execute, batch_size=None, throttle=None,
+              low=None, high=None):
+    '''
+    Call execute(connection, low, high) over consecutive ranges of batch_size
+    ids, each in a transaction of its own, and return the number of rows
+    that execute() reported.
+    '''
+    batch_size = batch_size or settings['batch_size']
+    throttle = settings['throttle'] if throttle is None else throttle
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        if low is None or high is None:
+            low, high = key_range(connection, table, key)
+        if low is None:
+            return 0
+        progress = Progress(label, low, high)
+        for start in range(low, high + 1, batch_size):
+            end = min(start + batch_size - 1, high)
+            started = time.perf_counter()
+            with transaction(connection):
+                rows = execute(connection, start, end)
+            progress.advance(end, rows or 0)
+            if throttle:
+                time.sleep((time.perf_counter() - started) * throttle)
+        progress.report()
+        return progress.rows
+
+
+@contextmanager
+def transaction(connection):
+    # The connection is in autocommit mode inside autocommit_block(), so
+    # the transactions are opened and closed by hand.
+    begin = 'BEGIN IMMEDIATE' if connection.dialect.name == 'sqlite' \
+        else 'BEGIN'
+    connection.exec_driver_sql(begin)
+    try:
+        yield
+    except BaseException:
+        connection.exec_driver_sql('ROLLBACK')
+        raise
+    connection.exec_driver_sql('COMMIT')
+
+
+def backfill(table, values, where=None, key='id', batch_size=None,
+             throttle=None):
+    '''
+    UPDATE table SET values, batch_size ids at a time. table is a
+    sa.table() with the columns the update needs, and values maps column
+    names to values or SQL expressions, as in update().values(). where
+    restricts the rows, and should skip the rows that are done already so
+    that an interrupted backfill can be resumed.
+    '''
+    def update(connection, low, high):
+        condition = table.c[key].between(low, high)
+        if where is not None:
+            condition = sa.and_(condition, where)
+        return connection.execute(
+            sa.update(table).where(condition).values(values)).rowcount
+
+    label = f'backfill of {table.name}'
+    if is_dry_run():
+        return estimate(label, table, key, batch_size, throttle, update)
+    return in_chunks(label, table, key, update, batch_size, throttle)
+
+
+def create_index(name, table_name, columns, unique=False, **kwargs):
+    '''
+    op.create_index() that does not block writes on PostgreSQL. A
+    concurrent build that fails leaves an INVALID index behind, which has to
+    be dropped before trying again.
+    '''
+    if op.get_context().dialect.name != 'postgresql':
+        op.create_index(name, table_name, columns, unique=unique, **kwargs)
+        return
+    with op.get_context().autocommit_block():
+        op.create_index(name, table_name, columns, unique=unique,
+                        postgresql_concurrently=True, **kwargs)
+
+
+def drop_index(name, table_name, **kwargs):
+    if op.get_context().dialect.name != 'postgresql':
+        op.drop_index(name, table_name=table_name, **kwargs)
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(name, table_name=table_name,
+                      postgresql_concurrently=True, **kwargs)
+
+
+@contextmanager
+def dry_run_batches(engine):
+    '''
+    Let op.batch_alter_table() render in a dry run, by giving it the table
+    reflected from engine as its copy_from, which is what --sql mode lacks
+    to rebuild a SQLite table. Tables that do not exist yet get
+    recreate='never'.
+    '''
+    original = Operations.batch_alter_table
+
+    @contextmanager
+    def batch_alter_table(self, table_name, schema=None, recreate='auto',
+                          copy_from=None, **kwargs):
+        if copy_from is None and recreate != 'never':
+            if sa.inspect(engine).has_table(table_name, schema=schema):
+                copy_from = sa.Table(table_name, sa.MetaData(),
+                                     schema=schema, autoload_with=engine)
+            else:
+                recreate = 'never'
+        with original(self, table_name, schema=schema, recreate=recreate,
+                      copy_from=copy_from, **kwargs) as batch_op:
+            yield batch_op
+
+    Operations.batch_alter_table = batch_alter_table
+    try:
+        yield
+    finally:
+        Operations.batch_alter_table = original
+
+
+def copy_and_swap(table_name, columns, indexes=(), key='id', batch_size=None,
+                  throttle=None):
+    '''
+    Replace table_name by a new table made of columns (sa.Column and
+    constraint objects) and indexes, a list of (name, [column names]) or
+    (name, [column names], unique) tuples, without holding a lock on it for
+    more than a chunk at a time:
+
+    1. The new table is created under a temporary name, with its indexes.
+    2. Triggers on the old table repeat every write in the new one.
+    3. The rows are copied over, batch_size ids at a time. Rows the triggers
+       copied first are left alone.
+    4. In one short transaction the old table is dropped, and the new one
+       takes its name. Triggers of the old table (such as the ones of the
+       full-text index of the posts) are created again on the new one.
+
+    Only the columns that the two tables have in common are copied, the
+    others start out with their defaults and can be filled with backfill()
+    afterwards.
+
+    Foreign keys that point to the table follow the name on SQLite. On
+    PostgreSQL they follow the table itself, so they are dropped and added
+    again as NOT VALID in the swap, and validated after it, which does not
+    block writes. SQLite cannot rename an index, so there the indexes are
+    built again under their final names after the swap, which holds the
+    write lock for as long as each build takes.
+    '''
+    dialect = op.get_context().dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        raise NotImplementedError(f'copy_and_swap() does not support '
+                                  f'{dialect}')
+    # The old table is reflected first, which brings along the tables it
+    # refers to, for the foreign keys of the new one.
+    bind = settings['engine'] if is_dry_run() else op.get_bind()
+    metadata = sa.MetaData()
+    old = sa.Table(table_name, metadata, autoload_with=bind)
+    shadow_name = f'_{table_name}_new'
+    shadow = sa.Table(shadow_name, metadata, *columns)
+    indexes = [(index[0], index[1], index[2] if len(index) > 2 else False)
+               for index in indexes]
+    temporary = [(f'{name}__new', index_columns, unique)
+                 for name, index_columns, unique in indexes]
+    for name, index_columns, unique in temporary:
+        sa.Index(name, *[shadow.c[c] for c in index_columns], unique=unique)
+
+    common = [c.name for c in shadow.columns if c.name in old.c]
+
+    def copy(connection, low, high):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        rows = sa.select(*[old.c[c] for c in common]) \
+            .where(old.c[key].between(low, high))
+        return connection.execute(
+            insert(shadow).from_select(common, rows)
+            .on_conflict_do_nothing()).rowcount
+
+    label = f'copy of {table_name}'
+    if is_dry_run():
+        def sample(connection, low, high):
+            shadow.create(connection)
+            copy(connection, low, high)
+        return estimate(label, old, key, batch_size, throttle, sample)
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        shadow.create(connection, checkfirst=True)
+        triggers = _own_triggers(connection, table_name) \
+            if dialect == 'sqlite' else []
+        _create_sync_triggers(connection, old, shadow, common, key)
+        # Everything written from now on reaches the new table, so the copy
+        # only has to go up to the ids that exist now.
+        low, high = key_range(connection, old, key)
+    in_chunks(label, old, key, copy, batch_size, throttle, low, high)
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        if dialect == 'sqlite':
+            _swap_sqlite(connection, table_name, shadow_name, triggers)
+            for (final, index_columns, unique), (name, _, _) in \
+                    zip(indexes, temporary):
+                op.create_index(final, table_name, index_columns,
+                                unique=unique)
+                op.drop_index(name, table_name=table_name)
+        else:
+            foreign_keys = _inbound_foreign_keys(connection, table_name)
+            _swap_postgresql(connection, table_name, shadow_name, key,
+                             indexes, temporary, foreign_keys)
+            for child, constraint in foreign_keys:
+                connection.execute(sa.text(
+                    f'ALTER TABLE {_quote(child)} VALIDATE CONSTRAINT '
+                    f'{_quote(constraint["name"])}'))
+    logger.info('%s swapped for the new version', table_name)
+
+
+def _quote(name):
+    return op.get_context().dialect.identifier_preparer.quote(name)
+
+
+def _own_triggers(connection, table_name):
+    return connection.execute(sa.text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+        "AND tbl_name = :table"), {'table': table_name}).all()
+
+
+def _create_sync_triggers(connection, old, shadow, common, key):
+    table, target = _quote(old.name), _quote(shadow.name)
+    names = ', '.join(_quote(c) for c in common)
+    new = ', '.join(f'NEW.{_quote(c)}' for c in common)
+    key = _quote(key)
+    if connection.dialect.name == 'sqlite':
+        # SQLite has one writer at a time, so a plain INSERT OR REPLACE
+        # cannot race with the chunks of the copy.
+        upsert = f'INSERT OR REPLACE INTO {target} ({names}) VALUES ({new});'
+        remove = f'DELETE FROM {target} WHERE {key} = OLD.{key};'
+        for event, body in (('INSERT', upsert), ('UPDATE', remove + upsert),
+                            ('DELETE', remove)):
+            connection.execute(sa.text(
+                f'CREATE TRIGGER IF NOT EXISTS '
+                f'{_quote(shadow.name + "_sync_" + event.lower())} AFTER '
+                f'{event} ON {table} BEGIN {body} END'))
+        return
+    updates = ', '.join(f'{_quote(c)} = EXCLUDED.{_quote(c)}'
+                        for c in common)
+    function = _quote(shadow.name + '_sync')
+    # ON CONFLICT DO UPDATE, because the row may have been copied by a
+    # chunk that committed after this transaction started.
+    connection.execute(sa.text(f'''
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {target} WHERE {key} = OLD.{key};
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {target} ({names}) VALUES ({new})
+                ON CONFLICT ({key}) DO UPDATE SET {updates};
+            END IF;
+            RETURN NULL;
+        END $$'''))
+    connection.execute(sa.text(
+        f'DROP TRIGGER IF EXISTS {function} ON {table}'))
+    connection.execute(sa.text(
+        f'CREATE TRIGGER {function} AFTER INSERT OR UPDATE OR DELETE ON '
+        f'{table} FOR EACH ROW EXECUTE FUNCTION {function}()'))
+
+
+def _swap_sqlite(connection, table_name, shadow_name, triggers):
+    # With legacy_alter_table on, renaming the new table does not rewrite
+    # the foreign keys of other tables that point to table_name, which then
+    # point to the new table. Foreign key enforcement has to be off to drop
+    # a table that is referenced. Neither PRAGMA works inside a transaction.
+    enforced = connection.exec_driver_sql('PRAGMA foreign_keys').scalar()
+    connection.exec_driver_sql('PRAGMA foreign_keys = OFF')
+    connection.exec_driver_sql('PRAGMA legacy_alter_table = ON')
+    try:
+        with transaction(connection):
+            connection.execute(sa.text(f'DROP TABLE {_quote(table_name)}'))
+            connection.execute(sa.text(
+                f'ALTER TABLE {_quote(shadow_name)} RENAME TO '
+                f'{_quote(table_name)}'))
+            for name, sql in triggers:
+                if not name.startswith(shadow_name):
+                    connection.exec_driver_sql(sql)
+    finally:
+        connection.exec_driver_sql('PRAGMA legacy_alter_table = OFF')
+        connection.exec_driver_sql(f'PRAGMA foreign_keys = {enforced}')
+
+
+def _inbound_foreign_keys(connection, table_name):
+    inspector = sa.inspect(connection)
+    return [(child, constraint)
+            for child in inspector.get_table_names() if child != table_name
+            for constraint in inspector.get_foreign_keys(child)
+            if constraint['referred_table'] == table_name]
+
+
+def _swap_postgresql(connection, table_name, shadow_name, key, indexes,
+                     temporary, foreign_keys):
+    table, shadow = _quote(table_name), _quote(shadow_name)
+    with transaction(connection):
+        connection.execute(sa.text(
+            f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE'))
+        for child, constraint in foreign_keys:
+            connection.execute(sa.text(
+                f'ALTER TABLE {_quote(child)} DROP CONSTRAINT '
+                f'{_quote(constraint["name"])}'))
+        connection.execute(sa.text(f'DROP TABLE {table}'))
+        connection.execute(sa.text(
+            f'DROP FUNCTION IF EXISTS {_quote(shadow_name + "_sync")}()'))
+        connection.execute(sa.text(f'ALTER TABLE {shadow} RENAME TO {table}'))
+        for (final, _, _), (name, _, _) in zip(indexes, temporary):
+            connection.execute(sa.text(
+                f'ALTER INDEX {_quote(name)} RENAME TO {_quote(final)}'))
+        # The new table got a sequence of its own, which has not seen the
+        # copied ids.
+        connection.execute(sa.text(
+            f'SELECT setval(pg_get_serial_sequence(:table, :key), '
+            f'(SELECT coalesce(max({_quote(key)}), 1) FROM {table}))'),
+            {'table': table, 'key': key})
+        for child, constraint in foreign_keys:
+            columns = ', '.join(_quote(c)
+                                for c in constraint['constrained_columns'])
+            referred = ', '.join(_quote(c)
+                                 for c in constraint['referred_columns'])
+            connection.execute(sa.text(
+                f'ALTER TABLE {_quote(child)} ADD CONSTRAINT '
+                f'{_quote(constraint["name"])} FOREIGN KEY ({columns}) '
+                f'REFERENCES {table} ({referred}) NOT VALID'))
@@ -0,0 +1,54 @@
+"""post full-text search
+
+Revision ID: 5f2b9d7c1e63
+Revises: 8a41d6c2e7b5
+Create Date: 2023-06-26 20:14:05.318442
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2b9d7c1e63'
+down_revision = '8a41d6c2e7b5'
+branch_labels = None
+depends_on = None
+
+# The FTS5 index only exists in SQLite databases, other databases are searched
+# by the LIKE backend of app/search.py and need nothing here.
+#
+# Careful: batch_alter_table() rebuilds a SQLite table by copying it, which
+# drops its triggers. A later migration that batch alters the post table has
+# to run the CREATE TRIGGER statements below again.
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5("
+               "body, content='post', content_rowid='id', "
+               "tokenize='porter unicode61')")
+    op.execute("CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+               "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); "
+               "END")
+    op.execute("CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+               "INSERT INTO post_fts (post_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); END")
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post "
+               "BEGIN "
+               "INSERT INTO post_fts (post_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); "
+               "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); "
+               "END")
+    # Index the posts that are already there.
+    op.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER post_fts_update')
+    op.execute('DROP TRIGGER post_fts_delete')
+    op.execute('DROP TRIGGER post_fts_insert')
+    op.execute('DROP TABLE post_fts')
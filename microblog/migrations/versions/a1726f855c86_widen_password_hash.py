@@ -0,0 +1,67 @@
+"""widen password_hash
+
+Revision ID: a1726f855c86
+Revises: f8729db8bf76
+Create Date: 2026-10-18 08:47:56.214896
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import online
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1726f855c86'
+down_revision = 'f8729db8bf76'
+branch_labels = None
+depends_on = None
+
+# An scrypt hash is 162 characters long, which does not fit in 128. On
+# SQLite, batch_alter_table() would rebuild the user table in one
+# transaction that blocks every login and every post (they update the
+# counters) until all the rows are copied, so the table is rebuilt with
+# online.copy_and_swap() instead. PostgreSQL makes a VARCHAR longer without
+# rewriting the rows.
+
+
+def user_columns(password_hash_length):
+    return [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=64), nullable=True),
+        sa.Column('email', sa.String(length=120), nullable=True),
+        sa.Column('password_hash', sa.String(length=password_hash_length),
+                  nullable=True),
+        sa.Column('fanout_on_read', sa.Boolean(), server_default='0',
+                  nullable=False),
+        sa.Column('post_count', sa.Integer(), server_default='0',
+                  nullable=False),
+        sa.Column('follower_count', sa.Integer(), server_default='0',
+                  nullable=False),
+        sa.Column('followed_count', sa.Integer(), server_default='0',
+                  nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    ]
+
+
+user_indexes = [
+    ('ix_user_email', ['email'], True),
+    ('ix_user_username', ['username'], True),
+]
+
+
+def resize_password_hash(old, new):
+    if op.get_context().dialect.name == 'sqlite':
+        online.copy_and_swap('user', user_columns(new), user_indexes)
+    else:
+        op.alter_column('user', 'password_hash',
+                        existing_type=sa.String(length=old),
+                        type_=sa.String(length=new), existing_nullable=True)
+
+
+def upgrade():
+    resize_password_hash(128, 256)
+
+
+def downgrade():
+    resize_password_hash(256, 128)
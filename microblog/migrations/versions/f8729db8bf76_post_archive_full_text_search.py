@@ -0,0 +1,56 @@
+"""post archive full-text search
+
+Revision ID: f8729db8bf76
+Revises: f055c45dbb27
+Create Date: 2026-10-18 08:36:56.470957
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8729db8bf76'
+down_revision = 'f055c45dbb27'
+branch_labels = None
+depends_on = None
+
+# The archived posts get an FTS5 index of their own, kept in sync with the
+# post_archive table by triggers, like the index of the post table in
+# 5f2b9d7c1e63, so that moving posts to the archive keeps them searchable.
+# The same warning applies: batch_alter_table() on post_archive drops these
+# triggers.
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE post_archive_fts USING fts5("
+               "body, content='post_archive', content_rowid='id', "
+               "tokenize='porter unicode61')")
+    op.execute("CREATE TRIGGER post_archive_fts_insert AFTER INSERT ON "
+               "post_archive BEGIN "
+               "INSERT INTO post_archive_fts (rowid, body) "
+               "VALUES (new.id, new.body); END")
+    op.execute("CREATE TRIGGER post_archive_fts_delete AFTER DELETE ON "
+               "post_archive BEGIN "
+               "INSERT INTO post_archive_fts (post_archive_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); END")
+    op.execute("CREATE TRIGGER post_archive_fts_update AFTER UPDATE OF body "
+               "ON post_archive BEGIN "
+               "INSERT INTO post_archive_fts (post_archive_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); "
+               "INSERT INTO post_archive_fts (rowid, body) "
+               "VALUES (new.id, new.body); END")
+    # Index the posts that were archived already.
+    op.execute("INSERT INTO post_archive_fts (post_archive_fts) "
+               "VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER post_archive_fts_update')
+    op.execute('DROP TRIGGER post_archive_fts_delete')
+    op.execute('DROP TRIGGER post_archive_fts_insert')
+    op.execute('DROP TABLE post_archive_fts')